@@ -30,6 +30,9 @@ from plugwise import *
 from swutil.util import *
 from swutil.pwmqtt import *
 from plugwise.api import *
+from plugwise.mirror import *
+from plugwise.backfill import *
+from plugwise.monitor import *
 
 from datetime import datetime, timedelta
 #import datetime
@@ -39,9 +42,13 @@ import subprocess
 import glob
 import os
 import logging
+import sys
+import signal
 import queue
 import threading
+import concurrent.futures
 import itertools
+import collections
 
 mqtt = True
 try:
@@ -86,12 +93,24 @@ curpost = '.log'
 logdir = 'pwlog/'
 logpre = 'pw-'
 logpost = '.log'
+fastdir = 'pwfast/'
+fastpre = 'pwfast-'
+fastpost = '.bin'
 
 open_logcomm(logpath+"pw-communication.log")
 
 #prepare for cleanup of /tmp after n days.
 cleanage = 604800; # seven days in seconds
 
+#version of the format of the circle state snapshot
+STATE_VERSION = 1
+
+#seconds of a ten seconds cycle available to send power requests of monitored circles
+MONITOR_BUDGET = 5.0
+
+#default share of the stick airtime for fast monitoring
+FAST_SHARE = 0.25
+
 locnow = datetime.utcnow()-timedelta(seconds=time.timezone)
 now = locnow
 yrfolder = str(now.year)+'/'
@@ -129,6 +148,29 @@ class PWControl(object):
         while not self.device.connected:
             time.sleep(5)
             self.device.reconnect()
+        #unsolicited pongs and advertisements, published by the stick reader thread
+        self.events = queue.Queue()
+        self.unjoined = set()
+        for function_code in (b'000E', b'0006'):
+            self.device.subscribe(function_code, self.events.put)
+        self.device.start_reader()
+        self.started = time.time()
+        #seconds from the start to the first power reading, by mac
+        self.first_reading = dict()
+        #AdaptiveRate and Deadband of the monitored circles, by mac
+        self.rates = dict()
+        self.deadbands = dict()
+        #lines of pwpower.log
+        self.curlines = []
+        #snapshot mode, see read_apply_controls
+        self.snapshot = False
+        #samples taken, samples skipped for the budget and overrun cycles since the last report
+        self.monitor_stats = collections.Counter()
+        #guards the control settings and the control file, changed by MQTT commands
+        #and the main loop. Not held during circle communication.
+        self.lock = threading.RLock()
+        #serialize the communication with a circle of MQTT commands and the main loop, by mac
+        self.circlelocks = dict()
         self.staticconfig_fn = 'config/pw-conf.json'
         self.control_fn = 'config/pw-control.json'
         #self.schedule_fn = 'config/pw-schedules.json'
@@ -155,6 +197,27 @@ class PWControl(object):
         self.logfnames = dict()
         self.daylogfnames = dict()
         self.lastlogfname = perpath+'pwlastlog.log'
+        self.calibrationfname = perpath+'pwcalibration.json'
+        self.statefname = perpath+'pwstate.json'
+        #local copies of the completed log buffers, one file per circle
+        self.mirrorpath = perpath+'pwmirror/'
+        if not os.path.exists(self.mirrorpath):
+            os.makedirs(self.mirrorpath)
+
+        #calibration constants by mac, saves reading them from the circles at every start
+        self.calibrations = self.load_calibrations()
+        #circles using cached calibration constants not yet compared with the circle
+        self.unverified = set()
+        #state of the circles at the last shutdown, by mac
+        state = self.load_state()
+        #circles using that state, to be verified after the first power readings
+        self.restored = []
+        #Backfill of log buffers outstanding after downtime, see start_backfill
+        self.backfill = None
+        #circles waiting for complete_init, which runs in the background
+        self.initializing = set()
+        #1 second monitoring of the circles with monitor_fast, see read_apply_controls
+        self.fast = FastMonitor(self.device, FAST_SHARE, logfname=self.fast_logfname)
 
         #read the static configuration
         sconf = json.load(open(self.staticconfig_fn))
@@ -170,11 +233,20 @@ class PWControl(object):
                 item['reverse_pol'] = False
             self.bymac[item.get('mac')]=i
             self.byname[item.get('name')]=i
-            #exception handling timeouts done by circle object for init
-            self.circles.append(Circle(item['mac'], self.device, item))
-            self.set_interval_production(self.circles[-1])
+            c = Circle(item['mac'], self.device, item, initialize=False)
+            c.set_mirror(LogMirror(self.mirrorpath+c.mac+'.bin'))
+            if c.mac in self.calibrations:
+                c.set_calibration(self.calibrations[c.mac])
+                self.unverified.add(c.mac)
+            if c.mac in state:
+                c.restore(state[c.mac])
+                self.restored.append(c)
+            self.circles.append(c)
             i += 1
-            info("adding circle: %s" % (self.circles[-1].name,))
+            info("adding circle: %s" % (c.name,))
+        self.circlelocks = dict((c.mac, threading.RLock()) for c in self.circles)
+        #exception handling timeouts done by circle object for init
+        self.init_circles()
         
         #retrieve last log addresses from persistent storage
         with open(self.lastlogfname, 'a+') as f:
@@ -199,11 +271,76 @@ class PWControl(object):
                     self.circles[self.bymac[mac]].cum_energy = cum_energy
                 except:
                     error("PWControl.__init__(): lastlog mac not found in circles")
+        self.save_calibrations()
          
         self.schedulesstat = dict ((f, os.path.getmtime(f)) for f in glob.glob(schedules_path+'/*.json'))
         self.schedules = self.read_schedules()
         self.poll_configuration()
 
+    def load_calibrations(self):
+        try:
+            with open(self.calibrationfname) as f:
+                return json.load(f)
+        except (IOError, ValueError) as reason:
+            info("PWControl.load_calibrations(): no cached calibrations: %s" % (reason,))
+            return dict()
+
+    def save_calibrations(self):
+        """store the calibration constants of the circles, when changed"""
+        calibrations = dict(self.calibrations)
+        for c in self.circles:
+            calibration = c.calibration()
+            if calibration is not None:
+                calibrations[c.mac] = calibration
+        if calibrations == self.calibrations and os.path.exists(self.calibrationfname):
+            return
+        tmpfname = self.calibrationfname+'.tmp'
+        with open(tmpfname, 'w') as f:
+            json.dump(calibrations, f, indent=1, sort_keys=True)
+        os.replace(tmpfname, self.calibrationfname)
+        self.calibrations = calibrations
+
+    def load_state(self):
+        """the circle state snapshot written by save_state, by mac"""
+        try:
+            with open(self.statefname) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as reason:
+            info("PWControl.load_state(): no circle state: %s" % (reason,))
+            return dict()
+        if state.get('version') != STATE_VERSION:
+            info("PWControl.load_state(): ignoring circle state of version %s" % (state.get('version'),))
+            return dict()
+        info("PWControl.load_state(): circle state of %s" % (datetime.fromtimestamp(state['ts']).isoformat(),))
+        return state['circles']
+
+    def save_state(self):
+        """write a snapshot of the state of the initialized circles, to restore at the next start"""
+        state = {'version': STATE_VERSION, 'ts': time.time(),
+            'circles': dict((c.mac, c.snapshot()) for c in self.circles if c.initialized)}
+        tmpfname = self.statefname+'.tmp'
+        with open(tmpfname, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(tmpfname, self.statefname)
+
+    def verify_calibration(self):
+        """compare the cached calibration constants of one online circle with the circle"""
+        for c in self.circles:
+            if c.mac in self.unverified and c.online:
+                break
+        else:
+            return
+        cached = c.calibration()
+        try:
+            c.calibrate()
+        except (ValueError, TimeoutException, SerialException) as reason:
+            debug("Error in verify_calibration(): %s" % (reason,))
+            return
+        self.unverified.discard(c.mac)
+        if c.calibration() != cached:
+            info("Circle %s calibration changed from %s to %s" % (c.mac, cached, c.calibration()))
+            self.save_calibrations()
+
     def get_relays(self):
         """
         Update the relay state for circles with schedules enabled.
@@ -211,7 +348,9 @@ class PWControl(object):
         for c in self.circles:
             if c.online and c.schedule_state == 'on':
                 try:
-                    c.get_info()
+                    #called ten seconds into each quarter hour, just after the schedule
+                    #may have switched the relay. A cached info may predate the switch.
+                    c.get_info(max_age=0)
                 except (TimeoutException, SerialException, ValueError) as reason:
                     debug("Error in get_relays(): %s" % (reason,))
                     continue
@@ -288,15 +427,99 @@ class PWControl(object):
             except (ValueError, TimeoutException, SerialException) as reason:
                 error("Error in sync_time: %s" % (reason,))
 
-    def set_interval_production(self, c):
-        if not c.online:
+    def for_circles(self, fn, circles, priority=REALTIME):
+        """call fn(c) for the circles concurrently, with as many requests in flight
+        as the stick allows
+        """
+        if not circles:
             return
-        try:
-            #TODO: Check this. Previously log_interval was only set when difference between config file and circle state
-            c.set_log_interval(c.loginterval, c.production)
-        except (ValueError, TimeoutException, SerialException) as reason:
-            error("Error in set_interval_production: %s" % (reason,))
-                            
+        scheduler = self.device.scheduler
+        def call(c):
+            with scheduler.using(priority):
+                fn(c)
+        with concurrent.futures.ThreadPoolExecutor(min(len(circles), self.device.window.maxsize)) as pool:
+            list(pool.map(call, circles))
+
+    def init_circles(self):
+        """read the state and the calibration of the circles. The parts of the initialization
+        that the first power readings do not depend on follow in complete_init()
+        """
+        def init(c):
+            #the state of restored circles is verified in complete_init()
+            if c not in self.restored:
+                c.reinit(deferred=True)
+            if c.online and c.calibration() is None:
+                try:
+                    c.calibrate()
+                except (ValueError, TimeoutException, SerialException) as reason:
+                    debug("Error in init_circles(): %s" % (reason,))
+        self.for_circles(init, self.circles)
+        info("circles initialized: %d of %d online after %.1f seconds" %
+            (sum(1 for c in self.circles if c.online), len(self.circles), time.time() - self.started))
+
+    def start_complete_init(self):
+        """run complete_init and then start_backfill in the background, keeping the
+        ten seconds cycle short. Log recording skips the circles until the backfill
+        took over their outstanding log buffers.
+        """
+        self.initializing = set(c.mac for c in self.circles if c.online and (not c.initialized or c in self.restored))
+        def run():
+            try:
+                self.complete_init()
+                with self.device.scheduler.using(HISTORY):
+                    self.start_backfill()
+            except Exception as reason:
+                error("Error in complete_init(): %s" % (reason,))
+            finally:
+                self.initializing = set()
+        t = threading.Thread(target=run, name="complete-init")
+        t.daemon = True
+        t.start()
+
+    def complete_init(self):
+        """detect the log intervals, verify the restored state of circles and dump the
+        node table, after the first power readings
+        """
+        self.for_circles(lambda c: c.complete_init(), [c for c in self.circles if c.online and not c.initialized], MAINTENANCE)
+        self.for_circles(lambda c: c.reinit(deferred=True), [c for c in self.restored if c.online], MAINTENANCE)
+        self.restored = []
+        if debug_enabled():
+            for c in self.circles:
+                if c.online and c._devtype is not None and c.type() == 'circle+':
+                    try:
+                        debug("joined node table: %s" % (c.read_node_table(),))
+                    except (ValueError, TimeoutException, SerialException):
+                        error("PWControl.complete_init(): Communication error in read_node_table")
+
+    def start_backfill(self):
+        """read the log buffers not logged yet in the background, when log_recording
+        would need more than one call for a circle to catch up
+        """
+        if self.backfill is not None and self.backfill.running():
+            return
+        plan = []
+        for c in self.circles:
+            if not c.online or self.controls[self.controlsbymac[c.mac]]['savelog'].lower() != 'yes':
+                continue
+            try:
+                last = c.get_info(max_age=60)['last_logaddr']
+            except (TimeoutException, SerialException, ValueError) as reason:
+                debug("Error in start_backfill(): %s" % (reason,))
+                continue
+            first = c.last_log + 1 if c.last_log_idx == 4 else c.last_log
+            #only those mirrored when read, log_recording reads the rest
+            addrs = [addr for addr in outstanding(first % LOG_BUFFERS, last)
+                if c.is_mirrorable(addr) and not c.is_mirrored(addr)]
+            if addrs:
+                plan.append((c, addrs))
+        if any(len(addrs) > 100 for c, addrs in plan):
+            #called from the complete init thread and the hourly task
+            with self.lock:
+                if self.backfill is not None and self.backfill.running():
+                    return
+                self.backfill = Backfill(self.device, plan)
+                self.backfill.start()
+
     def generate_test_schedule(self, val):
         #generate test schedules
         if val == -2:
@@ -355,19 +578,20 @@ class PWControl(object):
                     if sched != c.schedule._watt:
                         info("apply_schedule_changes: schedule changed. Update in circle %s - %s" % (c.name, c.schedule.name))
                         #schedule changed so upload to this circle
-                        c.define_schedule(c.schedule.name, sched, time.localtime().tm_isdst)
-                        try:
-                            sched_state = c.schedule_state
-                            c.schedule_off()
-                            c.load_schedule(time.localtime().tm_isdst)
-                            #update scheduleCRC
-                            c.get_clock()
-                            if sched_state == 'on':
-                                c.schedule_on()
-                        except (ValueError, TimeoutException, SerialException) as reason:
-                            #failure to upload schedule.
-                            c.undefine_schedule() #clear schedule forces a retry at next call
-                            error("Error during uploading schedule: %s" % (reason,))
+                        with self.circlelocks[c.mac]:
+                            c.define_schedule(c.schedule.name, sched, time.localtime().tm_isdst)
+                            try:
+                                sched_state = c.schedule_state
+                                c.schedule_off()
+                                c.load_schedule(time.localtime().tm_isdst)
+                                #update scheduleCRC
+                                c.get_clock()
+                                if sched_state == 'on':
+                                    c.schedule_on()
+                            except (ValueError, TimeoutException, SerialException) as reason:
+                                #failure to upload schedule.
+                                c.undefine_schedule() #clear schedule forces a retry at next call
+                                error("Error during uploading schedule: %s" % (reason,))
                         self.publish_circle_state(c.mac)
                 else:
                     error("Error during uploading schedule. Schedule %s not found." % (c.schedule.name,))
@@ -376,8 +600,7 @@ class PWControl(object):
         debug("read_apply_controls")
         #read the user control settings
         controls = json.load(open(self.control_fn))  
-        self.controlsjson = controls
-        self.controlsbymac = dict()
+        controlsbymac = dict()
         newcontrols = []        
         i=0
         for item in controls['dynamic']:
@@ -386,11 +609,23 @@ class PWControl(object):
                 if isinstance(item[key],str): item[key] = item[key].strip()
             item['mac'] = item['mac'].upper()
             newcontrols.append(item)
-            self.controlsbymac[item['mac']]=i
+            controlsbymac[item['mac']]=i
             i += 1
         #set log settings
         if 'log_comm' in controls:
             log_comm(controls['log_comm'].strip().lower() == 'yes')
+        if 'log_capture' in controls:
+            if controls['log_capture'].strip().lower() == 'yes':
+                open_capture(logpath+"pw-capture.bin")
+            else:
+                close_capture()
+        #read all monitored circles together every ten seconds, and publish a snapshot
+        self.snapshot = controls.get('snapshot', 'no').strip().lower() == 'yes'
+        try:
+            self.fast.share = min(1.0, max(0.0, float(controls.get('fast_share', FAST_SHARE))))
+        except ValueError:
+            error("invalid fast_share")
+            self.fast.share = FAST_SHARE
         if 'log_level' in controls:
             if controls['log_level'].strip().lower() == 'debug':
                 log_level(logging.DEBUG)
@@ -401,18 +636,42 @@ class PWControl(object):
             else:
                 log_level(logging.INFO)
         
-        self.controls =  newcontrols
+        with self.lock:
+            #new monitoring rates and deadbands for the circles whose settings changed
+            for mac in list(self.rates):
+                if self.control_changed(mac, newcontrols, controlsbymac, ('monitor_min', 'monitor_max')):
+                    del self.rates[mac]
+            for mac in list(self.deadbands):
+                if self.control_changed(mac, newcontrols, controlsbymac, ('deadband_abs', 'deadband_rel', 'heartbeat')):
+                    del self.deadbands[mac]
+            self.controlsjson = controls
+            self.controlsbymac = controlsbymac
+            self.controls =  newcontrols
         for mac, idx in self.controlsbymac.items():
             self.apply_control_to_circle(self.controls[idx], mac, force=False)
+        fast = [self.circles[self.bymac[mac]] for mac, idx in self.controlsbymac.items()
+            if self.controls[idx].get('monitor_fast', 'no').lower() == 'yes' and mac in self.bymac]
+        if [c.mac for c in fast] != [c.mac for c in self.fast.circles]:
+            info("fast monitoring of %s" % (", ".join(c.name for c in fast) or "no circles",))
+        self.fast.set_circles(fast)
            
         return
+
+    def control_changed(self, mac, controls, controlsbymac, keys):
+        """whether the control settings keys of mac differ in controls from the current ones"""
+        if mac not in self.controlsbymac or mac not in controlsbymac:
+            return True
+        old = self.controls[self.controlsbymac[mac]]
+        new = controls[controlsbymac[mac]]
+        return any(old.get(key) != new.get(key) for key in keys)
         
     def apply_control_to_circle(self, control, mac, force=False):
         """apply control settings to circle
         in case of a communication problem, c.online is set to False by api
         self.test_offline() will apply the control settings again by calling this function
         """
-        updated = self.apply_schedule_to_circle(control, mac, force)
+        with self.circlelocks.get(mac, self.lock):
+            updated = self.apply_schedule_to_circle(control, mac, force)
         c = self.circles[self.bymac[mac]]
         
         #no longer support setting the switch and schedule state on/off from the control json file.
@@ -473,7 +732,7 @@ class PWControl(object):
                 error("Error in apply_schedule_to_circle schedule_off: %s" % (reason,))
 
             c.undefine_schedule()
-            if c.scheduleCRC != 17786:
+            if c.scheduleCRC != ALWAYS_ON_CRC:
                 #set always-on schedule in circle
                 info('circle mac: %s needs schedule to be undefined' % (mac,))
                 #print('circle mac: %s needs schedule to be undefined' % (mac,))
@@ -568,7 +827,6 @@ class PWControl(object):
             control['schedule_state'] = 'off'
             info('circle mac: %s schedule forced to off because no schedule defined' % (mac,))
             self.write_control_file()
-            self.last_control_ts = os.stat(self.control_fn).st_mtime
 
 
         #switch schedule on/off if required
@@ -679,6 +937,13 @@ class PWControl(object):
             tmpfile = tmppath + str(year-1) + '/' + actdir + actpre + '*' + actpost
             cmd = "rsync -aXq " +  tmpfile + " " + perpath + str(year-1) + '/' + actdir
             subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            # /tmp/<year>/pwfast-*
+            if glob.glob(tmppath + str(year) + '/' + fastdir + fastpre + '*' + fastpost):
+                if not os.path.exists(perpath + str(year) + '/' + fastdir):
+                    os.makedirs(perpath + str(year) + '/' + fastdir)
+                tmpfile = tmppath + str(year) + '/' + fastdir + fastpre + '*' + fastpost
+                cmd = "rsync -aXq " +  tmpfile + " " + perpath + str(year) + '/' + fastdir
+                subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         
     def cleanup_tmp(self):
         # tmpfiles = tmppath + actpre + '*' + actpost
@@ -689,6 +954,19 @@ class PWControl(object):
         for fn in glob.iglob(tmpfiles):
              if time.time()-os.path.getmtime(fn) > cleanage:
                 os.unlink(fn)
+        tmpfiles = tmppath + '*/' + fastdir + fastpre + '*' + fastpost
+        for fn in glob.iglob(tmpfiles):
+             if time.time()-os.path.getmtime(fn) > cleanage:
+                os.unlink(fn)
+
+    def fast_logfname(self, mac, ts):
+        """the compact log of the fast monitoring of a circle, one a day like the act files"""
+        #local time not following DST (always non-DST)
+        date = (datetime.utcfromtimestamp(ts)-timedelta(seconds=time.timezone)).date()
+        path = tmppath + str(date.year) + '/' + fastdir
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path + fastpre + date.isoformat() + '-' + mac + fastpost
             
     def test_mtime(self, before, after):
         modified = []
@@ -732,60 +1010,99 @@ class PWControl(object):
         #and recovery is done by the same functions.
         
     def process_mqtt_commands(self):
+        """
+        Executes MQTT commands as soon as they arrive, in a thread of its own.
+        The requests of the commands are scheduled ahead of power polling,
+        relay refreshes, history reading and maintenance.
+        """
+        with self.device.scheduler.using(INTERACTIVE):
+            while 1:
+                rcv = qsub.get()
+                self.process_mqtt_command(rcv)
+
+    def process_mqtt_command(self, rcv):
         updated = False
-        while not qsub.empty():
-            rcv = qsub.get()
-            topic = rcv[0]
-            payl = rcv[1]
-            info("process_mqtt_commands: %s %s" % (topic, payl)) 
-            #topic format: plugwise2py/cmd/<cmdname>/<mac>
-            st = topic.split('/')
-            try:
-                mac = st[-1]
-                cmd = st[-2]
-                #msg format: json: {"mac":"...", "cmd":"", "val":""}
-                msg = json.loads(payl)
+        topic = rcv[0]
+        payl = rcv[1]
+        info("process_mqtt_commands: %s %s" % (topic, payl)) 
+        #topic format: plugwise2py/cmd/<cmdname>/<mac>
+        st = topic.split('/')
+        try:
+            mac = st[-1]
+            cmd = st[-2]
+            #msg format: json: {"mac":"...", "cmd":"", "val":""}
+            msg = json.loads(payl)
+            with self.lock:
                 control = self.controls[self.controlsbymac[mac]]
-                val = msg['val']
-                try:
-                    source = msg['uid']
-                except: #KeyError:
-                    source = "anonymous_mqtt"
-            except:
-                error("MQTT: Invalid message format in topic or JSON payload")
-                continue
-            if cmd == "switch":
-                val = val.lower()
-                if val == "on" or val == "off":
-                    control['switch_state'] = val
-                    updated = self.apply_switch_to_circle(control, mac, source)
-                    ##switch command overrides schedule_state setting
-                    #control['schedule_state'] = "off"
-                else:
-                    error("MQTT command has invalid value %s" % (val,))
-            elif cmd == "schedule":
-                val = val.lower()
-                if val == "on" or val == "off":
-                    control['schedule_state'] = val
-                    updated = self.apply_schedstate_to_circle(control, mac, source)
-                else:
-                    error("MQTT command has invalid value %s" % (val,))
-            elif cmd == "setsched":
-                error("MQTT command not implemented")
-            elif cmd == "reqstate":
-                #refresh power readings for circle
-                try:
-                    c = self.circles[self.bymac[mac]]                
-                    c.get_power_usage()
-                    info("Just read power for status update")
-                except:
-                    info("Error in reading power for status update")
-                #return message is generic state message below
-                
-            self.publish_circle_state(mac)            
+            val = msg['val']
+            try:
+                source = msg['uid']
+            except: #KeyError:
+                source = "anonymous_mqtt"
+        except:
+            error("MQTT: Invalid message format in topic or JSON payload")
+            return
+        with self.circlelocks.get(mac, self.lock):
+            updated = self.apply_mqtt_command(cmd, val, control, mac, source)
+        self.publish_circle_state(mac)            
         if updated:
             self.write_control_file()
-            self.last_control_ts = os.stat(self.control_fn).st_mtime
+
+    def apply_mqtt_command(self, cmd, val, control, mac, source):
+        """apply a command to a circle, True when the control settings are changed"""
+        updated = False
+        if cmd == "switch":
+            val = val.lower()
+            if val == "on" or val == "off":
+                control['switch_state'] = val
+                updated = self.apply_switch_to_circle(control, mac, source)
+                ##switch command overrides schedule_state setting
+                #control['schedule_state'] = "off"
+            else:
+                error("MQTT command has invalid value %s" % (val,))
+        elif cmd == "schedule":
+            val = val.lower()
+            if val == "on" or val == "off":
+                control['schedule_state'] = val
+                updated = self.apply_schedstate_to_circle(control, mac, source)
+            else:
+                error("MQTT command has invalid value %s" % (val,))
+        elif cmd == "setsched":
+            error("MQTT command not implemented")
+        elif cmd == "reqstate":
+            #refresh power readings for circle
+            try:
+                c = self.circles[self.bymac[mac]]                
+                c.get_power_usage(max_age=1)
+                info("Just read power for status update")
+            except:
+                info("Error in reading power for status update")
+            #return message is generic state message in process_mqtt_command
+        return updated
+
+    def log_scheduler_stats(self):
+        #the scheduler does not lock, its calls are serialized by the stick lock
+        with self.device._cv:
+            scheduler_stats = self.device.scheduler.stats(reset=True)
+        for name, st in scheduler_stats.items():
+            if st['admitted'] or st['waiting']:
+                info("scheduler %-11s admitted %6d waiting %3d queue wait avg %.3f s max %.3f s" %
+                    (name, st['admitted'], st['waiting'], st['wait_avg'], st['wait_max']))
+        cache = collections.Counter()
+        for c in self.circles:
+            cache.update(c.cache_stats(reset=True))
+        info("reading cache hits %d misses %d coalesced %d" % (cache['hits'], cache['misses'], cache['coalesced']))
+        for name, st in self.tasks.stats(reset=True).items():
+            info("task %-13s runs %5d overruns %3d skipped %3d run time avg %.3f s max %.3f s" %
+                (name, st['runs'], st['overruns'], st['skipped'], st['avg'], st['max']))
+        stats = self.monitor_stats
+        info("monitoring samples %d skipped %d overruns %d" % (stats['samples'], stats['skipped'], stats['overruns']))
+        self.monitor_stats = collections.Counter()
+        if self.fast.circles:
+            stats = self.fast.stats
+            self.fast.stats = collections.Counter()
+            info("fast monitoring samples %d skipped %d errors %d airtime %.1f s" %
+                (stats['samples'], stats['skipped'], stats['errors'], stats['airtime']))
     
     def ftopic(self, keyword, mac):
         return ("plugwise2py/state/" + keyword + "/" + mac)
@@ -795,10 +1112,12 @@ class PWControl(object):
 
     def write_control_file(self):
         #write control file for testing purposes
-        fjson = open("config/pw-control.json", 'w')
-        self.controlsjson['dynamic'] = self.controls
-        json.dump(self.controlsjson, fjson, indent=4)
-        fjson.close()
+        with self.lock:
+            fjson = open("config/pw-control.json", 'w')
+            self.controlsjson['dynamic'] = self.controls
+            json.dump(self.controlsjson, fjson, indent=4)
+            fjson.close()
+            self.last_control_ts = os.stat(self.control_fn).st_mtime
      
     def ten_seconds(self):
         """
@@ -806,8 +1125,11 @@ class PWControl(object):
         The missed values are just not logged. The circle ends up in 
         online = False, and the self.test_offline() tries to recover
         """
-        self.curfile.seek(0)
-        self.curfile.truncate(0)
+        tick = time.time()
+        #lines of pwpower.log, with the last reported power of the circles
+        current = []
+        #circles due for a reading, most overdue first
+        due = []
         for mac, f in self.actfiles.items():
             try:
                 c = self.circles[self.bymac[mac]]                
@@ -816,36 +1138,195 @@ class PWControl(object):
                 continue  
             if not c.online:
                 continue
-            
-            #prepare for logging values
-            if epochf:
-                ts = calendar.timegm(datetime.utcnow().utctimetuple())
+            rate = self.monitor_rate(mac)
+            if self.snapshot or rate.due(tick, slack=5):
+                due.append((rate.overdue(tick), mac, f, c))
             else:
-                t = datetime.time(datetime.utcnow()-timedelta(seconds=time.timezone))
-                ts = 3600*t.hour+60*t.minute+t.second
+                band = self.monitor_deadband(mac)
+                current.append("%s, %.2f\n" % (mac, c.power[1] if band.last is None else band.last))
+        if self.snapshot:
+            #all monitored circles, responses arriving close together
+            snapshot = power_snapshot([c for _, _, _, c in due])
+            for _, mac, f, c in due:
+                reading = snapshot.readings.get(mac)
+                #a missed reading is not logged
+                if reading is not None:
+                    self.report_power(mac, f, c, reading['power8s'], tick, current)
+            if snapshot.readings:
+                msg = dict(snapshot.as_dict(), typ="pwsnapshot")
+                qpub.put(("plugwise2py/state/snapshot", json.dumps(msg), True))
+                debug("power snapshot of %d circles, spread %.3f s" % (len(snapshot.readings), snapshot.spread()))
+            read = len(due)
+        else:
+            due.sort(key=lambda d: d[0], reverse=True)
+            #put the power requests in flight within the budget, then collect the responses
+            pending = []
+            for i, (_, mac, f, c) in enumerate(due):
+                if time.time() - tick > MONITOR_BUDGET:
+                    #most overdue in the next cycle
+                    self.monitor_stats['skipped'] += len(due) - i
+                    break
+                if self.fast.monitors(mac):
+                    #read by the fast monitoring, see the cache in get_power_usage
+                    pending.append((mac, f, c, None))
+                    continue
+                try:
+                    pending.append((mac, f, c, c.request_power_usage()))
+                except (TimeoutException, SerialException) as reason:
+                    error("Error in ten_seconds(): %s" % (reason,))
+            for mac, f, c, req in pending:
+                try:
+                    _, usage, _, _ = c.get_power_usage(req, max_age=2)
+                    self.report_power(mac, f, c, usage, tick, current)
+                except ValueError:
+                    #print("%5d, " % (ts,))
+                    f.write("%5d, \n" % (self.log_ts(),))
+                    f.flush()
+                    current.append("%s, \n" % (mac,))
+                except (TimeoutException, SerialException) as reason:
+                    #for continuous monitoring just retry
+                    error("Error in ten_seconds(): %s" % (reason,))
+            read = len(pending)
+        if current != self.curlines:
+            self.curfile.seek(0)
+            self.curfile.truncate(0)
+            self.curfile.writelines(current)
+            self.curfile.flush()
+            self.curlines = current
+        if time.time() - tick > 10:
+            self.monitor_stats['overruns'] += 1
+            info("ten_seconds(): overrun, %.1f seconds for %d circles" % (time.time() - tick, read))
+        return
+
+    def log_ts(self):
+        """timestamp of the act files: epoch, or seconds of the (non-DST) local day"""
+        if epochf:
+            return calendar.timegm(datetime.utcnow().utctimetuple())
+        t = datetime.time(datetime.utcnow()-timedelta(seconds=time.timezone))
+        return 3600*t.hour+60*t.minute+t.second
+
+    def report_power(self, mac, f, c, usage, tick, current):
+        """log and publish the power read by ten_seconds, adding its line of pwpower.log to current"""
+        ts = self.log_ts()
+        self.monitor_rate(mac).update(usage, tick)
+        self.monitor_stats['samples'] += 1
+        if mac not in self.first_reading:
+            self.first_reading[mac] = time.time() - self.started
+            info("circle %s first reading after %.1f seconds" % (c.name, self.first_reading[mac]))
+        #report by exception. Within the deadband the last reported value is implied
+        band = self.monitor_deadband(mac)
+        if band.report(usage, tick):
+            #print("%10d, %8.2f" % (ts, usage,))
+            f.write("%5d, %8.2f\n" % (ts, usage,))
+            f.flush()
+            #debug("MQTT put value in qpub")
+            msg = str('{"typ":"pwpower","ts":%d,"mac":"%s","power":%.2f}' % (ts, mac, usage))
+            qpub.put((self.ftopic("power", mac), msg, True))
+        current.append("%s, %.2f\n" % (mac, band.last))
+
+    def monitor_rate(self, mac):
+        """the AdaptiveRate of a monitored circle, from monitor_min and monitor_max of its
+        control settings in seconds
+        """
+        rate = self.rates.get(mac)
+        if rate is None:
+            control = self.controls[self.controlsbymac[mac]]
             try:
-                _, usage, _, _ = c.get_power_usage()
-                #print("%10d, %8.2f" % (ts, usage,))
-                f.write("%5d, %8.2f\n" % (ts, usage,))
-                self.curfile.write("%s, %.2f\n" % (mac, usage))
-                #debug("MQTT put value in qpub")
-                msg = str('{"typ":"pwpower","ts":%d,"mac":"%s","power":%.2f}' % (ts, mac, usage))
-                qpub.put((self.ftopic("power", mac), msg, True))
+                minimum = max(10, int(control.get('monitor_min', 10)))
+                maximum = int(control.get('monitor_max', minimum))
             except ValueError:
-                #print("%5d, " % (ts,))
-                f.write("%5d, \n" % (ts,))
-                self.curfile.write("%s, \n" % (mac,))
-            except (TimeoutException, SerialException) as reason:
-                #for continuous monitoring just retry
-                error("Error in ten_seconds(): %s" % (reason,))
-            f.flush()
-            #prevent backlog in command queue
-            if mqtt: self.process_mqtt_commands()
-        self.curfile.flush()
-        return
+                error("invalid monitor_min or monitor_max of %s" % (mac,))
+                minimum = maximum = 10
+            rate = self.rates[mac] = AdaptiveRate(minimum, maximum)
+        return rate
+
+    def monitor_deadband(self, mac):
+        """the Deadband of a monitored circle, from deadband_abs in Watt, deadband_rel
+        as a fraction and heartbeat in seconds of its control settings
+        """
+        band = self.deadbands.get(mac)
+        if band is None:
+            control = self.controls[self.controlsbymac[mac]]
+            try:
+                band = Deadband(float(control.get('deadband_abs', 0)), float(control.get('deadband_rel', 0)),
+                    int(control.get('heartbeat', 0)))
+            except ValueError:
+                error("invalid deadband_abs, deadband_rel or heartbeat of %s" % (mac,))
+                band = Deadband()
+            self.deadbands[mac] = band
+        return band
+
+    def every_ten_seconds(self):
+        self.ten_seconds()
+        self.log_status()
+        if self.first_cycle:
+            self.first_cycle = False
+            self.start_complete_init()
+
+    def every_minute(self):
+        #read historic data of all circles once a minute
+        if self.logrecsn == 0:
+            self.logrecsn = len(self.circles)
+        #add configured unjoined nodes
+        self.connect_unknown_nodes()
+        if self.unverified:
+            with self.device.scheduler.using(MAINTENANCE):
+                self.verify_calibration()
+
+    def next_log_recording(self):
+        """log recording of the next circle of the round, one every ten seconds"""
+        if self.logrecsn > 0:
+            c = self.circles[self.logrecsn - 1]
+            idx=self.controlsbymac[c.mac]
+            self.log_recording(self.controls[idx], c.mac)
+            self.logrecsn = self.logrecsn - 1
+
+    def check_dst(self):
+        """update schedules after change in DST. Update one every ten seconds"""
+        for c in self.circles:
+            if c.online and c.schedule != None and c.schedule.dst != time.localtime().tm_isdst:
+                info("Circle '%s' schedule shift due to DST changed." % (c.name,))
+                idx=self.controlsbymac[c.mac]
+                self.apply_control_to_circle(self.controls[idx], c.mac, force=True)
+                break
+
+    def check_offline(self):
+        """recover offline circles and apply changes in the user defined configuration"""
+        with self.device.scheduler.using(MAINTENANCE):
+            self.test_offline()
+        self.poll_configuration()
+
+    def wait_events(self, timeout):
+        """wait for the next periodic task, recovering circles and joining nodes as soon as they show up"""
+        if self.process_events(timeout):
+            with self.device.scheduler.using(MAINTENANCE):
+                self.test_offline(ping=False)
+                self.connect_unknown_nodes()
+
+    def hourly(self):
+        self.rsync_to_persistent()
+        #Allow resetted or unknown nodes to join the network every hour
+        #NOTE: Not fully tested.
+        try:
+            self.device.enable_joining(True)
+        except:
+            error("PWControl.run(): Communication error in enable_joining")
+        self.dump_status()
+        self.log_scheduler_stats()
+        flush_capture()
+        #circles offline at startup have been calibrated since
+        self.save_calibrations()
+        self.save_state()
+        with self.device.scheduler.using(HISTORY):
+            self.start_backfill()
 
-    # def hourly(self):
-        # return
+    def daily(self):
+        self.setup_actfiles()
+        self.cleanup_tmp()
+
+    def daily_sync_time(self):
+        self.sync_time()
+        info("Daily 4 AM: time synced circles.")
         
     def log_recording(self, control, mac):
         """
@@ -864,12 +1345,19 @@ class PWControl(object):
                 return
             if not c.online:
                 return
+            if self.backfill is not None and mac in self.backfill.pending:
+                #read from the mirror when the backfill is done
+                return
+            if mac in self.initializing:
+                #the log interval is not known yet, or the backfill is being planned
+                return
             
             #figure out what already has been logged.
             try:
-                c_info = c.get_info()
+                c_info = c.get_info(max_age=10)
                 #update c.power fields for administrative purposes
-                c.get_power_usage()
+                #read by ten_seconds just before
+                c.get_power_usage(max_age=10)
             except ValueError:
                 return
             except (TimeoutException, SerialException) as reason:
@@ -900,8 +1388,11 @@ class PWControl(object):
                     #TODO: correct if needed
                     last = 6015
             #read maximum 100 positions at a time for responsiveness and robustness for communication errors
-            if last > first + 99:
-                last = first + 99
+            #and any mirrored positions beyond those
+            end = last
+            last = min(end, first + 99)
+            while last < end and c.is_mirrored(last + 1):
+                last += 1
             log = []
             try:
                 #read one more than request to determine interval of first measurement
@@ -1082,9 +1573,10 @@ class PWControl(object):
                 info("circle buffers: %s %s read from %d to %d" % (mac, c.name, first, last))
                 
             #store lastlog addresses to file
-            with open(self.lastlogfname, 'w') as f:
+            with open(self.lastlogfname+'.tmp', 'w') as f:
                 for c in self.circles:
                     f.write("%s, %d, %d, %d, %.4f\n" % (c.mac, c.last_log, c.last_log_idx, c.last_log_ts, c.cum_energy))
+            os.replace(self.lastlogfname+'.tmp', self.lastlogfname)
                             
         return fileopen #if fileopen actual writing to log files took place
         
@@ -1093,7 +1585,36 @@ class PWControl(object):
         # for mac, idx in self.controlsbymac.iteritems():
             # self.log_recording(self.controls[idx], mac)
 
-    def test_offline(self):
+    def process_events(self, timeout=0):
+        """
+        Consume the unsolicited events published by the stick, waiting up to timeout
+        seconds for the first one. Returns True when an offline circle answered a
+        ping, or an unknown node advertised itself.
+        """
+        pending = False
+        while True:
+            try:
+                if timeout > 0:
+                    resp = self.events.get(timeout=timeout)
+                    timeout = 0
+                else:
+                    resp = self.events.get_nowait()
+            except queue.Empty:
+                return pending
+            mac = resp.mac.decode('utf-8')
+            if resp.function_code == b'000E':
+                try:
+                    c = self.circles[self.bymac[mac]]
+                except KeyError:
+                    continue
+                if not c.online:
+                    c.pong = True
+                    pending = True
+            elif resp.function_code == b'0006':
+                self.unjoined.add(mac)
+                pending = True
+
+    def test_offline(self, ping=True):
         """
         When an unrecoverable communication failure with a circle occurs, the circle
         is set online = False. This function will test on this condition and if offline,
@@ -1101,9 +1622,10 @@ class PWControl(object):
         control settings and switching schedule if needed.
         In case the circle was offline during initialization, a reinit is performed.
         """
+        self.process_events()
         #send a ping to all offline circles
         for c in self.circles:
-            if not c.online:
+            if ping and not c.online:
                 try:
                     c.ping()
                 except ValueError:
@@ -1121,7 +1643,6 @@ class PWControl(object):
                     #back online. Make sure the most recent settings are applied
                     if not c.initialized:
                         c.reinit()
-                        self.set_interval_production(c)
                     idx=self.controlsbymac[c.mac]
                     self.apply_control_to_circle(self.controls[idx], c.mac)
                 except ValueError:
@@ -1151,7 +1672,6 @@ class PWControl(object):
                         #back online. Make sure the most recent settings are applied
                         if not c.initialized:
                             c.reinit()
-                            self.set_interval_production(c)
                         idx=self.controlsbymac[c.mac]
                         self.apply_control_to_circle(self.controls[idx], c.mac)
                 except ValueError:
@@ -1267,7 +1787,8 @@ class PWControl(object):
 
         
     def connect_unknown_nodes(self):
-        for newnodemac in self.device.unjoined:
+        self.process_events()
+        for newnodemac in self.unjoined:
             newnode = None
             try:
                 newnode = self.circles[self.bymac[newnodemac]]
@@ -1278,6 +1799,7 @@ class PWControl(object):
             #accept or reject join based on occurence in pw-conf.json
             self.device.join_node(newnodemac, newnode != None)
         #clear the list
+        self.unjoined.clear()
         self.device.unjoined.clear()
         #a later call to self.test_offline will initialize the new circle(s)
         #self.test_offline()
@@ -1285,14 +1807,15 @@ class PWControl(object):
     def run(self):
         global mqtt
         
-        locnow = datetime.utcnow()-timedelta(seconds=time.timezone)
-        now = locnow
-        day = now.day
-        hour = now.hour
-        minute = now.minute
-        dst = time.localtime().tm_isdst
+        scheduler = self.device.scheduler
 
-        self.sync_time()
+        if mqtt:
+            cmd_t = threading.Thread(target=self.process_mqtt_commands)
+            cmd_t.setDaemon(True)
+            cmd_t.start()
+
+        with scheduler.using(MAINTENANCE):
+            self.sync_time()
         self.dump_status()
         #self.log_recordings()
         
@@ -1319,19 +1842,6 @@ class PWControl(object):
         # except:
             # pass
             
-        circleplus = None
-        for c in self.circles:
-            try:
-                if c.get_info()['type'] == 'circle+':
-                    circleplus = c
-            except:
-                pass
-        if circleplus != None:
-            try:
-                debug("joined node table: %s" % (circleplus.read_node_table(),))
-            except:
-                error("PWControl.run(): Communication error in read_node_table")
-      
         #Inform network that nodes are allowed to join the network
         #Nodes may start advertising themselves with a 0006 message.
         try:
@@ -1339,114 +1849,51 @@ class PWControl(object):
         except:
             error("PWControl.run(): Communication error in enable_joining")
 
-        # logrecs = True
-        logrecsn = len(self.circles)
-        while 1:
-            #check whether user defined configuration has been changed
-            #when schedules are changed, this call can take over ten seconds!
-            self.test_offline()
-            self.poll_configuration()
-            ##align with the next ten seconds.
-            #time.sleep(10-datetime.now().second%10)
-            #align to next 10 second boundary, while checking for input commands.
-            ref = datetime.now()
-            proceed_at = ref + timedelta(seconds=(10 - ref.second%10), microseconds= -ref.microsecond)
-            while datetime.now() < proceed_at:
-                if mqtt: self.process_mqtt_commands()
-                time.sleep(0.5)
-            #prepare for logging values
-            prev_dst = dst
-            prev_day = day
-            prev_hour = hour
-            prev_minute = minute
-            
-            #now = datetime.now()            
-            #local time not following DST (always non-DST)
-            locnow = datetime.utcnow()-timedelta(seconds=time.timezone)
-            now = locnow
-            
-            dst = time.localtime().tm_isdst
-            day = now.day
-            hour = now.hour
-            minute = now.minute
-            
-            #read historic data only one circle per minute
-            if minute != prev_minute:
-                # logrecs = True
-                if logrecsn == 0:
-                    logrecsn = len(self.circles)
-            
-            #get relays state just after each new quarter hour for circles operating a schedule.
-            if minute % 15 == 0 and now.second > 8:
-                self.get_relays()
-                
-            #add configured unjoined nodes every minute.
-            #although call is issued every hour
-            if minute != prev_minute:
-                self.connect_unknown_nodes()
+        #circles left in the current round of log recordings
+        self.logrecsn = len(self.circles)
+        self.first_cycle = True
 
-            if day != prev_day:
-                self.setup_actfiles()
-            self.ten_seconds()
-            self.log_status()
-            if hour != prev_hour:
-                #self.hourly()
-                #logrecs = True
-                #self.log_recordings()
-                self.rsync_to_persistent()
-                if hour == 4:
-                    self.sync_time()
-                    info("Daily 4 AM: time synced circles.")
-                #Allow resetted or unknown nodes to join the network every hour
-                #NOTE: Not fully tested.
-                try:
-                    self.device.enable_joining(True)
-                except:
-                    error("PWControl.run(): Communication error in enable_joining")
-                self.dump_status()
-            if day != prev_day:
-                #self.daily()
-                self.cleanup_tmp()
-                
-            # #log_recordings. Process one every ten seconds
-            # if logrecs:
-                # breaked = False
-                # for c in self.circles:
-                    # idx=self.controlsbymac[c.mac]
-                    # if self.log_recording(self.controls[idx], c.mac):
-                        # #actual recordings written to logfile
-                        # #allow next circle to be logged in next ten seconds.
-                        # breaked = True
-                        # break
-                # if not breaked:
-                    # #all circles have been processed
-                    # logrecs = False
-            
-            #log_recordings. Process one every ten seconds
-            if logrecsn > 0:
-                c = self.circles[logrecsn - 1]
-                idx=self.controlsbymac[c.mac]
-                self.log_recording(self.controls[idx], c.mac)
-                logrecsn = logrecsn - 1
-            
-            #update schedules after change in DST. Update one every ten seconds
-            for c in self.circles:
-                if c.online and c.schedule != None and c.schedule.dst != time.localtime().tm_isdst:
-                    info("Circle '%s' schedule shift due to DST changed." % (c.name,))
-                    idx=self.controlsbymac[c.mac]
-                    self.apply_control_to_circle(self.controls[idx], c.mac, force=True)
-                    break
+        def using(priority, fn):
+            def call():
+                with scheduler.using(priority):
+                    fn()
+            return call
 
+        #periodic tasks, aligned on local time not following DST (always non-DST).
+        #Tasks due at the same time run in this order.
+        tasks = self.tasks = TaskScheduler()
+        tasks.add("daily", self.daily, 86400, phase=time.timezone % 86400)
+        tasks.add("minute", self.every_minute, 60)
+        #relay state of circles operating a schedule, just after each new quarter hour
+        tasks.add("relays", using(RELAY, self.get_relays), 900, phase=10)
+        tasks.add("ten seconds", self.every_ten_seconds, 10)
+        tasks.add("log recording", using(HISTORY, self.next_log_recording), 10)
+        tasks.add("dst", self.check_dst, 10)
+        tasks.add("hourly", self.hourly, 3600)
+        tasks.add("sync time", using(MAINTENANCE, self.daily_sync_time), 86400, phase=(4*3600 + time.timezone) % 86400)
+        #when schedules are changed, this call can take over ten seconds!
+        tasks.add("offline", self.check_offline, 10, phase=5)
+        self.fast.start()
+        try:
+            tasks.run(self.wait_events)
+        finally:
+            self.fast.close()
+            #the workers of a running backfill would delay the exit
+            if self.backfill is not None:
+                self.backfill.stop()
                 
-            #test    
-            # self.log_recordings()
-            # self.rsync_to_persistent()
-            # self.setup_actfiles()
-            # self.cleanup_tmp()
+        #test    
+        # self.log_recordings()
+        # self.rsync_to_persistent()
+        # self.setup_actfiles()
+        # self.cleanup_tmp()
 
 init_logger(logpath+"pw-logger.log", "pw-logger")
 log_level(logging.DEBUG)
 
+#shutdown cleanly on a stop of the service
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+main = None
 try:
     qpub = queue.Queue()
     qsub = queue.Queue()
@@ -1471,5 +1918,8 @@ try:
     main=PWControl()
     main.run()
 except:
+    if main is not None:
+        main.save_state()
+    close_capture()
     close_logcomm()
     raise
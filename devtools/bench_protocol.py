@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#Micro benchmarks of the receive path of the protocol implementation.
+#Run from the Plugwise-2-py folder:
+#   python3 devtools/bench_protocol.py [-n 20000]
+
+import os
+import sys
+import time
+import optparse
+import binascii
+import struct
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from swutil.util import *
+from plugwise.protocol import *
+
+#log outside the source tree, the benchmarks provoke protocol errors
+init_logger(os.path.join(tempfile.gettempdir(), "bench_protocol.log"))
+log_level(logging.ERROR)
+log_comm(False)
+
+MAC = b'000D6F0001234567'
+
+#payloads as received from circles
+PAYLOADS = [
+    (PlugwisePowerUsageResponse, b'000C00640000A3F1FFFFFFFD0000'),
+    (PlugwiseInfoResponse, b'1403011B00044BE001850000007300074E0801D902'),
+    (PlugwisePowerBufferResponse, b'1403000000000A1D140300C0000009F51403018000000B10140302400000087200044BE0'),
+]
+
+def make_frame(response_class, payload, seqnr=b'1A2B', mac=MAC, prefix=True):
+    """build a frame with a valid checksum, as the stick would send it"""
+    msg = response_class.ID + seqnr + mac + payload
+    frame = PlugwiseMessage.PACKET_HEADER + msg + b"%04X" % crc_fun(msg) + PlugwiseMessage.PACKET_FOOTER
+    return (b'\x83' if prefix else b'') + frame
+
+def tree_decode(response_class, payload):
+    """decode walking a fresh tree of BaseType params, as done before compiled layouts"""
+    resp = response_class()
+    for p in resp.params:
+        myval = payload[:len(p)]
+        p.unserialize(myval)
+        payload = payload[len(myval):]
+    return resp
+
+def compiled_decode(response_class, payload):
+    resp = response_class.record()
+    resp._parse_params(payload)
+    return resp
+
+def rate(fn, args, n, repeat=3):
+    """best of repeat runs, in calls per second"""
+    best = None
+    for r in range(repeat):
+        t = time.perf_counter()
+        for i in range(n):
+            fn(*args)
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return n / best
+
+def bench_decode(n):
+    print("field decode [decodes/s]")
+    print("%-6s %12s %12s %8s" % ("code", "tree", "compiled", "speedup"))
+    for response_class, payload in PAYLOADS:
+        assert tree_decode(response_class, payload).__dict__.keys() >= set(k for k, _, _, _ in response_class._layout)
+        before = rate(tree_decode, (response_class, payload), n)
+        after = rate(compiled_decode, (response_class, payload), n)
+        print("%-6s %12.0f %12.0f %7.2fx" % (response_class.ID.decode(), before, after, after/before))
+
+    print("full frame unserialize [frames/s]")
+    for response_class, payload in PAYLOADS:
+        frame = make_frame(response_class, payload)
+        def unserialize():
+            response_class.record().unserialize(frame)
+        print("%-6s %12.0f" % (response_class.ID.decode(), rate(unserialize, (), n)))
+
+def ack_frame(seqnr, status=b'00C1'):
+    msg = b'0000' + seqnr + status
+    return PlugwiseMessage.PACKET_HEADER + msg + b"%04X" % crc_fun(msg) + PlugwiseMessage.PACKET_FOOTER
+
+def synthetic_corpus():
+    """frames in the mix of a polling daemon: stick acks followed by circle responses"""
+    frames = []
+    for i in range(64):
+        seqnr = b"%04X" % i
+        response_class, payload = PAYLOADS[i % 3 if i % 8 else 2]
+        frames.append(ack_frame(seqnr))
+        frames.append(make_frame(response_class, payload, seqnr))
+    return frames
+
+def read_corpus(fname):
+    """one hex encoded frame per line"""
+    with open(fname) as f:
+        return [binascii.unhexlify(line.strip()) for line in f if line.strip()]
+
+def legacy_unserialize(frame):
+    """the slicing receive path, as it was before parsing with offsets into one buffer"""
+    if frame.find(PlugwiseMessage.PACKET_HEADER5) == 0:
+        frame = frame[1:]
+    header, function_code, seqnr = struct.unpack("4s4s4s", frame[:12])
+    crc, footer = struct.unpack("4s2s", frame[-6:])
+    if crc != b"%04X" % crc_fun(frame[4:-6]):
+        raise ProtocolError("checksum error!")
+    response_class = RESPONSE_TYPES[(function_code, len(frame))]
+    if function_code == b'0000':
+        payload = frame[12:-6]
+    else:
+        mac = frame[12:28]
+        payload = frame[28:-6]
+    return tree_decode(response_class, payload)
+
+def bench_corpus(n, frames):
+    #one receive buffer with frame offsets, as delivered by the serial port
+    buf = b''.join(frames)
+    spans = []
+    pos = 0
+    for frame in frames:
+        spans.append((pos, pos+len(frame)))
+        pos += len(frame)
+    loops = max(1, n // len(frames))
+
+    def copied():
+        for s, e in spans:
+            legacy_unserialize(buf[s:e])
+    def in_place():
+        for s, e in spans:
+            decode_response(buf, None, s, e)
+
+    print("corpus of %d frames, %d bytes [frames/s]" % (len(frames), len(buf)))
+    before = rate(copied, (), loops) * len(frames)
+    after = rate(in_place, (), loops) * len(frames)
+    print("%-12s %12.0f" % ("slicing", before))
+    print("%-12s %12.0f %7.2fx" % ("in place", after, after/before))
+
+def bench_requests(n):
+    print("request serialize [frames/s]")
+    print("%-6s %12s %12s %8s" % ("code", "serialize", "cached", "speedup"))
+    for request_class, args in [(PlugwisePowerUsageRequest, ()), (PlugwiseInfoRequest, ()), (PlugwiseSwitchRequest, (True,))]:
+        before = rate(lambda: request_class(MAC, *args).serialize(), (), n)
+        after = rate(cached_frame, (request_class, MAC) + args, n)
+        print("%-6s %12.0f %12.0f %7.2fx" % (request_class.ID.decode(), before, after, after/before))
+    addrs = [i % 6016 for i in range(n)]
+    def buffer_requests():
+        for addr in addrs:
+            PlugwisePowerBufferRequest(MAC, addr).serialize()
+    print("%-6s %12.0f" % (PlugwisePowerBufferRequest.ID.decode(), rate(buffer_requests, (), 1) * n))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--number", type="int", default=20000, help="iterations per measurement")
+    parser.add_option("-c", "--corpus", dest="corpus", help="file with hex encoded frames, one per line")
+    options, args = parser.parse_args()
+    bench_decode(options.number)
+    bench_requests(options.number)
+    if options.corpus:
+        bench_corpus(options.number, read_corpus(options.corpus))
+    else:
+        bench_corpus(options.number, synthetic_corpus())
@@ -60,7 +60,8 @@ parser.add_option("-s", "--switch", dest="switch",
 parser.add_option("-l", "--log", dest="log", 
     help="""Read power usage history from the log buffers of the Circle. 
     Argument should be 'cur' or 'current' if you want to read the log buffer that is currently being written.
-    It can also be a numeric log buffer index if you want to read an arbitrary log buffer. 
+    It can also be a numeric log buffer index if you want to read an arbitrary log buffer,
+    a range first:last of log buffer indexes, or 'all' to read the complete history.
 """)
 parser.add_option("-i", "--info", action="store_true", dest="info", 
     help="Perform the info request")
@@ -101,16 +102,22 @@ def handle_query(c, query):
 
 def handle_log(c, log_opt):
     if log_opt in ('cur', 'current'):
-        log_idx = None
+        history = c.get_power_usage_history(None)
+    elif log_opt == 'all':
+        #oldest buffer first
+        history = c.iter_power_history((c.get_info()['last_logaddr'] + 1) % LOG_BUFFERS)
     else:
         try:
-            log_idx = int(log_opt)
+            first, _, last = log_opt.partition(':')
+            first = int(first)
+            last = int(last) if last else first
         except ValueError:
-            print("log option argument should be either number or string current")
+            print("log option argument should be either number, range, string current or all")
             return False
+        history = c.iter_power_history(first, last + 1)
 
     print("power usage log:")
-    for dt, watt, watt_hours in c.get_power_usage_history(log_idx):
+    for dt, watt, watt_hours in history:
 
         if dt is None:
             ts_str, watt, watt_hours = "N/A", "N/A", "N/A"
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#Load test of the 10 seconds polling cycle of Plugwise-2.py against simulated circles.
+#Switch commands are issued concurrently, as from MQTT, to measure their latency.
+#Run from the Plugwise-2-py folder:
+#   python3 devtools/pw-loadtest.py -n 64 -t 120 --loss 0.01 --ghost 0.01 --chatter 0.05
+
+import os
+import sys
+import time
+import random
+import logging
+import optparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from swutil.util import *
+from swutil.scheduler import *
+from plugwise.api import *
+from pwsim import add_options, simulator
+
+ATTR = {'name': 'sim', 'location': 'sim', 'always_on': 'False', 'reverse_pol': 'False',
+    'production': 'False', 'loginterval': '60'}
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values)-1, int(p*len(values)))]
+
+def summary(name, values, unit="s"):
+    if not values:
+        return "%-18s -" % (name,)
+    return "%-18s n=%-5d avg %.3f%s  p95 %.3f%s  max %.3f%s" % (name, len(values),
+        sum(values)/len(values), unit, percentile(values, 0.95), unit, max(values), unit)
+
+class LoadTest(object):
+    def __init__(self, stick, circles):
+        self.stick = stick
+        self.circles = circles
+        self.cycles = []
+        self.samples = 0
+        self.missed = 0
+        self.latencies = []
+        self.command_errors = 0
+        self._running = False
+
+    def ten_seconds(self):
+        """the power polling of PWControl.ten_seconds: requests to all online circles
+        in flight, then collect. Returns the number of missed samples.
+        """
+        pending = []
+        missed = 0
+        for c in self.circles:
+            if not c.online:
+                missed += 1
+                continue
+            try:
+                pending.append((c, c.request_power_usage()))
+            except (TimeoutException, SerialException):
+                missed += 1
+        for c, req in pending:
+            try:
+                c.get_power_usage(req)
+            except (ValueError, TimeoutException, SerialException):
+                missed += 1
+        return missed
+
+    def test_offline(self):
+        """ping offline circles, reinit the ones that answered an earlier ping"""
+        for c in self.circles:
+            if c.pong:
+                c.set_online()
+                if not c.initialized:
+                    c.reinit()
+            elif not c.online:
+                c.ping()
+
+    def commands(self, rate):
+        """switch random circles, rate commands per second"""
+        with self.stick.scheduler.using(INTERACTIVE):
+            while self._running:
+                time.sleep(random.expovariate(rate))
+                c = random.choice(self.circles)
+                t = time.time()
+                try:
+                    c.switch(c.relay_state != 'on')
+                    self.latencies.append(time.time() - t)
+                except (ValueError, TimeoutException, SerialException):
+                    self.command_errors += 1
+
+    def run(self, duration, interval, rate):
+        self._running = True
+        if rate > 0:
+            t = threading.Thread(target=self.commands, args=(rate,), name="commands")
+            t.daemon = True
+            t.start()
+        end = time.time() + duration
+        while time.time() < end:
+            start = time.time()
+            self.missed += self.ten_seconds()
+            self.samples += len(self.circles)
+            self.cycles.append(time.time() - start)
+            with self.stick.scheduler.using(MAINTENANCE):
+                self.test_offline()
+            print("cycle %3d %6.3fs missed %d" % (len(self.cycles), self.cycles[-1], self.missed))
+            time.sleep(max(0, interval - (time.time() - start)))
+        self._running = False
+
+    def report(self, sim):
+        print(summary("cycle duration", self.cycles))
+        print("%-18s %d of %d (%.2f%%)" % ("missed samples", self.missed, self.samples,
+            100.0*self.missed/self.samples if self.samples else 0))
+        print(summary("command latency", self.latencies))
+        print("%-18s %d" % ("command errors", self.command_errors))
+        print("%-18s %d" % ("request window", self.stick.window.limit()))
+        for name, s in sorted(self.stick.scheduler.stats().items()):
+            if s["admitted"]:
+                print("%-18s admitted %d  wait avg %.3fs max %.3fs" % (name, s["admitted"], s["wait_avg"], s["wait_max"]))
+        print("simulator          " + " ".join("%s=%d" % kv for kv in sorted(sim.counters.items())))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    add_options(parser)
+    parser.add_option("-t", "--time", type="float", default=60, help="duration of the test [s]")
+    parser.add_option("-i", "--interval", type="float", default=10, help="polling cycle [s]")
+    parser.add_option("-r", "--rate", type="float", default=0.5, help="switch commands per second")
+    parser.add_option("-l", "--log", default="pw-loadtest.log", help="log file")
+    options, args = parser.parse_args()
+
+    init_logger(options.log)
+    log_level(logging.INFO)
+    log_comm(False)
+
+    sim = simulator(options)
+    stick = Stick(sim.port)
+    stick.start_reader()
+    t = time.time()
+    circles = [Circle(mac.decode(), stick, ATTR, initialize=False) for mac in sim.order]
+    for c in circles:
+        c.reinit()
+    print("%d circles initialized in %.2fs, %d online" % (len(circles), time.time()-t, sum(1 for c in circles if c.online)))
+
+    test = LoadTest(stick, circles)
+    try:
+        test.run(options.time, options.interval, options.rate)
+    except KeyboardInterrupt:
+        pass
+    test.report(sim)
+    stick.stop_reader()
+    stick.close()
+    sim.stop()
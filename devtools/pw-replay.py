@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#Replay of a capture of serial traffic through the frame reassembler and the decoders.
+#Captures are written when "log_capture" is "yes" in pw-control.json.
+#Run from the Plugwise-2-py folder:
+#   python3 devtools/pw-replay.py pw-capture.bin [-n 10] [--realtime [--speed 10]]
+#Convert a communication log to a capture:
+#   python3 devtools/pw-replay.py --import pw-communication.log -o pw-capture.bin
+
+import os
+import re
+import sys
+import time
+import codecs
+import logging
+import optparse
+import datetime
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from swutil.util import *
+from plugwise.protocol import *
+
+HEADER = PlugwiseMessage.PACKET_HEADER
+FOOTER = PlugwiseMessage.PACKET_FOOTER
+
+def unlogf(s):
+    """bytes of a string formatted by logf: undo the repr, then the backslashreplace
+    of the bytes that are not utf-8
+    """
+    text = codecs.escape_decode(s.encode('utf-8'))[0]
+    return re.sub(rb'\\x([0-9a-f]{2})', lambda m: bytes([int(m.group(1), 16)]), text)
+
+def import_line(line):
+    """(timestamp, direction, data) of a pw-communication.log line, None when the line
+    carries no traffic
+    """
+    try:
+        stamp, msg = line.rstrip('\r\n').split(' - pwcomm - ', 1)
+        ts = time.mktime(datetime.datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S,%f').timetuple()) + int(stamp[-3:])/1000.0
+    except ValueError:
+        return None
+    kind = msg[:4]
+    if kind == 'SEND':
+        #SEND len ---> ID [args] mac [args] crc <---
+        tokens = msg.split()
+        fields = tokens[tokens.index('--->')+1:-1]
+        return ts, CAPTURE_TX, HEADER + ''.join(fields).encode() + FOOTER
+    elif kind == 'RECV':
+        #RECV len header ID seqnr status mac [payload] crc footer
+        tokens = msg.split()
+        header, fc, seqnr, status, mac = tokens[2:7]
+        payload = tokens[7] if len(tokens) == 10 else ''
+        crc = tokens[-2]
+        msg = fc + seqnr + status.strip('.') + mac.strip('.') + payload
+        prefix = b'\x83' if header == '-->>' else b''
+        return ts, CAPTURE_RX, prefix + HEADER + msg.encode() + crc.encode() + FOOTER
+    elif kind in ('DTRC', 'DSTR', 'RERR'):
+        if 'out of sequence' in msg:
+            #logged after the RECV line of the same frame
+            return None
+        data = msg[10:]
+        if kind == 'RERR':
+            data = data[:data.rfind(' - <!> ')]
+        return ts, CAPTURE_RX, unlogf(data)
+    return None
+
+def import_log(logfname, capfname):
+    writer = CaptureWriter(capfname)
+    count = 0
+    with open(logfname, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            rec = import_line(line)
+            if rec is not None:
+                ts, direction, data = rec
+                writer.write(direction, data, ts)
+                count += 1
+    writer.close()
+    print("imported %d records from %s into %s" % (count, logfname, capfname))
+
+class Replay(object):
+    def __init__(self, records):
+        self.records = records
+        self.stats = collections.Counter()
+        self.codes = collections.Counter()
+
+    def run(self, realtime=False, speed=1.0):
+        """feed the received bytes through the reassembler and decode the frames"""
+        frames = FrameReassembler()
+        stats = self.stats
+        t0 = time.time()
+        first = None
+        for ts, direction, data in self.records:
+            if direction == CAPTURE_TX:
+                stats['sent'] += 1
+                continue
+            if realtime:
+                if first is None:
+                    first = ts
+                delay = (ts - first)/speed - (time.time() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+            stats['bytes'] += len(data)
+            frames.feed(data, ts)
+            while frames.pending():
+                frame, _ = frames.pop()
+                stats['frames'] += 1
+                try:
+                    resp = decode_response(frame)
+                except (ProtocolError, UnexpectedResponse):
+                    stats['protocol errors'] += 1
+                    continue
+                if resp is None:
+                    stats['unknown'] += 1
+                else:
+                    self.codes[resp.function_code.decode()] += 1
+        stats['bad frames'] += frames.bad_frames
+        return time.time() - t0
+
+def report(stats, codes, elapsed, loops):
+    print("%-16s %d" % ("sent", stats['sent']//loops))
+    print("%-16s %d" % ("received bytes", stats['bytes']//loops))
+    print("%-16s %d" % ("frames", stats['frames']//loops))
+    for k in sorted(codes):
+        print("  %-14s %d" % (k, codes[k]//loops))
+    for k in ('unknown', 'protocol errors', 'bad frames'):
+        print("%-16s %d" % (k, stats[k]//loops))
+    if elapsed > 0:
+        print("%-16s %.3fs, %.0f frames/s, %.2f MB/s" % ("replay", elapsed, stats['frames']/elapsed, stats['bytes']/elapsed/1e6))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] capture")
+    parser.add_option("-n", "--number", type="int", default=1, help="replay the capture n times")
+    parser.add_option("-r", "--realtime", action="store_true", default=False, help="replay with the recorded timing")
+    parser.add_option("-s", "--speed", type="float", default=1.0, help="speed factor of a realtime replay")
+    parser.add_option("-i", "--import", dest="logfile", help="convert a pw-communication.log to a capture")
+    parser.add_option("-o", "--output", default="pw-capture.bin", help="capture file written by --import")
+    parser.add_option("-l", "--log", default="pw-replay.log", help="log file")
+    options, args = parser.parse_args()
+
+    init_logger(options.log)
+    log_level(logging.ERROR)
+    log_comm(False)
+
+    if options.logfile:
+        import_log(options.logfile, options.output)
+        sys.exit(0)
+    if len(args) != 1:
+        parser.error("no capture file")
+    records = list(read_capture(args[0]))
+    replay = Replay(records)
+    elapsed = 0.0
+    for i in range(options.number):
+        elapsed += replay.run(options.realtime, options.speed)
+    report(replay.stats, replay.codes, elapsed, options.number)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#Simulator of a Plugwise Stick and a network of Circles on a pseudo terminal.
+#The simulator speaks the protocol of plugwise/protocol.py: the stick acknowledges
+#requests with a seqnr, and the circles answer after a configurable latency, or not
+#at all. Run from the Plugwise-2-py folder:
+#   python3 devtools/pwsim.py [-n 16]
+#and point serial in pw-hostconfig.json to the printed port. Linux only.
+
+import os
+import sys
+import tty
+import time
+import heapq
+import random
+import struct
+import select
+import binascii
+import itertools
+import threading
+import optparse
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from plugwise.protocol import crc_fun, LogAddr, PLUGWISE_EPOCH
+from plugwise.mirror import LOG_BUFFERS
+
+HEADER = b'\x05\x05\x03\x03'
+FOOTER = b'\r\n'
+PULSES_PER_KW_SECOND = 468.9385193
+
+STICK_MAC = b'000D6F0000C0FFEE'
+NETWORK_ID = b'AB0D6F0000ABCDEF'
+MAC_FORMAT = '000D6F%010X'
+
+#stick statuses
+ACCEPTED = 0xC1
+NO_ACK = 0xE1
+
+#statuses of circles to commands acknowledged with their mac
+ACK_CLOCKSET = 0xD7
+ACK_ON = 0xD8
+ACK_OFF = 0xDE
+ACK_JOINING = 0xD9
+ACK_DATETIME = 0xDF
+ACK_SCHEDULE_ON = 0xE4
+ACK_SCHEDULE_OFF = 0xE5
+ACK_RESET = 0xF2
+ACK_LOGINTERVAL = 0xF8
+ACK_SCHEDULE_VALUE = 0xFA
+
+#requests without a mac
+NO_MAC = (b'000A', b'003B', b'0001', b'0008')
+
+CHATTER = [b'# APSRequestNodeInfo', b'# NWK_status 0x00', b'#Route discovery', b'# ZDO node desc req']
+
+def frame(msg):
+    """complete frame with checksum around msg, as sent by the stick"""
+    return b'\x83' + HEADER + msg + b"%04X" % crc_fun(msg) + FOOTER
+
+def dt_hex(dt):
+    """DateTime field: year since 2000, month, minutes since the start of the month"""
+    if dt is None:
+        return b'FFFFFFFF'
+    minutes = ((dt.day-1)*24 + dt.hour)*60 + dt.minute
+    return b"%02X%02X%04X" % (dt.year-PLUGWISE_EPOCH, dt.month, minutes)
+
+def float_hex(f):
+    return b"%08X" % struct.unpack('>I', struct.pack('>f', f))[0]
+
+def sint_hex(val, length):
+    return b"%0*X" % (length, val & ((1 << (4*length)) - 1))
+
+class SimClock(object):
+    """simulated UTC time, running speed times faster than the wall clock"""
+
+    def __init__(self, speed=1.0, start=None):
+        self.speed = speed
+        self.start = start or datetime.datetime.utcnow()
+        self.t0 = time.time()
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=(time.time()-self.t0)*self.speed)
+
+class SimCircle(object):
+    """model of a circle: a power draw that wanders, a relay, the log buffers
+    and the radio characteristics of its path through the mesh
+    """
+
+    def __init__(self, mac, clock, plus=False, watt=None, latency=0.05, jitter=0.02,
+                 loss=0.0, offline=0.0, ghost=0.0, interval=60, history=2000):
+        self.mac = mac
+        self.clock = clock
+        self.plus = plus
+        self.watt = random.uniform(5, 150) if watt is None else watt
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.offline = offline
+        self.ghost = ghost
+        self.reachable = True
+        self.relay = 1
+        self.schedule_enabled = 0
+        #the schedule memory as written by the stick: 672 values of 2 bytes, all on
+        self.schedule = bytearray(b'\xFF' * 1344)
+        self.gain_a = random.uniform(0.99, 1.01)
+        self.gain_b = random.uniform(-4e-7, -1e-7)
+        self.off_tot = random.uniform(-0.05, 0.05)
+        self.off_noise = 0.0
+        self.interval = interval
+        #the log entries cover history intervals before the simulator started.
+        #Entries from log_first on are interval minutes apart from log_origin, the
+        #earlier ones follow the log intervals set before, in log_segments.
+        now = clock.now().replace(second=0, microsecond=0)
+        self.log_first = 0
+        self.log_origin = now - datetime.timedelta(minutes=interval*history)
+        self.log_segments = []
+
+    def delay(self):
+        return max(0.001, random.gauss(self.latency, self.jitter))
+
+    def power(self):
+        """current power in Watt, a random walk while the relay is on"""
+        self.watt = max(0.0, self.watt + random.gauss(0, 1))
+        return self.watt if self.relay else 0.0
+
+    def raw_pulses(self, watt, seconds):
+        """pulse count of watt over seconds, uncorrected for calibration"""
+        return int(watt * PULSES_PER_KW_SECOND / 1000.0 * seconds / self.gain_a)
+
+    def log_entries(self):
+        """number of completed log intervals"""
+        elapsed = self.clock.now() - self.log_origin
+        return self.log_first + int(elapsed.total_seconds() // (60*self.interval))
+
+    def set_interval(self, interval):
+        """change the log interval. The written entries keep their timestamps, the
+        next entry completes interval minutes from now.
+        """
+        n = self.log_entries()
+        self.log_segments.append((self.log_first, self.log_origin, self.interval))
+        self.log_first = n
+        self.log_origin = self.clock.now().replace(second=0, microsecond=0)
+        self.interval = interval
+
+    def log_addr(self):
+        """the address of the buffer with the last completed entry, wrapping around"""
+        return (max(0, self.log_entries()-1) // 4) % LOG_BUFFERS
+
+    def log_buffer_entries(self, addr):
+        """the indexes of the log entries in buffer addr, of the last round written"""
+        last = max(0, self.log_entries()-1) // 4
+        buf = last - (last - addr) % LOG_BUFFERS
+        if buf < 0:
+            #not reached yet in the first round
+            return [None] * 4
+        return list(range(4*buf, 4*buf+4))
+
+    def log_entry(self, idx):
+        """timestamp and pulses of the log entry idx, None for entries not written yet"""
+        if idx is None or idx >= self.log_entries():
+            return None, -1
+        first, origin, interval = self.log_first, self.log_origin, self.interval
+        for segment in reversed(self.log_segments):
+            if idx >= first:
+                break
+            first, origin, interval = segment
+        dt = origin + datetime.timedelta(minutes=interval*(idx-first+1))
+        #a deterministic load per entry, so repeated reads agree
+        watt = 40 + 30*((idx*7919 + int(self.mac[-4:], 16)) % 97)/97.0
+        return dt, self.raw_pulses(watt, 60*interval)
+
+    def schedule_crc(self):
+        """the CRC16 (CCITT, XMODEM) over the schedule memory, computed with binascii
+        rather than the code under test
+        """
+        return binascii.crc_hqx(bytes(self.schedule), 0)
+
+class StickSimulator(object):
+    """a Plugwise stick on the master side of a pseudo terminal. Open the port attribute
+    as serial device. Every request is acknowledged with a new seqnr, in the order
+    received. The response of a circle follows after the latency of the circle, or
+    not at all when lost. Responses of concurrent requests share the air, one per airtime.
+    """
+
+    def __init__(self, circles, clock=None, chatter=0.0, stick_latency=0.005, airtime=0.005):
+        self.circles = dict((c.mac, c) for c in circles)
+        self.order = [c.mac for c in circles]
+        self.clock = clock or SimClock()
+        self.chatter = chatter
+        self.stick_latency = stick_latency
+        self.airtime = airtime
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.seqnr = 0
+        #the schedule buffer of the stick, written by byte address
+        self.buffer = bytearray(b'\xFF' * 1344)
+        self.counters = dict((k, 0) for k in ('requests', 'crc_errors', 'acks', 'responses',
+            'lost', 'offline', 'ghosts', 'chatter', 'unknown'))
+        self._queue = []
+        self._order = itertools.count()
+        self._air = 0.0
+        self._cv = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        for target in (self._read_loop, self._write_loop):
+            t = threading.Thread(target=target, name="pwsim")
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._cv:
+            self._cv.notify_all()
+        for t in self._threads:
+            t.join(2)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def circleplus(self):
+        return self.circles[self.order[0]] if self.order else None
+
+    def _send(self, delay, data, air=False):
+        """queue data to be written after delay seconds. Responses over the air
+        are spaced by airtime.
+        """
+        due = time.time() + delay
+        with self._cv:
+            if air:
+                due = max(due, self._air + self.airtime)
+                self._air = due
+            heapq.heappush(self._queue, (due, next(self._order), data))
+            self._cv.notify()
+
+    def _write_loop(self):
+        while self._running:
+            with self._cv:
+                while self._running and (not self._queue or self._queue[0][0] > time.time()):
+                    self._cv.wait(self._queue[0][0] - time.time() if self._queue else None)
+                if not self._running:
+                    return
+                _, _, data = heapq.heappop(self._queue)
+            if self.chatter and random.random() < self.chatter:
+                self.counters['chatter'] += 1
+                data = random.choice(CHATTER) + FOOTER + data
+            try:
+                os.write(self.master, data)
+            except OSError:
+                return
+
+    def _read_loop(self):
+        buf = b''
+        while self._running:
+            r, _, _ = select.select([self.master], [], [], 0.2)
+            if not r:
+                continue
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError:
+                return
+            while FOOTER in buf:
+                line, buf = buf.split(FOOTER, 1)
+                pos = line.find(HEADER)
+                if pos >= 0:
+                    self._request(line[pos+len(HEADER):])
+
+    def _request(self, data):
+        self.counters['requests'] += 1
+        msg, crc = data[:-4], data[-4:]
+        if crc != b"%04X" % crc_fun(msg):
+            #the stick ignores corrupted requests
+            self.counters['crc_errors'] += 1
+            return
+        fc = msg[:4]
+        if fc in NO_MAC:
+            mac, args = None, msg[4:]
+        elif fc in (b'0007', b'0004'):
+            mac, args = msg[-16:], msg[4:-16]
+        else:
+            mac, args = msg[4:20], msg[20:]
+        self.seqnr = (self.seqnr + 1) & 0xFFFF
+        if self.seqnr in (0xFFFD, 0xFFFE, 0xFFFF):
+            self.seqnr = 0
+        seqnr = b"%04X" % self.seqnr
+        self._ack(seqnr, ACCEPTED)
+        if mac is None:
+            self._stick_request(fc, seqnr, args)
+            return
+        circle = self.circles.get(mac)
+        if circle is None or not circle.reachable or random.random() < circle.offline:
+            #no route to the circle, the stick gives up after some time
+            self.counters['offline'] += 1
+            self._send(0.5 if circle is None else circle.latency*4, frame(b'0000' + seqnr + b"%04X" % NO_ACK))
+            return
+        if random.random() < circle.loss:
+            self.counters['lost'] += 1
+            return
+        resp = self._circle_request(circle, fc, seqnr, args)
+        if resp is None:
+            self.counters['unknown'] += 1
+            return
+        self.counters['responses'] += 1
+        #the stick acknowledges before the request goes out over the air
+        self._send(self.stick_latency + circle.delay(), resp, True)
+        if random.random() < circle.ghost:
+            #a retransmission in the mesh delivers the response twice
+            self.counters['ghosts'] += 1
+            self._send(self.stick_latency + circle.delay() + random.uniform(0.1, 1.0), resp, True)
+
+    def _ack(self, seqnr, status):
+        self.counters['acks'] += 1
+        self._send(self.stick_latency, frame(b'0000' + seqnr + b"%04X" % status))
+
+    def _stick_request(self, fc, seqnr, args):
+        if fc == b'000A':
+            online = 1 if self.order else 0
+            payload = b'01%02X' % online + NETWORK_ID + NETWORK_ID[-4:] + b'FF'
+            self._send(self.stick_latency, frame(b'0011' + seqnr + STICK_MAC + payload))
+        elif fc == b'003B':
+            #prepare a page of 8 values of the schedule in the buffer of the stick
+            addr = int(args[:4], 16)
+            self.buffer[addr:addr+16] = binascii.unhexlify(args[4:36])
+        elif fc == b'0008':
+            self._send(self.stick_latency, frame(b'0000' + seqnr + b"%04X" % ACK_JOINING + STICK_MAC))
+
+    def _circle_request(self, c, fc, seqnr, args):
+        """the response frame of circle c to request fc, None if not modeled"""
+        def response(rfc, payload=b''):
+            return frame(rfc + seqnr + c.mac + payload)
+
+        def ackmac(status):
+            return frame(b'0000' + seqnr + b"%04X" % status + c.mac)
+
+        now = c.clock.now()
+        if fc == b'0012':
+            watt = c.power()
+            p1s = c.raw_pulses(watt, 1)
+            p8s = c.raw_pulses(watt, 8)
+            p1h = c.raw_pulses(watt, now.minute*60 + now.second)
+            return response(b'0013', sint_hex(p1s, 4) + sint_hex(p8s, 4) + b"%08X" % p1h + b'00000000' + b'0000')
+        elif fc == b'0023':
+            #the address of the buffer with the last completed entry
+            logaddr = LogAddr(c.log_addr(), 8).serialize()
+            return response(b'0024', dt_hex(now) + logaddr + b"%02X" % c.relay + b'85' +
+                b'000000730007' + b'4E0801D9' + (b'01' if c.plus else b'02'))
+        elif fc == b'0048':
+            addr = LogAddr(0, 8).decode(args[:8])
+            payload = b''
+            for idx in c.log_buffer_entries(addr):
+                dt, pulses = c.log_entry(idx)
+                payload += dt_hex(dt) + sint_hex(pulses, 8)
+            return response(b'0049', payload + args[:8])
+        elif fc == b'0026':
+            return response(b'0027', float_hex(c.gain_a) + float_hex(c.gain_b) +
+                float_hex(c.off_tot) + float_hex(c.off_noise))
+        elif fc == b'003E':
+            return response(b'003F', b"%02X%02X%02X%02X" % (now.hour, now.minute, now.second, now.isoweekday()) +
+                b'00' + b"%04X" % c.schedule_crc())
+        elif fc == b'0016':
+            return ackmac(ACK_CLOCKSET)
+        elif fc == b'0017':
+            c.relay = int(args[:2], 16)
+            return ackmac(ACK_ON if c.relay else ACK_OFF)
+        elif fc == b'0057':
+            interval = int(args[:4], 16)
+            if interval and interval != c.interval:
+                c.set_interval(interval)
+            return ackmac(ACK_LOGINTERVAL)
+        elif fc == b'005F':
+            return response(b'0060', b'0000000000000000')
+        elif fc == b'0029':
+            return response(b'003A', b"%02d%02d%02d%02X%02d%02d%02d" % (now.second, now.minute, now.hour,
+                now.isoweekday(), now.day, now.month, now.year-PLUGWISE_EPOCH))
+        elif fc == b'0028':
+            return ackmac(ACK_DATETIME)
+        elif fc == b'0040':
+            c.schedule_enabled = int(args[:2], 16)
+            return ackmac(ACK_SCHEDULE_ON if c.schedule_enabled else ACK_SCHEDULE_OFF)
+        elif fc == b'003C':
+            #copy a page of 16 values from the buffer of the stick
+            idx = int(args[:2], 16)
+            c.schedule[32*(idx-1):32*idx] = self.buffer[32*(idx-1):32*idx]
+            return response(b'003D', args[:2])
+        elif fc == b'0059':
+            c.schedule = bytearray(binascii.unhexlify(args[:4]) * 672)
+            return ackmac(ACK_SCHEDULE_VALUE)
+        elif fc == b'000D':
+            return response(b'000E', b'0000' + b"%04X" % int(c.latency*1000))
+        elif fc == b'0018':
+            idx = int(args[:2], 16)
+            node = self.order[idx+1] if c.plus and idx+1 < len(self.order) else b'FFFFFFFFFFFFFFFF'
+            return response(b'0019', node + args[:2])
+        elif fc == b'001C':
+            return response(b'001D', args[:16] + b'01')
+        elif fc == b'0009':
+            return ackmac(ACK_RESET)
+        elif fc == b'0007':
+            #the stick acknowledge is all
+            return None
+        return None
+
+def network(n, clock, **kwargs):
+    """n simulated circles, the first one is the circle+"""
+    return [SimCircle((MAC_FORMAT % (0x1000+i)).encode(), clock, plus=(i == 0), **kwargs) for i in range(n)]
+
+def add_options(parser):
+    parser.add_option("-n", "--circles", type="int", default=16, help="number of circles, at most 64")
+    parser.add_option("--latency", type="float", default=0.05, help="mean response latency of circles [s]")
+    parser.add_option("--jitter", type="float", default=0.02, help="standard deviation of the latency [s]")
+    parser.add_option("--loss", type="float", default=0.0, help="fraction of responses lost")
+    parser.add_option("--offline", type="float", default=0.0, help="fraction of requests answered E1 by the stick")
+    parser.add_option("--ghost", type="float", default=0.0, help="fraction of responses received twice")
+    parser.add_option("--chatter", type="float", default=0.0, help="fraction of frames preceded by # debug output")
+    parser.add_option("--dead", type="int", default=0, help="number of circles that never respond")
+    parser.add_option("--speed", type="float", default=1.0, help="speed of simulated time for the log buffers")
+    parser.add_option("--seed", type="int", help="seed of the random generator")
+
+def simulator(options):
+    """a started simulator as configured by the options of add_options"""
+    if options.seed is not None:
+        random.seed(options.seed)
+    clock = SimClock(options.speed)
+    circles = network(min(options.circles, 64), clock, latency=options.latency, jitter=options.jitter,
+        loss=options.loss, offline=options.offline, ghost=options.ghost)
+    for c in circles[len(circles)-options.dead:] if options.dead else []:
+        c.reachable = False
+    return StickSimulator(circles, clock, chatter=options.chatter).start()
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    add_options(parser)
+    options, args = parser.parse_args()
+    sim = simulator(options)
+    print("stick on %s" % (sim.port,))
+    for mac in sim.order:
+        print("  %s%s" % (mac.decode(), " circle+" if sim.circles[mac].plus else ""))
+    try:
+        while True:
+            time.sleep(60)
+            print(" ".join("%s=%d" % kv for kv in sorted(sim.counters.items())))
+    except KeyboardInterrupt:
+        sim.stop()
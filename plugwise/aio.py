@@ -0,0 +1,443 @@
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#asyncio interface to the Stick and Circles. Requests are awaitable, and
+#requests to different circles can be awaited together:
+#
+#   stick = AsyncStick('/dev/ttyUSB0')
+#   await stick.connect()
+#   circles = [AsyncCircle(mac, stick, attr) for mac, attr in config]
+#   await asyncio.gather(*(c.reinit() for c in circles))
+#   powers = await asyncio.gather(*(c.get_power_usage() for c in circles), return_exceptions=True)
+#
+#Requests are admitted by the CommandScheduler of the stick. The priority class of
+#the requests of a task is set with stick.using(priority).
+
+import asyncio
+import contextlib
+import contextvars
+import time
+import datetime
+
+from serial.serialutil import SerialException
+
+from swutil.util import *
+from .protocol import *
+from .exceptions import *
+from .api import *
+
+class AsyncPendingRequest(PendingRequest):
+    """a PendingRequest that can be awaited"""
+
+    def __init__(self, loop, stick, frame, response_class=None, mac=None, timeout=RESPONSE_TIMEOUT):
+        PendingRequest.__init__(self, stick, frame, response_class, mac, timeout)
+        self.future = loop.create_future()
+
+    def set_result(self, resp, ts=None):
+        PendingRequest.set_result(self, resp, ts)
+        if not self.future.done():
+            self.future.set_result(resp)
+
+    def set_exception(self, exception):
+        PendingRequest.set_exception(self, exception)
+        if not self.future.done():
+            self.future.set_exception(exception)
+
+    def result(self):
+        return self.future.result()
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def detach(self):
+        """for a request that is not awaited: log its exception instead of leaving it unretrieved"""
+        def retrieve(future):
+            if not future.cancelled() and future.exception() is not None:
+                debug("unawaited request failed: %s" % (future.exception(),))
+        self.future.add_done_callback(retrieve)
+        return self
+
+class AsyncStick(Stick):
+    """asyncio interface to the Plugwise Stick.
+    The serial port is read by the event loop when data is available. Responses
+    are correlated with requests by seqnr, exactly as in Stick.
+    """
+
+    def __init__(self, port=0):
+        self._loop = None
+        self._window_waiters = []
+        #the priority class of the requests of a task, tasks share the thread
+        self._priority = contextvars.ContextVar('priority', default=None)
+        #a zero timeout makes reads return what is available without blocking
+        Stick.__init__(self, port, timeout=0)
+
+    def init(self):
+        """the stick is initialized by connect()"""
+        pass
+
+    async def connect(self):
+        """start reading the serial port on the running event loop and initialize the stick"""
+        self._loop = asyncio.get_running_loop()
+        if not self.connected:
+            self.reopen()
+        if not self.connected:
+            raise SerialException("Cannot open serial port %s" % (self.port,))
+        self._loop.add_reader(self._fd.fileno(), self._on_readable)
+        return await self.status()
+
+    def close(self):
+        if self._loop is not None and self._fd is not None and self.connected:
+            self._loop.remove_reader(self._fd.fileno())
+        Stick.close(self)
+        self._fail_outstanding(TimeoutException("Serial port closed"))
+        self._wake()
+
+    def _on_readable(self):
+        try:
+            data = self.read_available()
+        except SerialException as reason:
+            error("SerialException during read: %s" % (reason,))
+            self.close()
+            return
+        if data:
+            self._frames.feed(data)
+        while self._frames.pending():
+            msg, ts = self._frames.pop()
+            if debug_enabled():
+                debug("RECV %4d %s" % (len(msg), logf(msg)))
+            resp = self._decode(msg)
+            if resp is not None:
+                self._route(resp, msg, ts)
+        self._expire()
+        self._wake()
+        self._publish()
+
+    def _on_deadline(self):
+        self._expire()
+        self._wake()
+
+    def _wake(self):
+        """let submitters waiting for room in the window retry"""
+        waiters = self._window_waiters
+        self._window_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @contextlib.contextmanager
+    def using(self, priority):
+        """set the priority class of the requests of the current task"""
+        token = self._priority.set(priority)
+        try:
+            yield
+        finally:
+            self._priority.reset(token)
+
+    async def submit(self, cmd, response_class=None, mac=None, timeout=RESPONSE_TIMEOUT, priority=None):
+        """send a request and return an awaitable AsyncPendingRequest, see Stick.submit.
+        priority defaults to the class set with using().
+        """
+        if priority is None:
+            priority = self._priority.get()
+        ticket = self.scheduler.enqueue(priority)
+        try:
+            while not self.scheduler.admissible(ticket, self.outstanding() < self.window.limit()):
+                waiter = self._loop.create_future()
+                self._window_waiters.append(waiter)
+                self._loop.call_at(self._loop.time() + max(0, self._next_deadline() - time.time()) + 0.05, self._on_deadline)
+                await waiter
+        except BaseException:
+            #also when the task is cancelled
+            self.scheduler.cancel(ticket)
+            self._wake()
+            raise
+        req = AsyncPendingRequest(self._loop, self, cmd, response_class, mac, timeout)
+        req.priority = self.scheduler.admit(ticket)
+        #the next waiting request may be admissible now
+        self._wake()
+        debug("SEND %4d %s" % (len(cmd), logf(cmd)))
+        try:
+            self.write(cmd)
+        except SerialException as reason:
+            error("SerialException during write: %s" % (reason,))
+            self.close()
+            raise
+        req.sent_ts = time.time()
+        req.deadline = req.sent_ts + timeout
+        self._unacked.append(req)
+        self._loop.call_later(timeout + 0.05, self._on_deadline)
+        return req
+
+    async def request(self, cmd, response_class=None, mac=None, timeout=RESPONSE_TIMEOUT):
+        """send a request and return its response"""
+        return await (await self.submit(cmd, response_class, mac, timeout))
+
+    async def send_msg(self, cmd):
+        req = await self.submit(cmd)
+        await req
+        return (req.status == 0xC1, req.seqnr)
+
+    def wait(self, req):
+        raise RuntimeError("await the request instead of waiting for it")
+
+    async def status(self):
+        resp = await self.request(PlugwiseStatusRequest().serialize(), PlugwiseStatusResponse)
+        debug(str(resp))
+        self.mac = resp.mac.decode('utf-8')
+        if resp.network_id !=  0:
+            self.pan = resp.network_id.serialize()
+            self.short_pan = resp.network_id_short.serialize()
+            self.circleplusmac = b'00'+resp.network_id.serialize()[2:]
+        return resp.network_is_online
+
+    async def enable_joining(self, enabled):
+        req = PlugwiseEnableJoiningRequest(b'', enabled)
+        await self.request(req.serialize(), PlugwiseAckMacResponse)
+
+    async def join_node(self, newmac, permission):
+        req = PlugwiseJoinNodeRequest(newmac.encode('utf-8'), permission)
+        await self.send_msg(req.serialize())
+
+class AsyncCircle(Circle):
+    """asyncio interface to the Plugwise Circle & Circle+.
+    Created without talking to the circle, await reinit() to initialize it.
+    """
+
+    def __init__(self, mac, comchan, attr=None):
+        Circle.__init__(self, mac, comchan, attr, initialize=False)
+
+    async def _request(self, msg, response_class, floor=DEADLINE_FLOOR):
+        return await self._comchan.submit(msg, response_class, self._mac(), self._rtt.timeout(floor))
+
+    async def _result(self, req):
+        try:
+            resp = await req
+        except (TimeoutException, SerialException) as reason:
+            self._offline(reason, req)
+        return self._online(resp, req)
+
+    async def _call(self, msg, response_class, floor=DEADLINE_FLOOR):
+        return await self._result(await self._request(msg, response_class, floor))
+
+    async def reinit(self):
+        try:
+            info = await self.get_info()
+            cur_idx = info['last_logaddr']
+            await self._get_interval(cur_idx)
+            if self.always_on != 'False' and self.relay_state == 'off':
+                await self.switch_on()
+            await self.set_log_interval(self.loginterval, self.production)
+            self.online = True
+            self.online_changed = True
+            self.initialized = True
+        except (ValueError, TimeoutException, SerialException, AttributeError) as reason:
+            self.online = False
+            self.online_changed = True
+            self.initialized = False
+            error("OFFLINE Circle '%s' during initialization Error: %s" % (self.name, str(reason)))
+        self.pong = False
+
+    async def calibrate(self):
+        msg = cached_frame(PlugwiseCalibrationRequest, self._mac())
+        return self._calibration(await self._call(msg, PlugwiseCalibrationResponse))
+
+    async def _calibrated(self):
+        if self.gain_a is None:
+            await self.calibrate()
+
+    async def get_pulse_counters(self):
+        msg = cached_frame(PlugwisePowerUsageRequest, self._mac())
+        return self._pulse_counters(await self._call(msg, PlugwisePowerUsageResponse))
+
+    async def get_power_usage(self):
+        await self._calibrated()
+        return self._power_usage(await self.get_pulse_counters())
+
+    async def get_info(self):
+        msg = cached_frame(PlugwiseInfoRequest, self._mac())
+        return self._info(await self._call(msg, PlugwiseInfoResponse))
+
+    async def _type(self):
+        if self._devtype is None:
+            await self.get_info()
+        return self._devtype
+
+    async def type(self):
+        return self.map_type(await self._type())
+
+    async def get_clock(self):
+        msg = cached_frame(PlugwiseClockInfoRequest, self._mac())
+        return self._clock(await self._call(msg, PlugwiseClockInfoResponse))
+
+    async def set_clock(self, dt):
+        debug("Circle %s set clock to %s" % (self.name, dt.isoformat()))
+        await self._call(PlugwiseClockSetRequest(self._mac(), dt).serialize(), PlugwiseAckMacResponse)
+        return dt
+
+    async def switch(self, on):
+        info("API  %s %s circle switch: %s" % (self.mac, self.name, 'on' if on else 'off',))
+        if not isinstance(on, bool):
+            return False
+        if self.always_on != 'False' and on != True:
+            return False
+        resp = await self._call(cached_frame(PlugwiseSwitchRequest, self._mac(), on), PlugwiseAckMacResponse)
+        self._switched(on, resp)
+
+    async def switch_on(self):
+        await self.switch(True)
+
+    async def switch_off(self):
+        await self.switch(False)
+
+    async def get_power_usage_history(self, log_buffer_index=None, start_dt=None):
+        """see Circle.get_power_usage_history"""
+        await self._calibrated()
+        if log_buffer_index is None:
+            info_resp = await self.get_info()
+            log_buffer_index = info_resp['last_logaddr']
+            #the cur-pos may not be complete.
+            if log_buffer_index > 0:
+                log_buffer_index -= 1
+        return self._power_history(await self._log_buffer(log_buffer_index), start_dt)
+
+    async def mirror_log_buffer(self, addr):
+        """see Circle.mirror_log_buffer"""
+        if self._logmirror is not None and not self.is_mirrored(addr):
+            await self._log_buffer(addr)
+
+    async def _log_buffer(self, addr):
+        """see Circle._log_buffer"""
+        resp = self._mirrored(addr)
+        if resp is not None:
+            return resp
+        log_req = PlugwisePowerBufferRequest(self._mac(), addr).serialize()
+        resp = await self._call(log_req, PlugwisePowerBufferResponse, HISTORY_FLOOR)
+        if self.is_mirrorable(addr):
+            self._mirror_buffer(addr, resp)
+        return resp
+
+    async def _get_interval(self, cur_idx):
+        self.interval=60
+        self.usage=True
+        self.production=False
+        if cur_idx < 1:
+            return
+        log = await self.get_power_usage_history(cur_idx)
+        if len(log)<3:
+            log = (await self.get_power_usage_history(cur_idx-1)) + log
+        self._set_interval(log)
+
+    async def get_power_usage_history_raw(self, log_buffer_index=None):
+        if log_buffer_index is None:
+            info_resp = await self.get_info()
+            log_buffer_index = info_resp['last_logaddr']
+        log_req = PlugwisePowerBufferRequest(self._mac(), log_buffer_index).serialize()
+        return (await self._call(log_req, PlugwisePowerBufferResponseRaw, HISTORY_FLOOR)).raw.value
+
+    async def set_log_interval(self, interval, production=False):
+        msg = cached_frame(PlugwiseLogIntervalRequest, self._mac(), interval, interval if production else 0)
+        return await self._call(msg, PlugwiseAckMacResponse)
+
+    async def get_features(self):
+        msg = cached_frame(PlugwiseFeatureSetRequest, self._mac())
+        return (await self._call(msg, PlugwiseFeatureSetResponse)).features.value
+
+    async def get_circleplus_datetime(self):
+        msg = cached_frame(PlugwiseDateTimeInfoRequest, self._mac())
+        resp = await self._call(msg, PlugwiseDateTimeInfoResponse)
+        return datetime.datetime.combine(resp.date.value, resp.time.value)
+
+    async def set_circleplus_datetime(self, dt):
+        return await self._call(PlugwiseSetDateTimeRequest(self._mac(), dt).serialize(), PlugwiseAckMacResponse)
+
+    async def define_schedule(self, name, scheddata, dst=0):
+        #conversion of watts to pulses needs the calibration
+        await self._calibrated()
+        Circle.define_schedule(self, name, scheddata, dst)
+
+    async def load_schedule(self, dst=0):
+        if not self.schedule._pulse is None:
+            info("circle.load_schedule. enter function")
+            self.schedule._dst_shift(dst)
+            pages = []
+            for msg in self._schedule_pages():
+                pages.append(await self._comchan.submit(msg))
+            #the circle fetches the schedule from the stick, all pages must be in
+            try:
+                for idx, req in enumerate(pages):
+                    await req
+                    if req.status != 0xC1:
+                        raise TimeoutException("Schedule page %d not accepted by stick, status %04X" % (idx, req.status))
+            finally:
+                #the pages not awaited after a failure
+                for req in pages:
+                    req.detach()
+            reqs = []
+            for idx in range(1,43):
+                reqs.append(await self._request(PlugwiseSendScheduleRequest(self._mac(), idx).serialize(), PlugwiseSendScheduleResponse, SCHEDULE_FLOOR))
+            await asyncio.gather(*(self._result(req) for req in reqs))
+            info("circle.load_schedule. exit function")
+
+    async def schedule_onoff(self, on):
+        info("API  %s %s circle schedule %s" % (self.mac, self.name, 'on' if on else 'off'))
+        if not isinstance(on, bool):
+            return False
+        if self.always_on != 'False':
+            return False
+        resp = await self._call(cached_frame(PlugwiseEnableScheduleRequest, self._mac(), on), PlugwiseAckMacResponse)
+        self._schedule_switched(on, resp)
+        if on == True:
+            #update self.relay_state
+            await self.get_info()
+
+    async def schedule_on(self):
+        await self.schedule_onoff(True)
+
+    async def schedule_off(self):
+        await self.schedule_onoff(False)
+
+    async def set_schedule_value(self, val):
+        """Set complete schedule to a single value, see Circle.set_schedule_value"""
+        await self._calibrated()
+        val = self.watt_to_pulses(val) if val>=0 else val
+        req = PlugwiseSetScheduleValueRequest(self._mac(), val)
+        return await self._call(req.serialize(), PlugwiseAckMacResponse)
+
+    async def ping(self):
+        """ping circle, the response arrives unsolicited and sets self.pong"""
+        return (await self._comchan.submit(cached_frame(PlugwisePingRequest, self._mac()))).detach()
+
+    async def ping_synchronous(self):
+        return await self._call(cached_frame(PlugwisePingRequest, self._mac()), PlugwisePingResponse)
+
+    async def read_node_table(self):
+        #Needs to be called on Circle+
+        reqs = []
+        for idx in range(0,64):
+            reqs.append(await self._request(PlugwiseAssociatedNodesRequest(self._mac(), idx).serialize(), PlugwiseAssociatedNodesResponse))
+        resps = await asyncio.gather(*(self._result(req) for req in reqs))
+        return [resp.node_mac_id.value for resp in resps]
+
+    async def remove_node(self, removemac):
+        #Needs to be called on Circle+
+        req = PlugwiseRemoveNodeRequest(self._mac(), removemac)
+        return (await self._call(req.serialize(), PlugwiseRemoveNodeResponse)).status.value
+
+    async def reset(self):
+        req = PlugwiseResetRequest(self._mac(), await self._type(), 20)
+        return (await self._call(req.serialize(), PlugwiseAckMacResponse)).status.value
@@ -32,6 +32,9 @@ import re
 import sys
 import time
 import math
+import itertools
+import collections
+import threading
 from datetime import datetime, timedelta
 import time
 import calendar
@@ -39,12 +42,224 @@ import logging
 from serial.serialutil import SerialException
 
 from swutil.util import *
+from swutil.scheduler import *
 from .protocol import *
 from .exceptions import *
+from .mirror import LOG_BUFFERS
 
 PULSES_PER_KW_SECOND = 468.9385193
 
 DEFAULT_TIMEOUT = 1
+CALIBRATION_FIELDS = ('gain_a', 'gain_b', 'off_noise', 'off_tot')
+SNAPSHOT_FIELDS = ('_devtype', '_logaddr', 'interval', 'usage', 'production',
+    'relay_state', 'scheduleCRC', 'hw_ver', 'fw_ver')
+
+#seconds to wait for a response when no deadline is given
+RESPONSE_TIMEOUT = 6
+#minimum response deadlines of circle requests in seconds. Reading the log
+#buffers and uploading a schedule take the circle more time.
+DEADLINE_FLOOR = 1.0
+HISTORY_FLOOR = 3.0
+SCHEDULE_FLOOR = 4.0
+
+class RttEstimator(object):
+    """smoothed round trip time of a circle and its variation, from which the
+    response deadline is derived in the way of the TCP retransmission timer.
+    The deadline doubles after a timeout, until the next response is measured.
+    Without a measurement the deadline stays at the initial value, so that dead
+    circles fail as fast as before.
+    """
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+
+    def __init__(self, initial=RESPONSE_TIMEOUT, maximum=10.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.backoff = 1
+
+    def timed_out(self):
+        self.backoff = min(self.backoff * 2, 8)
+
+    def timeout(self, floor=0):
+        """response deadline in seconds, at least floor"""
+        if self.srtt is None:
+            return max(floor, self.initial)
+        rto = self.srtt + self.K * self.rttvar
+        return min(self.maximum, max(floor, rto) * self.backoff)
+
+class RequestWindow(object):
+    """number of requests allowed in flight on the stick. Grows by one for every
+    window of successful responses and halves when the network reports busy or
+    offline, or a request times out.
+    """
+
+    def __init__(self, size=2, minsize=1, maxsize=8):
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.size = float(size)
+
+    def limit(self):
+        return int(self.size)
+
+    def success(self):
+        self.size = min(self.maxsize, self.size + 1.0/self.size)
+
+    def busy(self):
+        self.size = max(self.minsize, self.size/2)
+
+class ReadingCache(object):
+    """responses of a circle by reading type, reused as long as they are fresh
+    enough for the caller. A reading asked for while the same reading is in
+    flight waits for that request instead of sending another one.
+    """
+
+    class _Flight(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.exception = None
+
+    def __init__(self, max_age=None):
+        #default freshness in seconds by reading type
+        self.max_age = dict(max_age or {})
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, kind, fetch, max_age=None):
+        """the cached reading of kind when it is at most max_age seconds old,
+        otherwise the result of fetch()
+        """
+        if max_age is None:
+            max_age = self.max_age.get(kind, 0)
+        with self._lock:
+            entry = self._entries.get(kind)
+            if entry is not None and time.time() - entry[0] <= max_age:
+                self.hits += 1
+                return entry[1]
+            flight = self._flights.get(kind)
+            waiting = flight is not None
+            if waiting:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                flight = self._flights[kind] = self._Flight()
+        if waiting:
+            flight.event.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.value
+        #the flight lands also when fetch is interrupted, waiters would block forever
+        value = None
+        exception = TimeoutException("Reading of %s interrupted" % (kind,))
+        try:
+            value = fetch()
+            exception = None
+        except Exception as reason:
+            exception = reason
+            raise
+        finally:
+            self._land(kind, flight, value, exception)
+        return value
+
+    def put(self, kind, value):
+        """store a reading obtained without get"""
+        with self._lock:
+            self._entries[kind] = (time.time(), value)
+        return value
+
+    def invalidate(self, kind=None):
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(kind, None)
+
+    def _land(self, kind, flight, value=None, exception=None):
+        with self._lock:
+            del self._flights[kind]
+            if exception is None:
+                self._entries[kind] = (time.time(), value)
+        flight.value = value
+        flight.exception = exception
+        flight.event.set()
+
+    def stats(self, reset=False):
+        retd = {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+        if reset:
+            self.hits = self.misses = self.coalesced = 0
+        return retd
+
+class PendingRequest(object):
+    """a request submitted to the stick, completed by its response or exception"""
+
+    def __init__(self, stick, frame, response_class=None, mac=None, timeout=RESPONSE_TIMEOUT):
+        self._stick = stick
+        self.frame = frame
+        self.response_class = response_class
+        self.mac = mac
+        self.timeout = timeout
+        self.seqnr = None
+        self.status = None
+        self.priority = None
+        self.sent_ts = None
+        self.deadline = None
+        self.done_ts = None
+        #receive time of the frame of the response
+        self.rx_ts = None
+        self.expired = False
+        self.response = None
+        self.exception = None
+        self._done = False
+
+    def accepts(self, resp):
+        return resp.__class__ is self.response_class and (self.mac is None or resp.mac == self.mac)
+
+    def done(self):
+        return self._done
+
+    def set_result(self, resp, ts=None):
+        """complete with response resp, of a frame received at ts"""
+        self.response = resp
+        self._complete()
+        self.rx_ts = self.done_ts if ts is None else ts
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self._complete()
+
+    def _complete(self):
+        self.done_ts = time.time()
+        self._done = True
+        if self.priority is not None:
+            self._stick.scheduler.release(self.priority)
+            self.priority = None
+
+    def rtt(self):
+        """seconds from sending the request to its completion"""
+        return self.done_ts - self.sent_ts
+
+    def result(self):
+        """wait for completion, return the response or raise its exception"""
+        self._stick.wait(self)
+        if self.exception is not None:
+            raise self.exception
+        return self.response
 
 class Stick(SerialComChannel):
     """provides interface to the Plugwise Stick"""
@@ -58,6 +273,32 @@ class Stick(SerialComChannel):
         self.circles = {} #dictionary {mac, circle} filled by circle init
         self.last_counter = 0
         self.unjoined = set()
+        self._frames = FrameReassembler()
+        #requests sent, waiting for the stick acknowledge, in send order
+        self._unacked = collections.deque()
+        #acknowledged requests waiting for their response, by seqnr
+        self._inflight = {}
+        #seqnrs recently assigned to requests, and the last one, to ignore late and
+        #duplicate acknowledges
+        self._assigned = collections.deque(maxlen=64)
+        self._last_seqnr = None
+        self.window = RequestWindow()
+        #admission to the window by priority class. Background classes are limited
+        #so that interactive commands find room.
+        self.scheduler = CommandScheduler({RELAY: 2, HISTORY: 2, MAINTENANCE: 1})
+        #guards the request state when the reader thread runs
+        self._lock = threading.RLock()
+        self._cv = threading.Condition(self._lock)
+        self._reader = None
+        self._running = False
+        #subscribers to responses that arrive unsolicited, by function code
+        self._subscribers = {}
+        self._events = []
+        #unsolicited responses, kept for expect_response while the reader thread runs
+        self._unclaimed = collections.deque(maxlen=16)
+        self.subscribe(b'000E', self._pong)
+        self.subscribe(b'0006', self._advertise)
+        self.subscribe(b'0061', self._associate)
         SerialComChannel.__init__(self, port=port, timeout=timeout)
         if self.connected:
             self.init()
@@ -72,6 +313,13 @@ class Stick(SerialComChannel):
         try:
             info("Reconnecting to serial device")
             self.close()
+            self._frames.reset()
+            with self._cv:
+                self._fail_outstanding(TimeoutException("Serial device reconnected"))
+                #the stick may count anew
+                self._assigned.clear()
+                self._last_seqnr = None
+                self._cv.notify_all()
             time.sleep(1)
             self.reopen()
         except Exception as e:
@@ -82,93 +330,274 @@ class Stick(SerialComChannel):
             self.init()
 
     def send_msg(self, cmd):
-        #log communication done in serialize function of message object. Could be too early!
-        debug("SEND %4d %s" % (len(cmd), logf(cmd)))
-        try:
-            self.write(cmd)
-        except SerialException as e:
-            print(e)
-            info("SerialException during write - recovering. msg %s" % str(e))
-            self.reconnect()
-        while 1:
-            resp = self.expect_response(PlugwiseAckResponse)
-            #test on sequence number, to be refined for wrap around
-            if (self.last_counter - int(resp.command_counter, 16) >= 0):
-                debug("Seqnr already used in send_msg")
+        """send a request and wait for the stick to acknowledge it.
+        Returns (success, seqnr), where seqnr is the command counter assigned by the stick.
+        """
+        req = self.submit(cmd)
+        self.wait(req)
+        if req.seqnr is None:
+            raise req.exception
+        self.last_counter = int(req.seqnr, 16)
+        return (req.status == 0xC1, req.seqnr)
+
+    def submit(self, cmd, response_class=None, mac=None, timeout=RESPONSE_TIMEOUT, priority=None):
+        """send a request without waiting for its response and return a PendingRequest.
+        The request completes with the response of response_class carrying the seqnr
+        the stick assigned to it, or at the acknowledge of the stick when response_class
+        is None. The request fails when it is not completed within timeout seconds.
+        Blocks until the scheduler admits the request to the window of requests in
+        flight, by priority class. priority defaults to the class of the calling thread.
+        """
+        with self._cv:
+            ticket = self.scheduler.enqueue(priority)
+            try:
+                while not self.scheduler.admissible(ticket, self.outstanding() < self.window.limit()):
+                    self._await(self._next_deadline())
+            except Exception:
+                self.scheduler.cancel(ticket)
+                raise
+            req = PendingRequest(self, cmd, response_class, mac, timeout)
+            req.priority = self.scheduler.admit(ticket)
+            #the next waiting request may be admissible now
+            self._cv.notify_all()
+            #log communication done in serialize function of message object. Could be too early!
+            debug("SEND %4d %s" % (len(cmd), logf(cmd)))
+            try:
+                self.write(cmd)
+            except SerialException as e:
+                print(e)
+                info("SerialException during write - recovering. msg %s" % str(e))
+                self.reconnect()
+                #the request is lost, let it time out
+            req.sent_ts = time.time()
+            req.deadline = req.sent_ts + timeout
+            self._unacked.append(req)
+        #responses routed while waiting for admission
+        self._publish()
+        return req
+
+    def wait(self, req):
+        """wait until req is completed"""
+        with self._cv:
+            while not req.done():
+                self._await(req.deadline)
+        #subscribers are called once the lock is released
+        self._publish()
+        return req
+
+    def _await(self, deadline):
+        """make progress towards deadline: receive and route a frame, or wait for
+        the reader thread to do so.
+        """
+        if self._reader is None or threading.current_thread() is self._reader:
+            self._pump(deadline - time.time())
+        else:
+            self._cv.wait(min(1.0, max(0.05, deadline - time.time())))
+            if time.time() >= deadline:
+                #do not wait for the reader thread to notice
+                self._expire()
+
+    def start_reader(self):
+        """start a thread that receives and routes frames continuously.
+        Unsolicited responses are then published as soon as they arrive.
+        """
+        if self._reader is not None:
+            return
+        self._running = True
+        self._reader = threading.Thread(target=self._read_loop, name="pw-reader")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def stop_reader(self):
+        reader = self._reader
+        if reader is None:
+            return
+        self._running = False
+        reader.join()
+        self._reader = None
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                self._pump(1)
+                self._publish()
+            except Exception as reason:
+                error("Error in stick reader thread: %s" % (reason,))
+                time.sleep(1)
+
+    def subscribe(self, function_code, callback):
+        """call callback(response) for every unsolicited response with function_code.
+        Callbacks run on the reader thread, when it runs, and should not wait for responses.
+        """
+        self._subscribers.setdefault(function_code, []).append(callback)
+
+    def unsubscribe(self, function_code, callback):
+        self._subscribers.get(function_code, []).remove(callback)
+
+    def _publish(self):
+        """call the subscribers of the events collected while routing. Called after
+        the lock is released, so that subscribers can submit requests of their own.
+        """
+        with self._lock:
+            events = self._events
+            self._events = []
+        for callback, resp in events:
+            try:
+                callback(resp)
+            except Exception as reason:
+                error("Error in subscriber of %s: %s" % (logf(resp.function_code), reason))
+
+    def outstanding(self):
+        """number of requests waiting for an acknowledge or a response"""
+        return len(self._unacked) + len(self._inflight)
+
+    def _next_deadline(self):
+        deadlines = [r.deadline for r in self._inflight.values()]
+        if self._unacked:
+            deadlines.append(self._unacked[0].deadline)
+        return min(deadlines) if deadlines else time.time()
+
+    def _pump(self, timeout):
+        """receive and route at most one frame, then expire requests past their deadline.
+        Events for subscribers are queued, the caller publishes them when it does not
+        hold the lock.
+        """
+        rx = self._poll(max(0, timeout))
+        with self._cv:
+            if rx is not None:
+                msg, ts = rx
+                resp = self._decode(msg)
+                if resp is not None:
+                    self._route(resp, msg, ts)
+            self._expire()
+            self._cv.notify_all()
+
+    def _route(self, resp, msg, ts=None):
+        """complete the request a response belongs to, received at ts"""
+        if resp.__class__ is PlugwiseAckResponse and self._acknowledge(resp):
+            return
+        req = self._inflight.get(resp.command_counter)
+        if req is not None and req.accepts(resp):
+            del self._inflight[req.seqnr]
+            self.window.success()
+            req.set_result(resp, ts)
+            return
+        self._dispatch(resp, msg)
+
+    def _acknowledge(self, ack):
+        """handle a stick status. The stick acknowledges requests in the order they were
+        sent. Later statuses carry the seqnr of a request in flight.
+        """
+        seqnr = ack.command_counter
+        status = ack.status.value
+        req = self._inflight.get(seqnr)
+        if req is not None:
+            if status == 0xE1:
+                #network busy or circle offline
+                del self._inflight[seqnr]
+                self.window.busy()
+                req.set_exception(TimeoutException("Network busy or circle offline, status %04X seqnr %s" % (status, logf(seqnr))))
+            elif status == 0xC1:
+                debug("Seqnr %s already acknowledged" % (logf(seqnr),))
+            else:
+                error("Received an error status '%04X' with seqnr %s - Retry receive ..." % (status, logf(seqnr)))
+            return True
+        if status == 0xE1:
             #in case a timeout on previous send occurs, then ignore here.
-            if resp.status.value == 0xE1:
-                debug("Ignoring 0xE1 status in send_msg")
-                continue
-            success = False
-            if resp.status.value == 0xC1:
-                success = True
-            self.last_counter = int(resp.command_counter, 16)
-            break
-        return (success, resp.command_counter)
+            debug("Ignoring 0xE1 status for seqnr %s" % (logf(seqnr),))
+            return True
+        if not self._unacked:
+            return False
+        if self._used(seqnr):
+            #late acknowledge of an expired request, or a duplicate
+            debug("Seqnr %s already used" % (logf(seqnr),))
+            return True
+        req = self._unacked.popleft()
+        req.seqnr = seqnr
+        self._assigned.append(seqnr)
+        self._last_seqnr = int(seqnr, 16)
+        req.status = status
+        if status != 0xC1:
+            self.window.busy()
+            if req.response_class is None:
+                req.set_result(ack)
+            else:
+                req.set_exception(TimeoutException("Request not accepted by stick, status %04X" % (status,)))
+        elif req.response_class is None:
+            req.set_result(ack)
+        else:
+            self._inflight[seqnr] = req
+        return True
 
-    def _recv_response(self, retry_timeout=5):
-        await_response = True
-        msg = b""
-        retry_timeout += 1
-        while await_response:
+    def _used(self, seqnr):
+        """whether seqnr was assigned before, or is not ahead of the last one assigned.
+        The 16 bit counter of the stick wraps around.
+        """
+        if seqnr in self._assigned:
+            return True
+        if self._last_seqnr is None:
+            return False
+        ahead = (int(seqnr, 16) - self._last_seqnr) % 0x10000
+        return ahead == 0 or ahead >= 0x8000
+
+    def _expire(self):
+        now = time.time()
+        while self._unacked and self._unacked[0].deadline <= now:
+            req = self._unacked.popleft()
+            req.expired = True
+            self.window.busy()
+            req.set_exception(TimeoutException("Timeout while waiting for acknowledge from stick"))
+        for seqnr, req in list(self._inflight.items()):
+            if req.deadline <= now:
+                del self._inflight[seqnr]
+                req.expired = True
+                self.window.busy()
+                req.set_exception(TimeoutException("Timeout while waiting for response from device"))
+
+    def _fail_outstanding(self, reason):
+        for req in list(self._unacked) + list(self._inflight.values()):
+            req.set_exception(reason)
+        self._unacked.clear()
+        self._inflight.clear()
+
+    def _poll(self, timeout):
+        """return the next complete frame and its receive timestamp, or None when no
+        frame completes within timeout seconds. Reads whatever the serial port has buffered.
+        """
+        deadline = time.time() + timeout
+        while not self._frames.pending():
             try:
-                msg += self.readline()
+                data = self.read_available()
             except SerialException as e:
                 print(e)
-                info("SerialException during readline - recovering. msg %s" % str(e))
+                info("SerialException during read - recovering. msg %s" % str(e))
                 self.reconnect()
-            # if msg == b"":
-                # logcomm("TOUT      '' - <!> Timeout on serial port" )        
-                # raise TimeoutException("Timeout while waiting for response from device")                
-            # #debug("read:"+logf(msg)+" with length "+str(len(msg)))
-            
-            # if (msg != b""):
-                # if (msg[-1] != '\n'):
-                    # logcomm("lastbyte not 0A")
-                # else:
-                    # logcomm("lastbyte is 0A")
-                # try:    
-                    # logcomm("last bytes: %04X %04X" % (ord(msg[-2]), ord(msg[-1])))
-                # except:
-                    # logcomm("last byte : %04X" % (ord(msg[-1]),))
-                    # pass
-            # logcomm("counter: %2d" % (retry_timeout,))
-            if (msg == b"") or ((msg[-1] != ord('\n')) and (msg[-1] != 131)): #131 = 0x83
-                retry_timeout -= 1
-                if retry_timeout <= 0:
-                    if (msg != b""):
-                        logcomm("TOUT %4d %s - <!> Timeout on serial port" % ( len(msg), logf(msg)))  
-                    else:
-                        logcomm("TOUT      '' - <!> Timeout on serial port" )        
-                    raise TimeoutException("Timeout while waiting for response from device")
-                else:
-                    continue
-            
-            header_start = msg.find(PlugwiseMessage.PACKET_HEADER5)
-            if header_start < 0:
-                header_start = msg.find(PlugwiseMessage.PACKET_HEADER)
-            if header_start > 0:
-                ### 2011 firmware seems to sometimes send extra \x83 byte before some of the
-                ### response messages but there might a all kinds of chatter going on so just 
-                # look for our packet header. Due to protocol errors it might be in the middle of a response
-                logcomm("DSTR %4d %s" % ( len(msg[:header_start]), repr(msg[:header_start].decode('utf-8'))))
-                msg = msg[header_start:]
-                
-            if msg.find(b'#') >= 0:
-                logcomm("DTRC %4d %s" % ( len(msg), logf(msg)))
-                msg = b""
-            elif len(msg)<22:
-                # Ignore. It is too short to interpet as a message.
-                # It may be part of Stick debug messages.
-                logcomm("DSHR %4d %s" % ( len(msg), logf(msg)))
-                msg = b""
+                data = b''
+            if data:
+                self._frames.feed(data)
+            elif time.time() >= deadline:
+                return None
+        frame, ts = self._frames.pop()
+        if debug_enabled():
+            debug("RECV %4d %s" % (len(frame), logf(frame)))
+        return frame, ts
+
+    def _recv_frame(self, retry_timeout=5):
+        """return the next complete frame and its receive timestamp.
+        Raises TimeoutException when no frame completes within retry_timeout+1 seconds.
+        """
+        rx = self._poll(retry_timeout + 1)
+        if rx is None:
+            partial = self._frames.partial()
+            if len(partial) > 0:
+                logcomm("TOUT %4d %s - <!> Timeout on serial port" % ( len(partial), logf(partial)))  
             else:
-                #message can be interpreted as response
-                #perform logcomm after interpetation of response
-                #logcomm("RECV %4d %s" % ( len(msg), logf(msg)))
-                await_response = False
-        debug("RECV %4d %s" % (len(msg), logf(msg)))
-        return msg
+                logcomm("TOUT      '' - <!> Timeout on serial port" )        
+            raise TimeoutException("Timeout while waiting for response from device")
+        return rx
+
+    def _recv_response(self, retry_timeout=5):
+        return self._recv_frame(retry_timeout)[0]
         
     def is_in_sequence(self, resp, seqnr):
         if not seqnr is None and resp.command_counter != seqnr:
@@ -177,125 +606,98 @@ class Stick(SerialComChannel):
         else:
             return True
 
+    def _decode(self, msg, response_class=None):
+        if response_class is None:
+            #prefer the response class of the request in flight with this seqnr
+            start = 5 if msg[:1] == PlugwiseMessage.PACKET_HEADER5[:1] else 4
+            req = self._inflight.get(msg[start+4:start+8])
+            if req is not None:
+                response_class = req.response_class
+        try:
+            resp = decode_response(msg, response_class)
+        except ProtocolError as reason:
+            logcomm("RERR %4d %s - <!> protocol error: %s" % ( len(msg), logf(msg), str(reason)))
+            error("protocol error [1]:"+str(reason))
+            return None
+        if resp is None:
+            logcomm("RERR %4d %s - <!> unknown response" % ( len(msg), logf(msg)))
+            error("unknown response: %s" % (logf(msg),))
+        return resp
+
     def expect_response(self, response_class, src_mac=None, seqnr=None, retry_timeout=5):
-        resp = response_class(seqnr)
+        if self._reader is not None:
+            return self._claim(response_class, src_mac, seqnr, retry_timeout)
         # there's a lot of debug info flowing on the bus so it's
         # expected that we constantly get unexpected messages
         while 1:
-            try:
-                #readlen = len(resp)
-                #debug("expecting to read "+str(readlen)+" bytes for msg. "+str(resp))
-                msg = self._recv_response(retry_timeout)
-                resp.unserialize(msg)
-                if self.is_in_sequence(resp, seqnr) and (src_mac is None or src_mac == resp.mac):
-                    return resp
-                error("expect_response: received response but did not return as expected %s %s %s %s" % (str(seqnr), str(src_mac), str(resp.mac), self.is_in_sequence(resp, seqnr)))
-            except ProtocolError as reason:
-                #retry to receive the response
-                logcomm("RERR %4d %s - <!> protocol error: %s" % ( len(msg), logf(msg), str(reason)))
-                error("protocol error [1]:"+str(reason))
-            except OutOfSequenceException as reason:
+            msg, ts = self._recv_frame(retry_timeout)
+            resp = self._decode(msg, response_class)
+            if resp is None:
                 #retry to receive the response
-                #test ping response any offline circle
-                try:
-                    if resp.function_code == b'000E':
-                        info("expect_response: out of sequence PING response")
-                        pingresp = PlugwisePingResponse()
-                        pingresp.unserialize(msg)
-                        circle = self.circles[resp.mac.decode('utf-8')]
-                        circle.pong = True
-                    elif resp.function_code == b'0006':
-                        info("entering unknown advertise MAC [1]")
-                        ackresp = PlugwiseAdvertiseNodeResponse()
-                        ackresp.unserialize(msg)
-                        info("unknown advertise MAC [1] %s" % logf(ackresp.mac))
-                        if ackresp.mac.decode('utf-8') not in self.unjoined:
-                            self.unjoined.add(ackresp.mac.decode('utf-8'))
-                    elif resp.function_code == b'0061':
-                        ackresp = PlugwiseAckAssociationResponse()
-                        ackresp.unserialize(msg)
-                        info("unknown MAC associating [1] %s" % logf(ackresp.mac))
-                    else:
-                        logcomm("RERR %4d %s - <!> out of sequence: %s" % ( len(msg), logf(msg), str(reason)))
-                        error("out of sequence error [2]:"+str(reason))
-                #Reinterpretation of response should never raise ProtocolError or UnexpectedResponse
-                #OutOfSequenceException is suppressed bu not passing seqnr in Response constructor
-                except (OutOfSequenceException, ProtocolError, UnexpectedResponse) as reason:
-                    #retry to receive the response
-                    logcomm("RERR %4d %s - <!> error while reinterpreting out of sequence response: %s" % ( len(msg), logf(msg), str(reason)))
-                    error("error while reinterpreting out of sequence response:"+str(reason))
-            except UnexpectedResponse as reason:
-                #response could be an error status message
-                #suppress error logging when expecting a response to ping in case circle is offline
-                #TODO: This logging suppresion is probably no longer required
-                if str(reason) != "'expected response code 000E, received code 0000'":
-                    error("unexpected response [1]:"+str(reason))
-                else:
-                    debug("unexpected response [1]:"+str(reason))
-                try:
-                    if resp.function_code == b'0000' and not issubclass(resp.__class__, PlugwiseAckResponse):
-                        #Could be an Ack or AckMac or AcqAssociation error code response when same seqnr
-                        if (len(msg) == 22 and msg[0:1] == b'\x05') or (len(msg) == 23 and msg[0:1] == b'\x83'):
-                            ackresp = PlugwiseAckResponse()
-                            ackresp.unserialize(msg)
-                            if self.is_in_sequence(ackresp, seqnr):
-                                return ackresp
-                        elif (len(msg) == 38 and msg[0:1] == b'\x05') or(len(msg) == 39 and msg[0:1] == b'\x83'):
-                            ackresp = PlugwiseAckMacResponse()
-                            ackresp.unserialize(msg)
-                            if self.is_in_sequence(ackresp, seqnr):
-                                return ackresp
-                        else:
-                            #it does not appear to be a proper Ack message
-                            #just retry to read next message
-                            logcomm("RERR %4d %s - <!> unexpected response error: %s" % ( len(msg), logf(msg), str(reason)))
-                        # except ProtocolError as reason:
-                        #     #retry to receive the response
-                        #     logcomm("RERR %4d %s - <!> protocol error while interpreting as Ack: %s" % ( len(msg), logf(msg), str(reason)))
-                        #     error("protocol error [3]:"+str(reason))
-                        # except OutOfSequenceException as reason:
-                        #     #retry to receive the response
-                        #     #test ping response any offline circle
-                        #     if resp.function_code == '000E':
-                        #         info("expect_response while interpreting as Ack: out of sequence ping response")
-                        #         pingresp = PlugwisePingResponse()
-                        #         pingresp.unserialize(msg)
-                        #         circle = self.circles[resp.mac]
-                        #         circle.pong = True
-                        #     else:
-                        #         logcomm("RERR %4d %s - <!> out of sequence while interpreting as Ack: %s" % ( len(msg), logf(msg), str(reason)))
-                        #         error("protocol error [4]:"+str(reason))
-                        # except UnexpectedResponse as reason:
-                        #     #response could be an error status message
-                        #     logcomm("RERR %4d %s - <!> unexpected response error while interpreting as Ack: %s" % ( len(msg), logf(msg), str(reason)))
-                        #     error("unexpected response [2]:"+str(reason))
-                    elif resp.function_code == b'0006':
-                        info("entering unknown advertise MAC [2]")
-                        ackresp = PlugwiseAdvertiseNodeResponse()
-                        ackresp.unserialize(msg)
-                        info("[0006 with in-sequence?] unknown advertise MAC [2] %s" % logf(ackresp.mac))
-                        if ackresp.mac not in self.unjoined:
-                            self.unjoined.add(ackresp.mac)
-                    elif resp.function_code == b'0061':
-                        ackresp = PlugwiseAckAssociationResponse()
-                        ackresp.unserialize(msg)
-                        info("[0061 with in-sequence?] unknown MAC associating [2] %s" % logf(ackresp.mac))
-                    else:
-                        logcomm("RERR %4d %s - <!> unexpected response error while expecting Ack: %s" % ( len(msg), logf(msg), str(reason)))                    
-                        error("unexpected response [4]:"+str(reason))
-                #Reinterpretation of response should never raise ProtocolError or UnexpectedResponse
-                #OutOfSequenceException is suppressed bu not passing seqnr in Response constructor
-                except (OutOfSequenceException, ProtocolError, UnexpectedResponse) as reason:
-                    #retry to receive the response
-                    logcomm("RERR %4d %s - <!> error while reinterpreting unexpected response: %s" % ( len(msg), logf(msg), str(reason)))
-                    error("error while reinterpreting  unexpected response:"+str(reason))
-            error("TEST: %s - going to retry receive msg" % (logf(resp.function_code),))
+                continue
+            if self._is_expected(resp, response_class, src_mac, seqnr):
+                return resp
+            with self._cv:
+                self._route(resp, msg, ts)
+                self._expire()
+            self._publish()
+
+    def _claim(self, response_class, src_mac, seqnr, retry_timeout):
+        """expect_response while the reader thread runs: take the response from the
+        unsolicited responses it routed.
+        """
+        deadline = time.time() + retry_timeout + 1
+        with self._cv:
+            while 1:
+                for resp in self._unclaimed:
+                    if self._is_expected(resp, response_class, src_mac, seqnr):
+                        self._unclaimed.remove(resp)
+                        return resp
+                if time.time() >= deadline:
+                    raise TimeoutException("Timeout while waiting for response from device")
+                self._cv.wait(min(1.0, deadline - time.time()))
+
+    def _is_expected(self, resp, response_class, src_mac, seqnr):
+        if not seqnr is None and resp.command_counter != seqnr:
+            return False
+        if resp.__class__ is response_class:
+            return src_mac is None or src_mac == resp.mac
+        #instead of the expected response an in sequence status message may be received,
+        #for example the E1 network offline status. The C1 accept status belongs to
+        #send_msg, when received here it is a duplicate.
+        return (not seqnr is None and resp.__class__ is PlugwiseAckResponse
+            and response_class is not PlugwiseAckResponse and resp.status.value != 0xC1)
+
+    def _dispatch(self, resp, msg):
+        """publish a response that no request is waiting for"""
+        subscribers = self._subscribers.get(resp.function_code)
+        if subscribers:
+            self._events.extend((callback, resp) for callback in subscribers)
+            return
+        if self._reader is not None:
+            #may still be claimed by expect_response
+            debug("unclaimed response %s seqnr %s" % (logf(resp.function_code), logf(resp.command_counter)))
+            self._unclaimed.append(resp)
+            return
+        logcomm("RERR %4d %s - <!> out of sequence: seqnr %s" % ( len(msg), logf(msg), logf(resp.command_counter)))
+        error("out of sequence response %s seqnr %s" % (logf(resp.function_code), logf(resp.command_counter)))
+
+    def _pong(self, resp):
+        info("expect_response: out of sequence PING response")
+        circle = self.circles.get(resp.mac.decode('utf-8'))
+        if circle is not None:
+            circle.pong = True
 
+    def _advertise(self, resp):
+        info("unknown advertise MAC %s" % logf(resp.mac))
+        self.unjoined.add(resp.mac.decode('utf-8'))
+
+    def _associate(self, resp):
+        info("unknown MAC associating %s" % logf(resp.mac))
 
     def enable_joining(self, enabled):
         req = PlugwiseEnableJoiningRequest(b'', enabled)
-        _, seqnr  = self.send_msg(req.serialize())
-        self.expect_response(PlugwiseAckMacResponse)
+        self.submit(req.serialize(), PlugwiseAckMacResponse).result()
 
     def join_node(self, newmac, permission):
         req = PlugwiseJoinNodeRequest(newmac.encode('utf-8'), permission)
@@ -306,17 +708,15 @@ class Stick(SerialComChannel):
     def reset(self):
         type = 0
         req = PlugwiseResetRequest(self._mac(), self._devtype, 20)
-        _, seqnr  = self.send_msg(req.serialize())
-        resp = self.expect_response(PlugwiseAckMacResponse)
+        resp = self.submit(req.serialize(), PlugwiseAckMacResponse).result()
         return resp.status.value
 
     def status(self):
         req = PlugwiseStatusRequest()
-        _, seqnr  = self.send_msg(req.serialize())
         #TODO: There is a short and a long response to 0011.
         #The short reponse occurs when no cirlceplus is connected, and has two byte parameters.
         #The short repsonse is likely not properly handled (exception?)
-        resp = self.expect_response(PlugwiseStatusResponse)
+        resp = self.submit(req.serialize(), PlugwiseStatusResponse).result()
         debug(str(resp))
         self.mac = resp.mac.decode('utf-8')
         if resp.network_id !=  0:
@@ -327,11 +727,10 @@ class Stick(SerialComChannel):
         
     def find_circleplus(self):
         req = PlugwiseQueryCirclePlusRequest()
-        _, seqnr  = self.send_msg(req.serialize())
         #Receive the circle+ response, but possibly, only an end-protocol response is seen.
         success = False
         try:
-            resp = self.expect_response(PlugwiseQueryCirclePlusResponse)
+            resp = self.submit(req.serialize(), PlugwiseQueryCirclePlusResponse).result()
             success=True
             self.circleplusmac = resp.new_node_mac_id.serialize()
         except (TimeoutException, SerialException) as reason:
@@ -340,17 +739,17 @@ class Stick(SerialComChannel):
 
     def connect_circleplus(self):
         req = PlugwiseConnectCirclePlusRequest(self.circleplusmac)
-        _, seqnr  = self.send_msg(req.serialize())
-        resp = self.expect_response(PlugwiseConnectCirclePlusResponse)
+        resp = self.submit(req.serialize(), PlugwiseConnectCirclePlusResponse).result()
         return resp.existing.value, self.allowed.value        
         
 class Circle(object):
     """provides interface to the Plugwise Plug & Plug+ devices
     """
 
-    def __init__(self, mac, comchan, attr=None):
+    def __init__(self, mac, comchan, attr=None, initialize=True):
         """
         will raise ValueError if mac doesn't look valid
+        @param initialize: read the circle state now, otherwise call reinit() later
         """
         self.mac = mac.upper()
         if self._validate_mac(mac) == False:
@@ -369,6 +768,8 @@ class Circle(object):
         self.reverse_pol = attr['reverse_pol']
         self.production = attr['production']
         self.loginterval = int(attr['loginterval'].strip())
+        #log settings of the configuration, production is replaced by the detected one
+        self._logsettings = [self.loginterval, self.production]
 
 
         self._devtype = None
@@ -386,6 +787,9 @@ class Circle(object):
         self.online_changed = False
         self.pong = False
         self.initialized = False
+        self._logaddr = 0
+        self.hw_ver = None
+        self.fw_ver = None
         self.relay_state = '?'
         self.switch_state = '?'
         self.schedule_state = '?'
@@ -401,12 +805,20 @@ class Circle(object):
         
         self.power = [0, 0, 0, 0]
         self.power_ts = 0
+        self._rtt = RttEstimator()
+        #power and info responses, by default always read from the circle
+        self._cache = ReadingCache({'power': 0, 'info': 0})
+        #LogMirror of the completed log buffers, see set_mirror
+        self._logmirror = None
+        #whether the mirror was checked against the log of the circle
+        self._mirror_checked = False
         
         self.interval=60
         self.usage=True
         self.production=False
         
-        self.reinit()
+        if initialize:
+            self.reinit()
         
     def _mac(self):
         #convert mac to bytes for communication protocol
@@ -417,18 +829,18 @@ class Circle(object):
         self.online_changed = True
         self.pong = False
 
-    def reinit(self):
+    def reinit(self, deferred=False):
+        """read the circle state, detect the interval of the log buffers and set the log interval
+        @param deferred: only read the circle state now, call complete_init() later for the rest
+        """
         try:
             info = self.get_info()
-            cur_idx = info['last_logaddr']
-            self._get_interval(cur_idx)
             if self.always_on != 'False' and self.relay_state == 'off':
-                self.switchon()
-            #TODO: Check this. Previously log_interval was only set when difference between config file and circle state
-            self.set_log_interval(self.loginterval, self.production)
+                self.switch_on()
+            if not deferred:
+                self._init_logging()
             self.online = True
             self.online_changed = True
-            self.initialized = True
         except (ValueError, TimeoutException, SerialException, AttributeError) as reason:
             self.online = False
             self.online_changed = True
@@ -436,6 +848,40 @@ class Circle(object):
             error("OFFLINE Circle '%s' during initialization Error: %s" % (self.name, str(reason)))       
         self.pong = False
 
+    def complete_init(self):
+        """detect the interval of the log buffers and set the log interval, after reinit(deferred=True)"""
+        try:
+            self._init_logging()
+        except (ValueError, TimeoutException, SerialException) as reason:
+            error("Circle '%s' initialization not completed. Error: %s" % (self.name, str(reason)))
+
+    def snapshot(self):
+        """the state learned from the circle, to be restored after a restart"""
+        snapshot = dict((key, getattr(self, key)) for key in SNAPSHOT_FIELDS)
+        snapshot['logsettings'] = self._logsettings
+        return snapshot
+
+    def restore(self, snapshot):
+        """take over the state of a snapshot instead of reading it from the circle.
+        The circle is assumed online and initialized. Verify with reinit(deferred=True).
+        When the configured log settings changed since, the circle is not initialized
+        and complete_init() sets the log interval.
+        """
+        for key in SNAPSHOT_FIELDS:
+            if key in snapshot:
+                setattr(self, key, snapshot[key])
+        self.online = True
+        self.online_changed = True
+        self.initialized = snapshot.get('logsettings') == self._logsettings
+        if not self.initialized:
+            info("Circle '%s' log settings changed to %s" % (self.name, self._logsettings))
+
+    def _init_logging(self):
+        self._get_interval(self._logaddr)
+        #TODO: Check this. Previously log_interval was only set when difference between config file and circle state
+        self.set_log_interval(self.loginterval, self.production)
+        self.initialized = True
+
     def get_status(self):
         retd = {}
         retd["mac"] = self.mac
@@ -496,65 +942,50 @@ class Circle(object):
 
         return True
 
-    def _expect_response(self, response_class, seqnr):        
-        retry_count = 1
-        retry_timeout = 5 #allow 5+1 seconds for timeout
-        #instead of expected response a status message with correct seqnr may be received
-        #the common case is the offline status 'E1'
-        #it appears that in case of bad networks the expected response competes with
-        #the offline status. Sometimes the proper response arrives just (<1s) after
-        #the offline status.
-        #the while loop is intended to deal with this situation.
-        while retry_count >= 0:
-            retry_count -= 1
-            try:
-                resp = self._comchan.expect_response(response_class, self._mac(), seqnr, retry_timeout)
-            except (TimeoutException, SerialException) as reason:
-                if self.online:
-                    info("OFFLINE Circle '%s'." % (self.name,))
-                self.online = False
-                self.online_changed = True
-                self.pong = False
-                raise TimeoutException("Timeout while waiting for response from circle '%s'" % (self.name,))
-            
-            # if not isinstance(resp, response_class):
-                # #error status returned
-                # if resp.status.value == 0xE1:
-                    # debug("Received an error status '%04X' from circle '%s' - Network slow or circle offline - Retry receive ..." % (resp.status.value, self.name))
-                    # retry_timeout = 1 #allow 1+1 seconds for timeout after an E1.
-                # else:
-                    # error("Received an error status '%04X' from circle '%s' with correct seqnr - Retry receive ..." % (resp.status.value, self.name))
-            if not isinstance(resp, response_class):
-                #error status returned
-                if resp.status.value == 0xE1:
-                    debug("Received an error status '%04X' from circle '%s' - Network slow or circle offline - Retry receive ..." % (resp.status.value, self.name))
-                    #retry_timeout = 1 #allow 1+1 seconds for timeout after an E1.
-                    if self.online:
-                        info("OFFLINE Circle '%s'." % (self.name,))
-                    self.online = False
-                    self.online_changed = True
-                    self.pong = False
-                    raise TimeoutException("Timeout while waiting for response from circle '%s'" % (self.name,))
-                else:
-                    error("Received an error status '%04X' from circle '%s' with correct seqnr - Retry receive ..." % (resp.status.value, self.name))
-            else:
-                ts_now = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
-                if not self.online:
-                    info("ONLINE  Circle '%s' after %d seconds." % (self.name, ts_now - self.last_seen))
-                    self.online = True
-                    self.online_changed = True
-                    self.pong = False
-                #self.last_seen = (datetime.datetime.utcnow()-datetime.timedelta(seconds=time.timezone)).isoformat()
-                self.last_seen = ts_now
-                return resp
-        #we only end here when multiple ack or ackmac messages are generated before the real response
+    def _request(self, msg, response_class, floor=DEADLINE_FLOOR):
+        """submit a request to the circle without waiting. Complete it with _result.
+        The response deadline follows the round trip times measured for this circle,
+        but is at least floor seconds.
+        """
+        return self._comchan.submit(msg, response_class, self._mac(), self._rtt.timeout(floor))
+
+    def _result(self, req):
+        """wait for the response of a request submitted with _request.
+        Instead of the expected response the offline status 'E1' may be received,
+        or no response at all. Both take the circle offline.
+        """
+        try:
+            resp = req.result()
+        except (TimeoutException, SerialException) as reason:
+            self._offline(reason, req)
+        return self._online(resp, req)
+
+    def rtt(self):
+        """smoothed round trip time and current response deadline in seconds"""
+        return (self._rtt.srtt, self._rtt.timeout(DEADLINE_FLOOR))
+
+    def _offline(self, reason, req=None):
+        if req is not None and req.expired:
+            self._rtt.timed_out()
+        debug("No response from circle '%s': %s" % (self.name, str(reason)))
         if self.online:
             info("OFFLINE Circle '%s'." % (self.name,))
         self.online = False
         self.online_changed = True
         self.pong = False
-        #TODO: Replace timeout exception by more specific exception
-        raise TimeoutException("Received multiple error messages from circle '%s'" % (self.name,))
+        raise TimeoutException("Timeout while waiting for response from circle '%s'" % (self.name,))
+
+    def _online(self, resp, req=None):
+        if req is not None:
+            self._rtt.update(req.rtt())
+        ts_now = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
+        if not self.online:
+            info("ONLINE  Circle '%s' after %d seconds." % (self.name, ts_now - self.last_seen))
+            self.online = True
+            self.online_changed = True
+            self.pong = False
+        self.last_seen = ts_now
+        return resp
         
     def map_type(self, devtype):
         types = dict({0: 'stick', 1: 'circle+', 2: 'circle'})
@@ -616,36 +1047,72 @@ class Circle(object):
     def calibrate(self):
         """fetch calibration info from the device
         """
-        msg = PlugwiseCalibrationRequest(self._mac()).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        calibration_response = self._expect_response(PlugwiseCalibrationResponse, seqnr)
+        msg = cached_frame(PlugwiseCalibrationRequest, self._mac())
+        return self._calibration(self._result(self._request(msg, PlugwiseCalibrationResponse)))
+
+    def _calibration(self, calibration_response):
         retl = []
 
-        for x in ('gain_a', 'gain_b', 'off_noise', 'off_tot'):
+        for x in CALIBRATION_FIELDS:
             val = getattr(calibration_response, x).value
             retl.append(val)
             setattr(self, x, val)
 
         return retl
 
-    def get_pulse_counters(self):
+    def calibration(self):
+        """return the calibration constants as a dict, None when not read yet"""
+        if self.gain_a is None:
+            return None
+        return dict((x, getattr(self, x)) for x in CALIBRATION_FIELDS)
+
+    def set_calibration(self, calibration):
+        """use calibration constants, as returned by calibration(), instead of reading
+        them from the device. They are factory values and do not change.
+        """
+        for x in CALIBRATION_FIELDS:
+            setattr(self, x, float(calibration[x]))
+
+    def cache_stats(self, reset=False):
+        """hits, misses and coalesced reads of the reading cache"""
+        return self._cache.stats(reset)
+
+    def request_power_usage(self):
+        """submit a power usage request without waiting for the response.
+        Pass the returned request to get_power_usage or get_pulse_counters.
+        """
+        return self._request(cached_frame(PlugwisePowerUsageRequest, self._mac()), PlugwisePowerUsageResponse)
+
+    def get_pulse_counters(self, req=None, max_age=None):
         """return pulse counters for 1s interval, 8s interval and for the current hour,
         both usage and production as a tuple
+        @param req: request returned by request_power_usage, None to send one now
+        @param max_age: accept a reading of at most max_age seconds old instead of
+            sending a request. None for the default of the cache.
         """
-        msg = PlugwisePowerUsageRequest(self._mac()).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        debug("counters mac %s, seqnr %s" % (self.mac, seqnr))
-        resp = self._expect_response(PlugwisePowerUsageResponse, seqnr)
+        if req is None:
+            resp = self._cache.get('power', lambda: self._result(self.request_power_usage()), max_age)
+        else:
+            resp = self._cache.put('power', self._result(req))
+            debug("counters mac %s, seqnr %s" % (self.mac, req.seqnr))
+        return self._pulse_counters(resp)
+
+    def _pulse_counters(self, resp):
         p1s, p8s, p1h, pp1h = resp.pulse_1s.value, resp.pulse_8s.value, resp.pulse_hour.value, resp.pulse_prod_hour.value
         if self.production == 'False':
             pp1h = 0
         return (p1s, p8s, p1h, pp1h)
 
-    def get_power_usage(self):
+    def get_power_usage(self, req=None, max_age=None):
         """returns power usage for the last second in Watts
         might raise ValueError if reading the pulse counters fails
+        @param req: request returned by request_power_usage, None to send one now
+        @param max_age: see get_pulse_counters
         """
-        pulse_1s, pulse_8s, pulse_1h, pulse_prod_1h = self.get_pulse_counters()
+        return self._power_usage(self.get_pulse_counters(req, max_age))
+
+    def _power_usage(self, pulses):
+        pulse_1s, pulse_8s, pulse_1h, pulse_prod_1h = pulses
         kw_1s = 1000*self.pulses_to_kWs(self.pulse_correction(pulse_1s))
         debug("POWER:          1s: %.3f" % (kw_1s,))
         kw_8s = 1000*self.pulses_to_kWs(self.pulse_correction(pulse_8s, 8))/8.0
@@ -666,9 +1133,23 @@ class Circle(object):
 
         return (kw_1s, kw_8s, kw_1h, kw_p_1h)
 
-    def get_info(self):
+    def request_info(self):
+        """submit an info request without waiting for the response, see get_info"""
+        return self._request(cached_frame(PlugwiseInfoRequest, self._mac()), PlugwiseInfoResponse)
+
+    def get_info(self, req=None, max_age=None):
         """fetch relay state & current logbuffer index info
+        @param req: request returned by request_info, None to send one now
+        @param max_age: accept a response of at most max_age seconds old instead of
+            sending a request. None for the default of the cache.
         """
+        if req is None:
+            resp = self._cache.get('info', lambda: self._result(self.request_info()), max_age)
+        else:
+            resp = self._cache.put('info', self._result(req))
+        return self._info(resp)
+
+    def _info(self, resp):
         def map_hz(hz_raw):
             if hz_raw == 133:
                 return 50
@@ -679,23 +1160,26 @@ class Circle(object):
             states = dict({0: 'off', 1: 'on'})
             return states[state]
 
-        msg = PlugwiseInfoRequest(self._mac()).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseInfoResponse, seqnr)
         retd = response_to_dict(resp)
         retd['hz'] = map_hz(retd['hz'])
         self._devtype = retd['type']
         retd['type'] = self.map_type(retd['type'])
         retd['relay_state'] = relay(retd['relay_state'])
         self.relay_state = retd['relay_state']
+        if self._logmirror is not None:
+            self._check_mirror(retd['last_logaddr'], retd['datetime'])
+        self._logaddr = retd['last_logaddr']
+        self.hw_ver = bytes(retd['hw_ver']).decode('utf-8', 'replace')
+        self.fw_ver = retd['fw_ver'].isoformat()
         return retd
 
     def get_clock(self):
         """fetch current time from the device
         """
-        msg = PlugwiseClockInfoRequest(self._mac()).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseClockInfoResponse, seqnr)
+        msg = cached_frame(PlugwiseClockInfoRequest, self._mac())
+        return self._clock(self._result(self._request(msg, PlugwiseClockInfoResponse)))
+
+    def _clock(self, resp):
         self.scheduleCRC = resp.scheduleCRC.value
         debug("Circle %s get clock to %s" % (self.name, resp.time.value.isoformat()))
         return resp.time.value
@@ -705,8 +1189,7 @@ class Circle(object):
         """
         debug("Circle %s set clock to %s" % (self.name, dt.isoformat()))
         msg = PlugwiseClockSetRequest(self._mac(), dt).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        resp = self._result(self._request(msg, PlugwiseAckMacResponse))
         #status = '00D7'
         return dt
 
@@ -719,9 +1202,12 @@ class Circle(object):
             return False
         if self.always_on != 'False' and on != True:
             return False
-        req = PlugwiseSwitchRequest(self._mac(), on)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        resp = self._result(self._request(cached_frame(PlugwiseSwitchRequest, self._mac(), on), PlugwiseAckMacResponse))
+        self._switched(on, resp)
+
+    def _switched(self, on, resp):
+        #a cached relay state is outdated
+        self._cache.invalidate('info')
         if on == True:
             if resp.status.value != 0xD8:
                 error("Wrong switch status reply when  switching on. expected '00D8', received '%04X'" % (resp.status.value,))
@@ -734,7 +1220,6 @@ class Circle(object):
             self.switch_state = 'off'
             self.relay_state = 'off'
             #self.schedule_state = 'off'
-        return 
 
     def switch_on(self):
         self.switch(True)
@@ -767,10 +1252,107 @@ class Circle(object):
             if log_buffer_index > 0:
                 log_buffer_index -= 1
 
-        log_req = PlugwisePowerBufferRequest(self._mac(), log_buffer_index).serialize()
-        _, seqnr  = self._comchan.send_msg(log_req)
-        resp = self._expect_response(PlugwisePowerBufferResponse, seqnr)
-        
+        return self._power_history(self._log_buffer(log_buffer_index), start_dt)
+
+    def set_mirror(self, mirror):
+        """read completed log buffers from a LogMirror, and mirror the ones read from the circle.
+        The mirror is used once the next info response showed it fits the log of the circle.
+        """
+        self._logmirror = mirror
+        self._mirror_checked = False
+
+    def is_mirrored(self, addr):
+        return self._logmirror is not None and self._mirror_checked and self._logmirror.get(addr) is not None
+
+    def is_mirrorable(self, addr):
+        """whether log buffer addr is mirrored when read: a completed buffer below the
+        current log address. Buffers above it, of the previous round after a wrap around,
+        are written again when the log address reaches them.
+        """
+        return self._logmirror is not None and self._mirror_checked and 0 <= addr < self._logaddr
+
+    def _check_mirror(self, logaddr, now):
+        """invalidate the mirror when it does not fit the log of the circle at log address
+        logaddr and clock now: the log address went back, the newest mirrored buffer is
+        beyond it or later than the clock, or older than a round of the log takes, after
+        which the log may have wrapped around.
+        """
+        mirror = self._logmirror
+        reason = None
+        if logaddr < mirror.logaddr:
+            reason = "log address back from %d to %d" % (mirror.logaddr, logaddr)
+        elif mirror.newest >= logaddr:
+            reason = "newest mirrored buffer %d beyond log address %d" % (mirror.newest, logaddr)
+        elif mirror.newest >= 0 and now is not None:
+            resp = self._mirror_record(mirror.newest)
+            dates = [getattr(resp, "logdate%d" % (i,)).value for i in range(1, 5)]
+            interval = max(b - a for a, b in zip(dates, dates[1:]))
+            interval = max(interval, timedelta(minutes=1))
+            if dates[3] > now + interval:
+                reason = "newest mirrored buffer of %s later than the clock %s" % (dates[3], now)
+            elif now - dates[3] > LOG_BUFFERS * 4 * interval:
+                reason = "log may have wrapped around since %s" % (dates[3],)
+        if reason is not None:
+            info("Circle %s log mirror invalidated: %s" % (self.mac, reason))
+            mirror.invalidate()
+        mirror.set_logaddr(logaddr)
+        self._mirror_checked = True
+
+    def mirror_log_buffer(self, addr):
+        """read log buffer addr from the circle into the mirror, when not mirrored yet"""
+        if self._logmirror is not None and not self.is_mirrored(addr):
+            self._log_buffer(addr)
+
+    def request_log_buffer(self, addr):
+        """submit a log buffer request without waiting for the response, None when the
+        buffer is mirrored. Pass the returned request to _log_buffer.
+        """
+        if self.is_mirrored(addr):
+            return None
+        log_req = PlugwisePowerBufferRequest(self._mac(), addr).serialize()
+        return self._request(log_req, PlugwisePowerBufferResponse, HISTORY_FLOOR)
+
+    def _log_buffer(self, addr, req=None):
+        """the 0049 response of log buffer addr, from the mirror when it holds the address
+        @param req: request returned by request_log_buffer, None to send one now
+        """
+        resp = self._mirrored(addr)
+        if resp is not None:
+            return resp
+        if req is None:
+            req = self.request_log_buffer(addr)
+        resp = self._result(req)
+        #the buffer at the current log address is still being written
+        if self.is_mirrorable(addr):
+            self._mirror_buffer(addr, resp)
+        return resp
+
+    def _mirrored(self, addr):
+        if self._logmirror is None or not self._mirror_checked:
+            return None
+        return self._mirror_record(addr)
+
+    def _mirror_record(self, addr):
+        serialized = self._logmirror.get(addr)
+        if serialized is None:
+            return None
+        resp = PlugwisePowerBufferResponse.record()
+        resp._parse_params(serialized + LogAddr(addr, 8).serialize())
+        return resp
+
+    def _mirror_buffer(self, addr, resp):
+        dates = [getattr(resp, "logdate%d" % (i,)).value for i in range(1, 5)]
+        if None in dates:
+            return
+        prev = self._mirrored(addr-1) if addr > 0 else None
+        if prev is not None and prev.logdate4.value is not None and dates[0] < prev.logdate4.value:
+            #the clock of the circle was set back, the mirror may not be continuous
+            info("Circle %s log buffer %d older than its predecessor" % (self.mac, addr))
+            self._logmirror.invalidate()
+        fields = ("logdate1", "pulses1", "logdate2", "pulses2", "logdate3", "pulses3", "logdate4", "pulses4")
+        self._logmirror.put(addr, b''.join(bytes(getattr(resp, name).raw) for name in fields))
+
+    def _power_history(self, resp, start_dt=None):
         intervals = []
         dts = []
         pulses = []
@@ -830,6 +1412,42 @@ class Circle(object):
             retl.append((dts[i], watt, watthour))
         return retl
 
+    def iter_power_history(self, start, end=None, since=None):
+        """yield the (datetime, average-watt-in-interval, watt-hours-in-this-interval) records
+        of the log buffers from address start, wrapping around at the end of the log.
+        Production logged with usage is added to the usage of the same timestamp.
+        The next buffer is requested while the records of the current one are consumed.
+
+        @param end: address to stop before. None to end with the buffer being written,
+            equal to start to read the complete log.
+        @param since: only yield records after this datetime
+        """
+        if end is None:
+            end = self.get_info()['last_logaddr'] + 1
+        if start < end:
+            addrs = iter(range(start, end))
+        else:
+            addrs = itertools.chain(range(start, LOG_BUFFERS), range(0, end))
+        #the interval of the first record is inferred from the buffer itself
+        prev_dt = None
+        addr = next(addrs, None)
+        req = self.request_log_buffer(addr) if addr is not None else None
+        while addr is not None:
+            resp = self._log_buffer(addr, req)
+            addr = next(addrs, None)
+            req = self.request_log_buffer(addr) if addr is not None else None
+            records = []
+            for i, (dt, watt, watt_hour) in enumerate(self._power_history(resp, prev_dt)):
+                if records and dt == records[-1][0] and self.production == True and i & 1:
+                    records[-1] = (dt, records[-1][1] + watt, records[-1][2] + watt_hour)
+                else:
+                    records.append((dt, watt, watt_hour))
+            if records:
+                prev_dt = records[-1][0]
+            for record in records:
+                if since is None or record[0] > since:
+                    yield record
+
     def get_power_usage_history_raw(self, log_buffer_index=None):
         """Reads the raw interpreted power usage information from the given log buffer 
         address at the Circle. This function reads (check!) 64 bytes of memory.
@@ -846,8 +1464,7 @@ class Circle(object):
             log_buffer_index = info_resp['last_logaddr']
 
         log_req = PlugwisePowerBufferRequest(self._mac(), log_buffer_index).serialize()
-        _, seqnr  = self._comchan.send_msg(log_req)
-        resp = self._expect_response(PlugwisePowerBufferResponseRaw, seqnr)
+        resp = self._result(self._request(log_req, PlugwisePowerBufferResponseRaw, HISTORY_FLOOR))
         retl = getattr(resp, "raw").value
 
         return retl
@@ -860,26 +1477,23 @@ class Circle(object):
             False: Usage logging only.
             True:  Usage and Production logging.
         """
-        msg = PlugwiseLogIntervalRequest(self._mac(), interval, interval if production else 0).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        return self._expect_response(PlugwiseAckMacResponse, seqnr)
+        msg = cached_frame(PlugwiseLogIntervalRequest, self._mac(), interval, interval if production else 0)
+        return self._result(self._request(msg, PlugwiseAckMacResponse))
         #status = '00F8'
         
     def get_features(self):
         """fetch feature set
         """
 
-        msg = PlugwiseFeatureSetRequest(self._mac()).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseFeatureSetResponse, seqnr)
+        msg = cached_frame(PlugwiseFeatureSetRequest, self._mac())
+        resp = self._result(self._request(msg, PlugwiseFeatureSetResponse))
         return resp.features.value
         
     def get_circleplus_datetime(self):
         """fetch current time from the circle+
         """
-        msg = PlugwiseDateTimeInfoRequest(self._mac()).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseDateTimeInfoResponse, seqnr)
+        msg = cached_frame(PlugwiseDateTimeInfoRequest, self._mac())
+        resp = self._result(self._request(msg, PlugwiseDateTimeInfoResponse))
         dt = datetime.datetime.combine(resp.date.value, resp.time.value)
         return dt
         
@@ -887,8 +1501,7 @@ class Circle(object):
         """set circle+ clock to the value indicated by the datetime object dt
         """
         msg = PlugwiseSetDateTimeRequest(self._mac(), dt).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        return self._expect_response(PlugwiseAckMacResponse, seqnr)
+        return self._result(self._request(msg, PlugwiseAckMacResponse))
         #status = '00DF'=ack '00E7'=nack
         
     def define_schedule(self, name, scheddata, dst=0):
@@ -906,16 +1519,28 @@ class Circle(object):
             #TODO: add test on inequality of CRC
             
             #info("schedule %s" % self.schedule._pulse)
-            for idx in range(0,84):
-                chunk = self.schedule._pulse[(8*idx):(8*idx+8)]
-                req = PlugwisePrepareScheduleRequest(idx, chunk)
-                _, seqnr  = self._comchan.send_msg(req.serialize())
-            for idx in range(1,43):
-                req = PlugwiseSendScheduleRequest(self._mac(), idx)
-                _, seqnr  = self._comchan.send_msg(req.serialize())
-                resp = self._expect_response(PlugwiseSendScheduleResponse, seqnr)
+            pages = [self._comchan.submit(msg) for msg in self._schedule_pages()]
+            #the circle fetches the schedule from the stick, all pages must be in
+            for idx, req in enumerate(pages):
+                req.result()
+                if req.status != 0xC1:
+                    raise TimeoutException("Schedule page %d not accepted by stick, status %04X" % (idx, req.status))
+            #keep the schedule pages in flight, then collect the responses in order.
+            #The frames of the pages are not cached, they would evict the frequent ones.
+            reqs = [self._request(PlugwiseSendScheduleRequest(self._mac(), idx).serialize(), PlugwiseSendScheduleResponse, SCHEDULE_FLOOR)
+                for idx in range(1,43)]
+            for req in reqs:
+                resp = self._result(req)
             info("circle.load_schedule. exit function")
 
+    def _schedule_pages(self):
+        """the prepare requests that transfer the schedule to the stick"""
+        retl = []
+        for idx in range(0,84):
+            chunk = self.schedule._pulse[(8*idx):(8*idx+8)]
+            retl.append(PlugwisePrepareScheduleRequest(idx, chunk).serialize())
+        return retl
+
     def schedule_onoff(self, on):
         """switch schedule on or off
         @param on: new state, boolean
@@ -925,20 +1550,22 @@ class Circle(object):
             return False
         if self.always_on != 'False':
             return False
-        req = PlugwiseEnableScheduleRequest(self._mac(), on)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        resp = self._result(self._request(cached_frame(PlugwiseEnableScheduleRequest, self._mac(), on), PlugwiseAckMacResponse))
+        self._schedule_switched(on, resp)
+        if on == True:
+            #update self.relay_state
+            self.get_info()
+
+    def _schedule_switched(self, on, resp):
+        self._cache.invalidate('info')
         if on == True:
             if resp.status.value != 0xE4:
                 error("Wrong schedule status reply when setting schedule on. expected '00E4', received '%04X'" % (resp.status.value,))
             self.schedule_state = 'on'
-            #update self.relay_state
-            self.get_info()
         else:
             if resp.status.value != 0xE5:
                 error("Wrong schedule status reply when setting schedule off. expected '00E5', received '%04X'" % (resp.status.value,))
             self.schedule_state = 'off'  
-        return 
 
     def schedule_on(self):
         self.schedule_onoff(True)
@@ -955,8 +1582,7 @@ class Circle(object):
         #TODO: incorporate this in Schedule object
         val = self.watt_to_pulses(val) if val>=0 else val
         req = PlugwiseSetScheduleValueRequest(self._mac(), val)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        return self._expect_response(PlugwiseAckMacResponse, seqnr)
+        return self._result(self._request(req.serialize(), PlugwiseAckMacResponse))
         #status = '00FA'
         
         
@@ -969,6 +1595,9 @@ class Circle(object):
         log = self.get_power_usage_history(cur_idx)
         if len(log)<3:
             log = self.get_power_usage_history(cur_idx-1) + log
+        self._set_interval(log)
+
+    def _set_interval(self, log):
         if len(log)<3:
             error("_get_interval: to few entries in power buffer to determine interval")
             return
@@ -983,47 +1612,112 @@ class Circle(object):
     def ping(self):
         """ping circle
         """
-        req = PlugwisePingRequest(self._mac())
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        debug("pinged mac %s, seqnr %s" % (self.mac, seqnr))
-        return #self._expect_response(PlugwisePingResponse, seqnr)
+        req = self._comchan.submit(cached_frame(PlugwisePingRequest, self._mac()))
+        debug("pinged mac %s" % (self.mac,))
+        #the response arrives unsolicited and sets self.pong
+        return req
 
     def ping_synchronous(self):
         """ping circle
         """
-        req = PlugwisePingRequest(self._mac())
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        return self._expect_response(PlugwisePingResponse, seqnr)
+        return self._result(self._request(cached_frame(PlugwisePingRequest, self._mac()), PlugwisePingResponse))
 
     def read_node_table(self):
         #Needs to be called on Circle+
         nodetable = []
-        for idx in range(0,64):
-            req = PlugwiseAssociatedNodesRequest(self._mac(), idx)
-            _, seqnr  = self._comchan.send_msg(req.serialize())
-            resp = self._expect_response(PlugwiseAssociatedNodesResponse, seqnr)
+        reqs = [self._request(PlugwiseAssociatedNodesRequest(self._mac(), idx).serialize(), PlugwiseAssociatedNodesResponse)
+            for idx in range(0,64)]
+        for req in reqs:
+            resp = self._result(req)
             nodetable.append(resp.node_mac_id.value)
         return nodetable
         
     def remove_node(self, removemac):
         #Needs to be called on Circle+
         req = PlugwiseRemoveNodeRequest(self._mac(), removemac)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseRemoveNodeResponse, seqnr)
+        resp = self._result(self._request(req.serialize(), PlugwiseRemoveNodeResponse))
         return resp.status.value
             
     def reset(self):
         req = PlugwiseResetRequest(self._mac(), self._type(), 20)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        resp = self._result(self._request(req.serialize(), PlugwiseAckMacResponse))
         return resp.status.value
             
+class PowerSnapshot(object):
+    """power of a set of circles read together. Each reading is timestamped with the
+    arrival of its response. The snapshot time is the median of those, the spread
+    the seconds between the first and last reading.
+    """
+
+    def __init__(self):
+        self.readings = {}
+        self.missing = []
+
+    def add(self, mac, ts, power1s, power8s):
+        self.readings[mac] = {"ts": ts, "power1s": power1s, "power8s": power8s}
+
+    def miss(self, mac):
+        self.missing.append(mac)
+
+    def ts(self):
+        times = sorted(r["ts"] for r in self.readings.values())
+        return times[len(times)//2] if times else None
+
+    def spread(self):
+        times = [r["ts"] for r in self.readings.values()]
+        return max(times) - min(times) if times else 0.0
+
+    def as_dict(self):
+        return {"ts": self.ts(), "spread": self.spread(), "circles": self.readings, "missing": self.missing}
+
+def snapshot_order(circles):
+    """circles ordered to have their responses arrive close together: the ones
+    with the longest round trip first
+    """
+    return sorted(circles, key=lambda c: c.rtt()[0] or 0.0, reverse=True)
+
+def power_snapshot(circles):
+    """read the power of circles as close together in time as the stick allows,
+    all requests in flight before the first response is collected. Returns a PowerSnapshot.
+    """
+    snapshot = PowerSnapshot()
+    pending = []
+    for c in snapshot_order(circles):
+        try:
+            pending.append((c, c.request_power_usage()))
+        except (TimeoutException, SerialException):
+            snapshot.miss(c.mac)
+    for c, req in pending:
+        try:
+            power1s, power8s, _, _ = c.get_power_usage(req)
+        except (ValueError, TimeoutException, SerialException):
+            snapshot.miss(c.mac)
+            continue
+        snapshot.add(c.mac, req.rx_ts, power1s, power8s)
+    return snapshot
+
+def schedule_crc(pulses):
+    """the CRC of a schedule as reported by the circle in the clock info response:
+    the CRC16 over the schedule values as big endian 16 bit integers
+
+    >>> '%04X' % schedule_crc([-1] * 672)                   #always on
+    '457A'
+    >>> '%04X' % schedule_crc([0] * 672)                    #always off
+    '0000'
+    >>> '%04X' % schedule_crc(([-1] * 32 + [0] * 64) * 7)   #on from 0:00 to 8:00
+    '5303'
+    >>> '%04X' % schedule_crc([5] * 672)                    #standby killer at 5 pulses
+    '230B'
+    """
+    return crc_fun(struct.pack('>%dh' % len(pulses), *pulses))
+
+#CRC of the schedule that is always on, the schedule of a circle without schedule
+ALWAYS_ON_CRC = schedule_crc([-1] * 672)
+
 def response_to_dict(r):
     retd = {}
-    for key in dir(r):
-        ptr = getattr(r, key)
-        if isinstance(ptr, BaseType):
-            retd[key] = ptr.value
+    for key, _, _, _ in r._layout:
+        retd[key] = getattr(r, key).value
     return retd
 
 class Schedule(object):
@@ -1046,7 +1740,7 @@ class Schedule(object):
         self._pulse = list(int(self.watt_to_pulses(circle_w2p, w)) if w>0 else w for w in self._watt)
         #self._pulse = list(int(circle_w2p(i)) if i>0 else i for i in self._watt)
         #self._shift_day()
-        self.CRC = crc_fun(''.join(str(struct.pack('>h',i)) for i in self._pulse))
+        self.CRC = schedule_crc(self._pulse)
         #self._hex = ''.join(("%04X" % int_to_uint(i,4)) for i in self._pulse)
         
     def watt_to_pulses(self, circle_w2p, watt):
@@ -1065,18 +1759,18 @@ class Schedule(object):
         # info("circle.schedule._shift_day rotate left by one day")
         # #rotate schedule a day to the left
         # self._pulse = self._pulse[96:]+self._pulse[:96]
-        # #self.CRC = crc_fun(''.join(str(struct.pack('>h',i)) for i in self._pulse))
+        # #self.CRC = schedule_crc(self._pulse)
 
     def _dst_shift(self, dst):
         if self.dst and not dst:
             info("circle.schedule._dst_shift rotate right [end of DST]")
             #rotate schedule 4 quarters right (forward in time)
             self._pulse = self._pulse[-4:]+self._pulse[:-4]
-            self.CRC = crc_fun(''.join(str(struct.pack('>h',i)) for i in self._pulse))
+            self.CRC = schedule_crc(self._pulse)
             self.dst = 0
         elif not self.dst and dst:
             info("circle.schedule._dst_shift rotate left [start of DST]")
             #rotate schedule 4 quarters left (backward in time)
             self._pulse = self._pulse[4:]+self._pulse[:4]
-            self.CRC = crc_fun(''.join(str(struct.pack('>h',i)) for i in self._pulse))
+            self.CRC = schedule_crc(self._pulse)
             self.dst = 1
@@ -0,0 +1,144 @@
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#Catch up on the log buffers of circles after downtime. The outstanding log
+#buffers are read into the LogMirror of the circles, after which the regular
+#log recording processes them without communication. The mirror is the
+#checkpoint: a restarted backfill skips the buffers mirrored before.
+
+import time
+import threading
+import concurrent.futures
+
+from serial.serialutil import SerialException
+
+from swutil.util import *
+from swutil.scheduler import *
+from .exceptions import *
+from .mirror import LOG_BUFFERS
+
+def outstanding(first, last):
+    """log buffer addresses from first up to, not including, the current address last,
+    wrapping around at the end of the log
+    """
+    if first <= last:
+        return list(range(first, last))
+    return list(range(first, LOG_BUFFERS)) + list(range(0, last))
+
+class Backfill(object):
+    """reads log buffers of several circles in the background, interleaved over the
+    circles. Requests are sent with the HISTORY priority, of which the stick admits
+    as many as its request window allows but one, leaving room for realtime requests,
+    and at least the configured HISTORY limit.
+    """
+    #seconds between progress reports
+    REPORT = 30
+
+    def __init__(self, stick, plan):
+        """@param plan: list of (circle, list of log buffer addresses)"""
+        self.stick = stick
+        self._lock = threading.Lock()
+        self._work = self._interleave(plan)
+        self.total = len(self._work)
+        self.done = 0
+        self.failed = 0
+        self.pending = set(c.mac for c, addrs in plan if addrs)
+        self._remaining = dict((c.mac, len(addrs)) for c, addrs in plan if addrs)
+        self._stop = False
+        self._thread = None
+        self.started = None
+
+    def _interleave(self, plan):
+        """(circle, address) pairs, taking the next address of each circle in turn"""
+        work = []
+        n = max([len(addrs) for c, addrs in plan] or [0])
+        for i in range(n):
+            for c, addrs in plan:
+                if i < len(addrs):
+                    work.append((c, addrs[i]))
+        work.reverse()
+        return work
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self.run, name="backfill")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        if self.started is None:
+            self.started = time.time()
+        info("backfill: %d log buffers of %d circles" % (self.total, len(self.pending)))
+        scheduler = self.stick.scheduler
+        window = self.stick.window
+        workers = window.maxsize
+        with self.stick._cv:
+            limit = scheduler.limits.get(HISTORY)
+            scheduler.set_limit(HISTORY, lambda: max(limit or 1, window.limit() - 1))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                futures = [executor.submit(self._worker) for i in range(workers)]
+                while concurrent.futures.wait(futures, self.REPORT).not_done:
+                    info("backfill: %s" % (self.progress(),))
+        finally:
+            with self.stick._cv:
+                scheduler.set_limit(HISTORY, limit)
+        info("backfill: done %s" % (self.progress(),))
+
+    def _worker(self):
+        scheduler = self.stick.scheduler
+        with scheduler.using(HISTORY):
+            while not self._stop:
+                with self._lock:
+                    if not self._work:
+                        return
+                    c, addr = self._work.pop()
+                if c.mac not in self.pending:
+                    continue
+                try:
+                    c.mirror_log_buffer(addr)
+                except (ValueError, TimeoutException, SerialException) as reason:
+                    #offline, the remaining buffers are read by the regular log recording
+                    error("backfill: circle %s stopped at log buffer %d: %s" % (c.mac, addr, reason))
+                    with self._lock:
+                        self.pending.discard(c.mac)
+                        self.failed += self._remaining.pop(c.mac, 0)
+                    continue
+                with self._lock:
+                    self.done += 1
+                    if c.mac not in self._remaining:
+                        #failed in another worker
+                        continue
+                    self._remaining[c.mac] -= 1
+                    if self._remaining[c.mac] == 0:
+                        del self._remaining[c.mac]
+                        self.pending.discard(c.mac)
+
+    def progress(self):
+        """done of total buffers, rate and estimated time to completion"""
+        elapsed = time.time() - self.started if self.started else 0
+        rate = self.done / elapsed if elapsed > 0 else 0
+        left = self.total - self.done - self.failed
+        eta = "%ds" % (left / rate,) if rate > 0 else "-"
+        return "%d of %d log buffers, %d failed, %.1f/s, eta %s" % (self.done, self.total, self.failed, rate, eta)
@@ -0,0 +1,136 @@
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#Local copy of the completed log buffers of a circle. A log buffer address is
+#not written again once the circle moved past it, until the log wraps around
+#or is cleared. The file holds a fixed size record per address: the four
+#timestamps and pulse counters of the 0049 response, as 32 binary bytes.
+#An address of all zero bytes has not been mirrored.
+#The records follow a header with the log address of the circle when last seen
+#and the address of the newest mirrored buffer, -1 for none. From these the
+#circle checks the mirror still fits its log, see Circle._check_mirror.
+
+import os
+import struct
+import binascii
+import threading
+
+from swutil.util import *
+
+#log buffer addresses of a circle
+LOG_BUFFERS = 6016
+
+class LogMirror(object):
+    RECORD = 32
+    EMPTY = bytes(RECORD)
+    HEADER = struct.Struct('<4sIi')
+    MAGIC = b'PWM1'
+
+    def __init__(self, filename, size=LOG_BUFFERS):
+        self.filename = filename
+        self.size = size
+        self.logaddr = 0
+        self.newest = -1
+        self._lock = threading.Lock()
+        self._data = bytearray(size * self.RECORD)
+        self._file = None
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            if len(data) == self.HEADER.size + len(self._data) and data[:4] == self.MAGIC:
+                _, self.logaddr, self.newest = self.HEADER.unpack_from(data)
+                self._data[:] = data[self.HEADER.size:]
+            else:
+                info("LogMirror: ignoring %s of unexpected size %d or format" % (filename, len(data)))
+                self._write(0, self._header() + self._data)
+                self._sync()
+        except IOError:
+            pass
+
+    def get(self, addr):
+        """the serialized log buffer at addr, as in the 0049 response, None when not mirrored"""
+        if not 0 <= addr < self.size:
+            return None
+        record = bytes(self._data[addr*self.RECORD:(addr+1)*self.RECORD])
+        if record == self.EMPTY:
+            return None
+        return binascii.hexlify(record).upper()
+
+    def put(self, addr, serialized):
+        """store the serialized log buffer at addr"""
+        if not 0 <= addr < self.size:
+            return
+        record = binascii.unhexlify(serialized)
+        offset = addr*self.RECORD
+        with self._lock:
+            if self._data[offset:offset+self.RECORD] == record:
+                return
+            self._data[offset:offset+self.RECORD] = record
+            #the record first, a header naming a record not written would pass it as checked
+            self._write(self.HEADER.size + offset, record)
+            if addr > self.newest:
+                self.newest = addr
+                self._write(0, self._header())
+            self._sync()
+
+    def set_logaddr(self, logaddr):
+        """record the log address the circle reported"""
+        with self._lock:
+            if logaddr != self.logaddr:
+                self.logaddr = logaddr
+                self._write(0, self._header())
+                self._sync()
+
+    def invalidate(self):
+        """forget all mirrored buffers, after the log of the circle was cleared or wrapped"""
+        with self._lock:
+            self._data[:] = bytes(len(self._data))
+            self.newest = -1
+            self._write(0, self._header() + self._data)
+            self._sync()
+
+    def count(self):
+        """number of mirrored addresses"""
+        return sum(1 for addr in range(self.size) if self._data[addr*self.RECORD:(addr+1)*self.RECORD] != self.EMPTY)
+
+    def _header(self):
+        return self.HEADER.pack(self.MAGIC, self.logaddr, self.newest)
+
+    def _write(self, offset, data):
+        f = self._open()
+        f.seek(offset)
+        f.write(data)
+
+    def _sync(self):
+        """the mirror is the checkpoint of a backfill, make it survive a power cut"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _open(self):
+        if self._file is None:
+            if not os.path.exists(self.filename):
+                with open(self.filename, 'wb') as f:
+                    f.write(self._header() + self._data)
+            self._file = open(self.filename, 'r+b')
+        return self._file
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,172 @@
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+#Fast monitoring of the 1 second power of a few circles, at up to one sample a
+#second. The samples are kept in a ring buffer per circle and appended to a
+#compact log of FAST_RECORD records: timestamp and power in Watt.
+
+import time
+import struct
+import threading
+import collections
+
+from serial.serialutil import SerialException
+
+from swutil.util import *
+from swutil.scheduler import *
+from .exceptions import *
+
+FAST_RECORD = struct.Struct('<df')
+
+def read_fast_log(filename):
+    """yield the (timestamp, watt) samples of a fast monitoring log"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for offset in range(0, len(data) - FAST_RECORD.size + 1, FAST_RECORD.size):
+        yield FAST_RECORD.unpack_from(data, offset)
+
+class FastMonitor(object):
+    """samples circles every period seconds within a share of the stick airtime.
+    The airtime of a sample is taken as the round trip time of its request. Airtime
+    is credited at share seconds a second up to share seconds, a circle is sampled
+    while credit is left. Circles skipped for lack of credit are sampled first the
+    next period.
+    """
+
+    def __init__(self, stick, share=0.25, period=1.0, history=3600, logfname=None):
+        """@param logfname: function of mac and timestamp returning the log file name, None to not log"""
+        self.stick = stick
+        self.share = share
+        self.period = period
+        self.history = history
+        self.logfname = logfname
+        self.circles = []
+        self.buffers = {}
+        self.stats = collections.Counter()
+        self._credit = share
+        self._last = time.time()
+        self._logs = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def set_circles(self, circles):
+        with self._lock:
+            self.circles = list(circles)
+            for c in self.circles:
+                if c.mac not in self.buffers:
+                    self.buffers[c.mac] = collections.deque(maxlen=self.history)
+            macs = set(c.mac for c in self.circles)
+            for mac in list(self._logs):
+                if mac not in macs:
+                    self._logs.pop(mac)[1].close()
+
+    def monitors(self, mac):
+        return any(c.mac == mac for c in self.circles)
+
+    def samples(self, mac, since=0):
+        """the (timestamp, watt) samples of a circle in the ring buffer, after since"""
+        return [s for s in list(self.buffers.get(mac, ())) if s[0] > since]
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name="fastmonitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        due = time.time()
+        while self._running:
+            try:
+                self.sample()
+            except Exception as reason:
+                error("Error in fast monitoring: %s" % (reason,))
+                time.sleep(1)
+            due += self.period
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                #behind, do not try to catch up
+                due = time.time()
+
+    def sample(self):
+        """sample the circles once, as far as the airtime credit allows"""
+        now = time.time()
+        self._credit = min(self.share, self._credit + self.share * (now - self._last))
+        self._last = now
+        with self._lock:
+            circles = [c for c in self.circles if c.online]
+        pending = []
+        with self.stick.scheduler.using(REALTIME):
+            for c in circles:
+                if self._credit <= 0:
+                    self.stats['skipped'] += 1
+                    continue
+                try:
+                    req = c.request_power_usage()
+                except (TimeoutException, SerialException):
+                    self.stats['errors'] += 1
+                    continue
+                pending.append((c, req))
+                #charged with the expected airtime, corrected when the response is in
+                self._credit -= c.rtt()[0] or 0.0
+            for c, req in pending:
+                expected = c.rtt()[0] or 0.0
+                try:
+                    watt = c.get_power_usage(req)[0]
+                except (ValueError, TimeoutException, SerialException):
+                    self.stats['errors'] += 1
+                    continue
+                self._credit -= req.rtt() - expected
+                self.stats['airtime'] += req.rtt()
+                self.stats['samples'] += 1
+                self.buffers[c.mac].append((req.rx_ts, watt))
+                self._log(c.mac, req.rx_ts, watt)
+        #skipped circles first the next time
+        if len(pending) < len(circles):
+            with self._lock:
+                sampled = set(c.mac for c, _ in pending)
+                self.circles.sort(key=lambda c: c.mac in sampled)
+        for _, f in self._logs.values():
+            f.flush()
+
+    def _log(self, mac, ts, watt):
+        if self.logfname is None:
+            return
+        fname = self.logfname(mac, ts)
+        entry = self._logs.get(mac)
+        if entry is None or entry[0] != fname:
+            if entry is not None:
+                entry[1].close()
+            entry = self._logs[mac] = (fname, open(fname, 'ab'))
+        entry[1].write(FAST_RECORD.pack(ts, watt))
+
+    def close(self):
+        self.stop()
+        #the thread may be writing the logs
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for _, f in self._logs.values():
+                f.close()
+            self._logs = {}
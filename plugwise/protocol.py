@@ -24,6 +24,9 @@
 import struct
 import binascii
 import datetime
+import collections
+import threading
+import time
 from .exceptions import *
 
 from swutil.util import *
@@ -37,6 +40,43 @@ import crcmod
 
 crc_fun = crcmod.mkCrcFun(0x11021, rev=False, initCrc=0x0000, xorOut=0x0000)
 
+class LRUCache(object):
+    """mapping of bounded size, evicting the least recently used entry.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
 class UnexpectedResponse(Exception):
     def __init__(self, value):
         self.value = value
@@ -57,8 +97,12 @@ class BaseType(object):
     def serialize(self):
         return self.value
 
+    def decode(self, val):
+        """return the value of serialized val, without storing it"""
+        return val
+
     def unserialize(self, val):
-        self.value = val
+        self.value = self.decode(val)
 
     def __len__(self):
         return self.length
@@ -95,12 +139,12 @@ class StringVal(BaseType):
         fmt = b"%%0%dd" % self.length
         return fmt % self.value
 
-    def unserialize(self, val):
+    def decode(self, val):
         try:
-            self.value = int(val)
+            return int(val)
         except ValueError:
             debug('value error while attempting to construct StringVal object. val = %s' % val)
-            self.value = 0
+            return 0
 
 class SInt(BaseType):
     def __init__(self, value, length=2):
@@ -118,8 +162,12 @@ class SInt(BaseType):
         fmt = b"%%0%dX" % self.length
         return fmt % int_to_uint(self.value, self.length)
 
-    def unserialize(self, val):
-        self.value = self.negative(int(val,16), self.length)
+    def decode(self, val):
+        val = int(val,16)
+        bits = self.length<<2
+        if val & (1<<(bits-1)):
+            val -= 1<<bits
+        return val
     
 class Int(BaseType):
     def __init__(self, value, length=2):
@@ -130,23 +178,21 @@ class Int(BaseType):
         fmt = b"%%0%dX" % self.length
         return fmt % self.value
 
-    def unserialize(self, val):
-        self.value = int(val, 16)
+    def decode(self, val):
+        return int(val, 16)
 
 class UnixTimestamp(Int):
     def __init__(self, value, length=8):
         Int.__init__(self, value, length=length)
 
-    def unserialize(self, val):
-        Int.unserialize(self, val)
-        self.value = datetime.datetime.fromtimestamp(self.value)
+    def decode(self, val):
+        return datetime.datetime.fromtimestamp(int(val, 16))
 
 class Year2k(Int):
     """year value that is offset from the year 2000"""
 
-    def unserialize(self, val):
-        Int.unserialize(self, val)
-        self.value += PLUGWISE_EPOCH
+    def decode(self, val):
+        return int(val, 16) + PLUGWISE_EPOCH
 
 class DateTime(CompositeType):
     """datetime value as used in the general info response
@@ -164,16 +210,21 @@ class DateTime(CompositeType):
 
     def unserialize(self, val):
         CompositeType.unserialize(self, val)
-        minutes = self.minutes.value
+        self.value = self._datetime(self.year.value, self.month.value, self.minutes.value)
+
+    def decode(self, val):
+        return self._datetime(int(val[0:2], 16) + PLUGWISE_EPOCH, int(val[2:4], 16), int(val[4:8], 16))
+
+    def _datetime(self, year, month, minutes):
         hours = minutes // 60
         days = hours // 24
         hours -= (days*24)
         minutes -= (days*24*60)+(hours*60)
         try:
-            self.value = datetime.datetime(self.year.value, self.month.value, days+1, hours, minutes)
+            return datetime.datetime(year, month, days+1, hours, minutes)
         except ValueError:
             debug('value error while attempting to construct datetime object')
-            self.value = None
+            return None
 
 class Time(CompositeType):
     """time value as used in the clock info response"""
@@ -188,6 +239,9 @@ class Time(CompositeType):
     def unserialize(self, val):
         CompositeType.unserialize(self, val)
         self.value = datetime.time(self.hour.value, self.minute.value, self.second.value)
+
+    def decode(self, val):
+        return datetime.time(int(val[0:2], 16), int(val[2:4], 16), int(val[4:6], 16))
         
 class DateStr(CompositeType):
     """date value as used in the datetime info response"""
@@ -201,11 +255,17 @@ class DateStr(CompositeType):
 
     def unserialize(self, val):
         CompositeType.unserialize(self, val)
+        self.value = self._date(self.day.value, self.month.value, self.year.value)
+
+    def decode(self, val):
+        return self._date(self.day.decode(val[0:2]), self.month.decode(val[2:4]), self.year.decode(val[4:6]))
+
+    def _date(self, day, month, year):
         try:
-            self.value = datetime.date(self.year.value+PLUGWISE_EPOCH, self.month.value, self.day.value)
+            return datetime.date(year+PLUGWISE_EPOCH, month, day)
         except ValueError:
             debug('value error while attempting to construct DateStr object')
-            self.value = None
+            return None
        
 class TimeStr(CompositeType):
     """time value as used in the datetime info response"""
@@ -220,15 +280,18 @@ class TimeStr(CompositeType):
     def unserialize(self, val):
         CompositeType.unserialize(self, val)
         self.value = datetime.time(self.hour.value, self.minute.value, self.second.value)
+
+    def decode(self, val):
+        return datetime.time(self.hour.decode(val[4:6]), self.minute.decode(val[2:4]), self.second.decode(val[0:2]))
        
 class Float(BaseType):
     def __init__(self, value, length=4):
         self.value = value
         self.length = length
 
-    def unserialize(self, val):
+    def decode(self, val):
         hexval = binascii.unhexlify(val)
-        self.value = struct.unpack("!f", hexval)[0]
+        return struct.unpack("!f", hexval)[0]
 
 class LogAddr(Int):
     LOGADDR_OFFSET = 278528
@@ -236,9 +299,24 @@ class LogAddr(Int):
     def serialize(self):
         return b"%08X" % ((self.value * 32) + self.LOGADDR_OFFSET)
 
-    def unserialize(self, val):
-        Int.unserialize(self, val)
-        self.value = (self.value - self.LOGADDR_OFFSET) // 32
+    def decode(self, val):
+        return (int(val, 16) - self.LOGADDR_OFFSET) // 32
+
+class Field(object):
+    """decoded response field: the value and the serialized bytes it was decoded from.
+    Offers the value/serialize interface of the BaseType it replaces.
+    """
+    __slots__ = ('value', 'raw')
+
+    def __init__(self, value, raw):
+        self.value = value
+        self.raw = raw
+
+    def serialize(self):
+        return self.raw
+
+    def __len__(self):
+        return len(self.raw)
 
 # /base types
 
@@ -255,14 +333,51 @@ class PlugwiseMessage(object):
         msg = self.ID+self.mac+args
         checksum = self.calculate_checksum(msg)
         full_msg = self.PACKET_HEADER+msg+checksum+self.PACKET_FOOTER
-        logcomm("SEND %4d ---> %4s           %16s %s %4s <---" % (len(full_msg), self.ID.decode(), self.mac.decode(), args.decode(), checksum.decode()))        
+        if logcomm_enabled():
+            logcomm(sendlog(full_msg))
         return full_msg
 
     def calculate_checksum(self, s):
         return b"%04X" % crc_fun(s)
 
+def sendlog(frame):
+    """communication log line of a frame serialized as header, ID, mac, args, checksum, footer"""
+    return "SEND %4d ---> %4s           %16s %s %4s <---" % (len(frame), frame[4:8].decode(), frame[8:24].decode(), frame[24:-6].decode(), frame[-6:-2].decode())
+
+#serialized frames of requests sent repeatedly with the same mac and arguments
+frame_cache = LRUCache(512)
+
+def cached_frame(request_class, mac, *args):
+    """return the serialized frame of request_class(mac, *args). Frames are
+    cached by (request class, mac, args), so args must be hashable. Only use
+    for requests with the standard ID, mac, args layout.
+    """
+    key = (request_class, mac, args)
+    frame = frame_cache.get(key)
+    if frame is None:
+        frame = request_class(mac, *args).serialize()
+        frame_cache[key] = frame
+    elif logcomm_enabled():
+        logcomm(sendlog(frame))
+    return frame
+
+#checksum state after the ID and mac of a request, by ID+mac
+crc_prefixes = LRUCache(128)
+
+def prefix_checksum(prefix, args):
+    """checksum of prefix+args, continuing from the cached CRC over prefix"""
+    crc = crc_prefixes.get(prefix)
+    if crc is None:
+        crc = crc_fun(prefix)
+        crc_prefixes[prefix] = crc
+    return b"%04X" % crc_fun(args, crc)
+
 class PlugwiseResponse(PlugwiseMessage):
     ID = b'FFFF'
+    #flat field layout (name, start, end, decode), compiled at import by _compile()
+    _layout = ()
+    _arglen = 0
+    _framelen = 34
     
     def __init__(self, seqnr = None):
         PlugwiseMessage.__init__(self)
@@ -273,21 +388,53 @@ class PlugwiseResponse(PlugwiseMessage):
         self.command_counter = None
         self.expected_command_counter = seqnr
 
-    def unserialize(self, response):
+    @classmethod
+    def _compile(cls):
+        """flatten the params of a prototype instance into a layout of
+        (attribute name, start offset, end offset, decode function)
+        """
+        proto = cls()
+        names = dict((id(v), k) for k, v in vars(proto).items() if isinstance(v, BaseType))
+        layout = []
+        offset = 0
+        for p in proto.params:
+            layout.append((names[id(p)], offset, offset+len(p), p.decode))
+            offset += len(p)
+        cls._layout = tuple(layout)
+        cls._arglen = offset
+        cls._framelen = len(proto)
+
+    @classmethod
+    def record(cls, seqnr = None):
+        """return an instance to unserialize into, without building the
+        tree of BaseType params. The fields are filled as Field records
+        """
+        resp = cls.__new__(cls)
+        PlugwiseResponse.__init__(resp, seqnr)
+        return resp
+
+    def unserialize(self, response, start=0, end=None):
+        """decode the frame in response[start:end]. The frame is parsed with offsets
+        into the buffer. Only the fields kept in the response are copied out,
+        the checksum is computed over a memoryview.
+        """
         # FIXME: avoid magic numbers
+        if end is None:
+            end = len(response)
 
         header5 = False
-        header_start = response.find(PlugwiseMessage.PACKET_HEADER5)
-        if header_start == 0:
+        if response[start] == 0x83 and response[start+1:start+5] == PlugwiseMessage.PACKET_HEADER:
             #A response from a circle seems to be preceeded by the x/83 in the header
-            #Just strip this character to not further complcate the code
-            response = response[1:]
+            #Just skip this character to not further complcate the code
+            start += 1
             header5 = True
                 
-        header, self.function_code, self.command_counter = struct.unpack("4s4s4s", response[:12])
-        crc, footer = struct.unpack("4s2s", response[-6:])
-        raw_msg_len = len(response)
-        
+        header = response[start:start+4]
+        self.function_code = bytes(response[start+4:start+8])
+        self.command_counter = bytes(response[start+8:start+12])
+        crc = bytes(response[end-6:end-2])
+        footer = response[end-2:end]
+        raw_msg_len = end - start
 
         #check for protocol errors
         protocol_error = ''
@@ -302,20 +449,22 @@ class PlugwiseResponse(PlugwiseMessage):
                 header = '-->>'
             else:
                 header = '--->'
-        if crc != self.calculate_checksum(response[4:-6]):
+        if crc != self.calculate_checksum(memoryview(response)[start+4:end-6]):
             protocol_error = "checksum error!"
-        debug("STRU      "+header+" "+logf(self.function_code)+" "+logf(self.command_counter)+" <data> "+logf(crc)+" "+footer)
+        if debug_enabled():
+            debug("STRU      "+header+" "+logf(self.function_code)+" "+logf(self.command_counter)+" <data> "+logf(crc)+" "+logf(footer))
         if len(protocol_error) > 0:
             raise ProtocolError(protocol_error)
             
         if self.function_code in [b'0000', b'0002', b'0003', b'0005']:
-            response = response[12:-6]
+            offset = start+12
         else:
-            self.mac = response[12:28]
-            response = response[28:-6]
-        debug("DATA %4d %s" % (len(response), logf(response)))
+            self.mac = bytes(response[start+12:start+28])
+            offset = start+28
+        if debug_enabled():
+            debug("DATA %4d %s" % (end-6-offset, logf(response[offset:end-6])))
         
-        if self.function_code in [b'0006', b'0061']:
+        if self.function_code in [b'0006', b'0061'] and self.function_code != self.ID:
             error("response.unserialize: detected %s expected %s" % (logf(self.function_code), logf(self.ID)))
         
         if self.expected_command_counter != None and self.expected_command_counter != self.command_counter:
@@ -326,39 +475,40 @@ class PlugwiseResponse(PlugwiseMessage):
             raise UnexpectedResponse("response doesn't have expected length. expected %d bytes got %d" % (len(self), raw_msg_len))
         
         #log communication when no exceptions will be raised
-        if self.mac is None:
-            logmac = b'................'
-        else:
-            logmac = self.mac
-        if self.function_code in [b'0000', b'0003', b'0005']:
-            #HACK: retrieve info from Acq and AcqMac responses
-            respstatus = response[:4]
-            logresp = b''
-            if raw_msg_len == 38:
-                logmac = response[4:]
-        else:
-            respstatus = b'....'
-            logresp = response
-        logcomm("RECV %4d %s %4s %4s %4s %16s %s %4s %s" % 
-            (raw_msg_len, header, self.function_code.decode(), self.command_counter.decode(),
-            respstatus.decode(), logmac.decode(),
-            logresp.decode(), crc.decode(), footer))
+        if logcomm_enabled():
+            if self.mac is None:
+                logmac = b'................'
+            else:
+                logmac = self.mac
+            if self.function_code in [b'0000', b'0003', b'0005']:
+                #HACK: retrieve info from Acq and AcqMac responses
+                respstatus = response[offset:offset+4]
+                logresp = b''
+                if raw_msg_len == 38:
+                    logmac = response[offset+4:end-6]
+            else:
+                respstatus = b'....'
+                logresp = response[offset:end-6]
+            logcomm("RECV %4d %s %4s %4s %4s %16s %s %4s %s" % 
+                (raw_msg_len, header, self.function_code.decode(), self.command_counter.decode(),
+                bytes(respstatus).decode(), bytes(logmac).decode(),
+                bytes(logresp).decode(), crc.decode(), footer))
         
         # FIXME: check function code match
-        response = self._parse_params(response)
+        self._parse_params(response, offset)
 
-    def _parse_params(self, response):
-        for p in self.params:
-            myval = response[:len(p)]
-            debug("PARS      "+logf(myval))
-            p.unserialize(myval)
-            debug("PARS      "+logf(myval) + " EVAL "+str(p.value))
-            response = response[len(myval):]
-        return response
+    def _parse_params(self, response, offset=0):
+        """decode the fields of the compiled layout from response, starting at
+        offset. Returns the offset just beyond the last field.
+        """
+        fields = self.__dict__
+        for name, start, end, decode in self._layout:
+            raw = response[offset+start:offset+end]
+            fields[name] = Field(decode(raw), raw)
+        return offset + self._arglen
 
     def __len__(self):
-        arglen = sum(len(x) for x in self.params)
-        return 34 + arglen
+        return 34 + self._arglen
 
 class PlugwiseAckResponse(PlugwiseResponse):
     ID = b'0000'
@@ -372,12 +522,11 @@ class PlugwiseAckResponse(PlugwiseResponse):
         self.command_counter = None
         
     def __len__(self):
-        arglen = sum(len(x) for x in self.params)
-        return 18 + arglen
+        return 18 + self._arglen
 
-    def unserialize(self, response):
+    def unserialize(self, response, start=0, end=None):
         try:
-            PlugwiseResponse.unserialize(self, response)
+            PlugwiseResponse.unserialize(self, response, start, end)
         except UnexpectedResponse as reason:
             if self.function_code != None and self.function_code in ['0006', '0061']:
                 debug("PlugwiseAckResponse.unserialize()  Unjoined node. Do we ever arrive here?")
@@ -398,8 +547,8 @@ class PlugwiseAckMacResponse(PlugwiseAckResponse):
         self.acqmac = String(None, length=16)
         self.params += [self.acqmac]
         
-    def unserialize(self, response):
-        PlugwiseAckResponse.unserialize(self, response)
+    def unserialize(self, response, start=0, end=None):
+        PlugwiseAckResponse.unserialize(self, response, start, end)
         self.mac = self.acqmac.value
 
 class PlugwiseCalibrationResponse(PlugwiseResponse):
@@ -577,13 +726,13 @@ class PlugwiseQueryCirclePlusResponse(PlugwiseResponse):
         self.params += [self.channel, self.source_mac_id, self.extended_pan_id, self.unique_network_id, self.new_node_mac_id, self.pan_id, self.idx]
         
     def __len__(self):
-        arglen = sum(len(x) for x in self.params)
-        return 18 + arglen
+        return 18 + self._arglen
 
-    def unserialize(self, response):
-        PlugwiseResponse.unserialize(self, response)
+    def unserialize(self, response, start=0, end=None):
+        PlugwiseResponse.unserialize(self, response, start, end)
         #Clear first two characters of mac ID, as they contain part of the short PAN-ID
         self.new_node_mac_id.value = b'00'+self.new_node_mac_id.value[2:]
+        self.new_node_mac_id.raw = self.new_node_mac_id.value
         
 class PlugwiseQueryCirclePlusEndResponse(PlugwiseResponse):
     ID = b'0003'
@@ -594,8 +743,7 @@ class PlugwiseQueryCirclePlusEndResponse(PlugwiseResponse):
         self.params += [self.status]
        
     def __len__(self):
-        arglen = sum(len(x) for x in self.params)
-        return 18 + arglen
+        return 18 + self._arglen
         
 class PlugwiseConnectCirclePlusResponse(PlugwiseResponse):
     ID = b'0005'
@@ -607,8 +755,7 @@ class PlugwiseConnectCirclePlusResponse(PlugwiseResponse):
         self.params += [self.exsisting, self.allowed]
        
     def __len__(self):
-        arglen = sum(len(x) for x in self.params)
-        return 18 + arglen
+        return 18 + self._arglen
 
 class PlugwiseRemoveNodeResponse(PlugwiseResponse):
     ID = b'001D'
@@ -682,6 +829,17 @@ class PlugwisePowerBufferRequest(PlugwiseRequest):
     def __init__(self, mac, log_address):
         PlugwiseRequest.__init__(self, mac)
         self.args.append(LogAddr(log_address, 8))
+
+    def serialize(self):
+        """the log address is the only argument that changes between requests to
+        the same circle. Continue the checksum from the one over ID and mac.
+        """
+        args = self.args[0].serialize()
+        checksum = prefix_checksum(self.ID+self.mac, args)
+        full_msg = self.PACKET_HEADER+self.ID+self.mac+args+checksum+self.PACKET_FOOTER
+        if logcomm_enabled():
+            logcomm(sendlog(full_msg))
+        return full_msg
         
 class PlugwiseLogIntervalRequest(PlugwiseRequest):
     ID = b'0057'
@@ -734,7 +892,7 @@ class PlugwisePrepareScheduleRequest(PlugwiseRequest):
     
     def __init__(self, idx, schedule_chunk):
         # PrepareScedule doesn't send MAC address
-        PlugwiseRequest.__init__(self, '')
+        PlugwiseRequest.__init__(self, b'')
         self.args.append(Int(16*idx, length=4))
         for i in range(0,8):
             self.args.append(SInt(schedule_chunk[i], length=4))
@@ -847,3 +1005,145 @@ class PlugwiseResetRequest(PlugwiseRequest):
         self.args.append(Int(moduletype, length=2))
         self.args.append(Int(timeout, length=2))
         
+
+def _response_classes(cls=PlugwiseResponse):
+    yield cls
+    for sub in cls.__subclasses__():
+        for c in _response_classes(sub):
+            yield c
+
+class FrameReassembler(object):
+    """reassembles frames from the bytes received from the stick.
+    Received data is appended to one buffer, from which consumed bytes are
+    removed at the front. Frames are located by PACKET_HEADER, with the
+    optional 0x83 prefix, up to PACKET_FOOTER. Length and checksum are
+    checked before a frame is queued together with its receive timestamp.
+    Stick debug output ('#' lines) and other chatter between frames is dropped.
+    """
+    MIN_FRAME = 22
+    MAX_FRAME = 128
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._frames = collections.deque()
+        self.bad_frames = 0
+
+    def reset(self):
+        del self._buf[:]
+        self._frames.clear()
+
+    def feed(self, data, ts=None):
+        """add received data. ts is the receive time, default now"""
+        if ts is None:
+            ts = time.time()
+        self._buf += data
+        self._scan(ts)
+
+    def pending(self):
+        return len(self._frames)
+
+    def pop(self):
+        """return the oldest complete frame as (frame, receive timestamp)"""
+        return self._frames.popleft()
+
+    def partial(self):
+        """the received bytes that are not part of a complete frame yet"""
+        return bytes(self._buf)
+
+    def _scan(self, ts):
+        buf = self._buf
+        pos = 0
+        while True:
+            hdr = buf.find(PlugwiseMessage.PACKET_HEADER, pos)
+            if hdr < 0:
+                #keep an incomplete line of chatter, which may also be the start of a header
+                nl = buf.rfind(b'\n', pos)
+                keep = nl+1 if nl >= 0 else pos
+                if len(buf)-keep > self.MAX_FRAME:
+                    keep = len(buf)-4
+                self._drop(pos, keep)
+                pos = keep
+                break
+            start = hdr-1 if hdr > pos and buf[hdr-1] == 0x83 else hdr
+            self._drop(pos, start)
+            pos = start
+            ftr = buf.find(PlugwiseMessage.PACKET_FOOTER, hdr+4)
+            if ftr < 0:
+                if len(buf)-hdr > self.MAX_FRAME:
+                    self._reject(start, hdr+4, "no footer")
+                    pos = hdr+4
+                    continue
+                break
+            end = ftr+2
+            #a truncated frame followed by a complete one
+            nxt = buf.find(PlugwiseMessage.PACKET_HEADER, hdr+4, end)
+            if nxt >= 0:
+                nxt = nxt-1 if buf[nxt-1] == 0x83 else nxt
+                self._reject(start, nxt, "truncated")
+                pos = nxt
+                continue
+            pos = end
+            if end-hdr < self.MIN_FRAME:
+                self._reject(start, end, "too short")
+                continue
+            with memoryview(buf) as view:
+                crc = b"%04X" % crc_fun(view[hdr+4:end-6])
+            if buf[end-6:end-2] != crc:
+                self._reject(start, end, "checksum error!")
+                continue
+            self._frames.append((bytes(buf[start:end]), ts))
+        del buf[:pos]
+
+    def _drop(self, start, end):
+        if end > start and logcomm_enabled():
+            chatter = self._buf[start:end]
+            if chatter.find(b'#') >= 0:
+                logcomm("DTRC %4d %s" % (len(chatter), logf(chatter)))
+            elif chatter.strip():
+                logcomm("DSTR %4d %s" % (len(chatter), logf(chatter)))
+
+    def _reject(self, start, end, reason):
+        self.bad_frames += 1
+        frame = self._buf[start:end]
+        logcomm("RERR %4d %s - <!> protocol error: %s" % (len(frame), logf(frame), reason))
+        error("protocol error [1]:"+reason)
+
+#response classes by (function code, frame length). The frame length excludes
+#the optional 0x83 prefix. When two classes share a key, the first defined one
+#is registered. The other is only decoded when it is explicitly expected.
+RESPONSE_TYPES = {}
+
+def register_response(response_class):
+    RESPONSE_TYPES.setdefault((response_class.ID, response_class._framelen), response_class)
+
+def decode_response(frame, expected=None, start=0, end=None):
+    """decode the frame in frame[start:end] exactly once, into the response class
+    registered for its function code and length. The expected response class is
+    used when it fits the frame, to select between classes sharing a function code.
+    Returns None when no response class is known for the frame.
+    Raises ProtocolError on a broken header, footer or checksum.
+    """
+    if end is None:
+        end = len(frame)
+    header = start+1 if frame[start] == 0x83 else start
+    if frame[header:header+4] != PlugwiseMessage.PACKET_HEADER:
+        raise ProtocolError("broken header!")
+    key = (bytes(frame[header+4:header+8]), end-header)
+    if expected is not None and (expected.ID, expected._framelen) == key:
+        response_class = expected
+    else:
+        response_class = RESPONSE_TYPES.get(key)
+    if response_class is None:
+        return None
+    resp = response_class.record()
+    resp.unserialize(frame, start, end)
+    return resp
+
+def _register_responses():
+    """compile the layouts of the response classes and register them by ID"""
+    for cls in _response_classes():
+        cls._compile()
+        if cls.ID != PlugwiseResponse.ID:
+            register_response(cls)
+
+_register_responses()
@@ -0,0 +1,321 @@
+# Copyright (C) 2012,2013,2014,2015,2016,2017,2018,2019,2020 Seven Watt <info@sevenwatt.com>
+# <http://www.sevenwatt.com>
+#
+# This file is part of Plugwise-2-py.
+#
+# Plugwise-2-py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Plugwise-2-py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Plugwise-2-py.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import heapq
+import random
+import itertools
+import threading
+import contextlib
+
+from .util import *
+
+#priority classes, most urgent first
+INTERACTIVE = 0
+REALTIME = 1
+RELAY = 2
+HISTORY = 3
+MAINTENANCE = 4
+PRIORITY_NAMES = ['interactive', 'realtime', 'relay', 'history', 'maintenance']
+
+class CommandScheduler(object):
+    """admission of requests to a shared channel by priority class.
+    Waiting requests are admitted most urgent class first, in arrival order
+    within a class. A class can be limited in the number of requests it has
+    admitted and not yet released, so that background work leaves room for
+    urgent requests. The priority of the requests of a thread is set with
+    using(). The scheduler does not lock: the caller serializes the calls.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+        self.active = [0] * len(PRIORITY_NAMES)
+        self._waiting = []
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self._admitted = [0] * len(PRIORITY_NAMES)
+        self._wait_total = [0.0] * len(PRIORITY_NAMES)
+        self._wait_max = [0.0] * len(PRIORITY_NAMES)
+
+    def priority(self):
+        """the priority class of the requests of the calling thread"""
+        return getattr(self._local, 'priority', REALTIME)
+
+    @contextlib.contextmanager
+    def using(self, priority):
+        prev = self.priority()
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = prev
+
+    def enqueue(self, priority=None):
+        """register a waiting request, returns its ticket"""
+        if priority is None:
+            priority = self.priority()
+        ticket = (priority, next(self._seq), time.time())
+        self._waiting.append(ticket)
+        return ticket
+
+    def admissible(self, ticket, room):
+        """True when ticket is the most urgent waiting request its class limit allows,
+        and room is available on the channel.
+        """
+        if not room:
+            return False
+        eligible = [t for t in self._waiting if self._below_limit(t[0])]
+        return bool(eligible) and min(eligible) is ticket
+
+    def admit(self, ticket):
+        priority, _, ts = ticket
+        self._waiting.remove(ticket)
+        self.active[priority] += 1
+        wait = time.time() - ts
+        self._admitted[priority] += 1
+        self._wait_total[priority] += wait
+        self._wait_max[priority] = max(self._wait_max[priority], wait)
+        return priority
+
+    def cancel(self, ticket):
+        self._waiting.remove(ticket)
+
+    def release(self, priority):
+        self.active[priority] -= 1
+
+    def set_limit(self, priority, limit):
+        """limit the requests of a class in flight, returns the previous limit.
+        limit is a number, a function returning the number, or None for no limit.
+        """
+        prev = self.limits.get(priority)
+        if limit is None:
+            self.limits.pop(priority, None)
+        else:
+            self.limits[priority] = limit
+        return prev
+
+    def _below_limit(self, priority):
+        limit = self.limits.get(priority)
+        if callable(limit):
+            limit = limit()
+        return limit is None or self.active[priority] < limit
+
+    def stats(self, reset=False):
+        """per class: admitted requests, average and maximum queue wait in seconds"""
+        retd = {}
+        for priority, name in enumerate(PRIORITY_NAMES):
+            n = self._admitted[priority]
+            retd[name] = {
+                "admitted": n,
+                "waiting": sum(1 for t in self._waiting if t[0] == priority),
+                "wait_avg": self._wait_total[priority] / n if n else 0.0,
+                "wait_max": self._wait_max[priority],
+            }
+        if reset:
+            self._admitted = [0] * len(PRIORITY_NAMES)
+            self._wait_total = [0.0] * len(PRIORITY_NAMES)
+            self._wait_max = [0.0] * len(PRIORITY_NAMES)
+        return retd
+
+class AdaptiveRate(object):
+    """interval between readings of a changing value, between minimum and maximum
+    seconds. A reading that changed more than absolute, or more than relative of the
+    previous reading, resets the interval to the minimum. An unchanged reading
+    doubles the interval.
+    """
+
+    def __init__(self, minimum, maximum, absolute=5.0, relative=0.1):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.absolute = absolute
+        self.relative = relative
+        self.interval = minimum
+        self.last = None
+        self.next = 0
+
+    def due(self, now, slack=0):
+        """True when a reading is due at now, or within slack seconds after now"""
+        return now + slack >= self.next
+
+    def overdue(self, now):
+        """seconds past the time of the next reading"""
+        return now - self.next
+
+    def update(self, value, now):
+        """register a reading taken at now, returns True when it changed"""
+        changed = self.last is None or abs(value - self.last) > max(self.absolute, self.relative * abs(self.last))
+        if changed:
+            self.interval = self.minimum
+        else:
+            self.interval = min(self.maximum, self.interval * 2)
+        self.last = value
+        self.next = now + self.interval
+        return changed
+
+class Deadband(object):
+    """report by exception. A value is reported when it differs from the last reported
+    value by more than absolute, or by more than relative of that value, or when
+    heartbeat seconds passed since the last report. Without limits every value is
+    reported, a heartbeat of 0 disables the heartbeat.
+    """
+
+    def __init__(self, absolute=0.0, relative=0.0, heartbeat=0):
+        self.absolute = absolute
+        self.relative = relative
+        self.heartbeat = heartbeat
+        self.last = None
+        self.last_ts = 0
+
+    def report(self, value, now):
+        """True when value is to be reported, it is then the last reported value"""
+        if self.last is not None and (self.absolute > 0 or self.relative > 0):
+            band = max(self.absolute, self.relative * abs(self.last))
+            silent = now - self.last_ts < self.heartbeat if self.heartbeat > 0 else True
+            if abs(value - self.last) <= band and silent:
+                return False
+        self.last = value
+        self.last_ts = now
+        return True
+
+#what a periodic task does after a run that ended beyond its next run time
+SKIP = 'skip'
+CATCH_UP = 'catch up'
+
+class PeriodicTask(object):
+    """a function run every interval seconds, at phase seconds past the multiples of
+    the interval since the epoch, delayed by up to jitter seconds. A run taking longer
+    than max_runtime seconds is an overrun. Runs missed by a late or long run are
+    skipped, or run at once to catch up.
+    """
+
+    def __init__(self, name, fn, interval, phase=0, jitter=0, max_runtime=None, overrun=SKIP, order=0):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.phase = phase
+        self.jitter = jitter
+        self.max_runtime = max_runtime if max_runtime is not None else interval
+        self.overrun = overrun
+        self.order = order
+        self.due = None
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def next_after(self, t):
+        """the first aligned run time after t"""
+        slot = (t - self.phase) // self.interval
+        return self.phase + (slot + 1) * self.interval
+
+    def reset_stats(self):
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.total = 0.0
+        self.max = 0.0
+
+class TaskScheduler(object):
+    """runs periodic tasks in the order of their run times, tasks due at the same time
+    in the order they were added. run() sleeps until the next task is due in the idle
+    function, which can return earlier to handle events.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.tasks = []
+        self._heap = []
+        self._running = False
+
+    def add(self, name, fn, interval, phase=0, jitter=0, max_runtime=None, overrun=SKIP, start=None):
+        """register fn to run every interval seconds, see PeriodicTask.
+        @param start: time of the first run, None for the first aligned run time
+        """
+        task = PeriodicTask(name, fn, interval, phase, jitter, max_runtime, overrun, len(self.tasks))
+        self.tasks.append(task)
+        if start is None:
+            start = task.next_after(self.clock())
+        self._schedule(task, start)
+        return task
+
+    def _schedule(self, task, due):
+        task.due = due
+        heapq.heappush(self._heap, (due + random.uniform(0, task.jitter), task.order, task))
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def run_pending(self):
+        """run the tasks that are due, returns the number of tasks run"""
+        n = 0
+        while self._heap and self._heap[0][0] <= self.clock():
+            _, _, task = heapq.heappop(self._heap)
+            start = self.clock()
+            try:
+                task.fn()
+            finally:
+                end = self.clock()
+                runtime = end - start
+                task.runs += 1
+                task.total += runtime
+                task.max = max(task.max, runtime)
+                if runtime > task.max_runtime:
+                    task.overruns += 1
+                    info("task %s overrun: %.1f s" % (task.name, runtime))
+                due = task.due + task.interval
+                if due <= end and task.overrun == SKIP:
+                    skip_to = task.next_after(end)
+                    task.skipped += int(round((skip_to - due) / task.interval))
+                    due = skip_to
+                self._schedule(task, due)
+            n += 1
+        return n
+
+    def run(self, idle=None):
+        """run the tasks until stop(). idle(timeout) waits up to timeout seconds,
+        time.sleep when None.
+        """
+        idle = idle or time.sleep
+        self._running = True
+        while self._running:
+            self.run_pending()
+            due = self.next_due()
+            if due is None:
+                break
+            timeout = due - self.clock()
+            if timeout > 0:
+                idle(timeout)
+
+    def stop(self):
+        self._running = False
+
+    def stats(self, reset=False):
+        """per task: runs, overruns, skipped runs, average and maximum run time in seconds"""
+        retd = {}
+        for task in self.tasks:
+            retd[task.name] = {
+                "runs": task.runs,
+                "overruns": task.overruns,
+                "skipped": task.skipped,
+                "avg": task.total / task.runs if task.runs else 0.0,
+                "max": task.max,
+            }
+            if reset:
+                task.reset_stats()
+        return retd
@@ -22,6 +22,8 @@
 #   POL v0.2 - written in 2009 by Maarten Damen <http://www.maartendamen.com>
 
 import sys
+import time
+import struct
 import serial
 from serial.serialutil import SerialException
 import datetime
@@ -33,12 +35,15 @@ LOG_COMMUNICATION = False
 #global var
 pw_logger = None
 pw_comm_logger = None
+pw_capture = None
 
 def logf(msg):
     if type(msg) == type("  "):
         return msg
     if type(msg) == type(b'  '):
         return repr(msg.decode('utf-8', 'backslashreplace'))[1:-1]
+    if isinstance(msg, (bytearray, memoryview)):
+        return repr(bytes(msg).decode('utf-8', 'backslashreplace'))[1:-1]
     return repr(msg)[1:-1]
 
 def hexstr(s):
@@ -76,6 +81,10 @@ def log_comm(enable):
     global LOG_COMMUNICATION
     LOG_COMMUNICATION = enable
 
+def debug_enabled():
+    """test before formatting expensive debug messages"""
+    return pw_logger.isEnabledFor(logging.DEBUG)
+
 def debug(msg):
     #if __debug__ and DEBUG_PROTOCOL:
         #print("%s: %s" % (datetime.datetime.now().isoformat(), msg,))
@@ -108,11 +117,92 @@ def close_logcomm():
     #logcommfile.close()
     return
     
+def logcomm_enabled():
+    """test before formatting expensive communication log messages"""
+    return LOG_COMMUNICATION
+
 def logcomm(msg):
     if LOG_COMMUNICATION:
         #logcommfile.write("%s %s \n" % (datetime.datetime.now().isoformat(), msg,))
         pw_comm_logger.info(msg)
 
+#binary capture of the serial traffic. The file starts with CAPTURE_MAGIC, followed
+#by records of a little endian header (timestamp, direction, length) and the raw bytes.
+CAPTURE_MAGIC = b'PWCAP1\n'
+CAPTURE_RX = 0
+CAPTURE_TX = 1
+CAPTURE_RECORD = struct.Struct('<dBH')
+
+class CaptureWriter(object):
+    """appends the bytes read from and written to the serial port to a capture file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = open(filename, 'ab', 65536)
+        if self._f.tell() == 0:
+            self._f.write(CAPTURE_MAGIC)
+
+    def write(self, direction, data, ts=None):
+        #one write call per record, the buffered file serializes the threads
+        data = bytes(data)
+        for i in range(0, len(data), 0xFFFF):
+            chunk = data[i:i+0xFFFF]
+            self._f.write(CAPTURE_RECORD.pack(time.time() if ts is None else ts, direction, len(chunk)) + chunk)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+def read_capture(filename):
+    """yield the records of a capture file as (timestamp, direction, data).
+    A record truncated by a crash ends the capture.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a capture file" % (filename,))
+        while True:
+            hdr = f.read(CAPTURE_RECORD.size)
+            if len(hdr) < CAPTURE_RECORD.size:
+                return
+            ts, direction, length = CAPTURE_RECORD.unpack(hdr)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield ts, direction, data
+
+def open_capture(filename):
+    """start capturing the serial traffic to filename, appending to an existing capture"""
+    global pw_capture
+    if pw_capture is not None:
+        if pw_capture.filename == filename:
+            return
+        close_capture()
+    pw_capture = CaptureWriter(filename)
+    info("capturing serial traffic to %s" % (filename,))
+
+def close_capture():
+    global pw_capture
+    if pw_capture is not None:
+        capture = pw_capture
+        pw_capture = None
+        capture.close()
+        info("capture of serial traffic closed")
+
+def capture(direction, data):
+    cap = pw_capture
+    if cap is not None:
+        try:
+            cap.write(direction, data)
+        except ValueError:
+            #closed by another thread
+            pass
+
+def flush_capture():
+    if pw_capture is not None:
+        pw_capture.flush()
+
 class SerialComChannel(object):
     """simple wrapper around serial module"""
 
@@ -157,7 +247,26 @@ class SerialComChannel(object):
                 self.reopen()
             except Exception as e:
                 info("read reopen exception %s" % str(e))
-        return self._fd.read(bytecount)
+        data = self._fd.read(bytecount)
+        if pw_capture is not None and data:
+            capture(CAPTURE_RX, data)
+        return data
+
+    def read_available(self):
+        """read all bytes waiting in the OS buffer. When nothing is waiting,
+        block for the first byte for at most the port timeout.
+        """
+        if not self.connected:
+            try:
+                self.reopen()
+            except Exception as e:
+                info("read reopen exception %s" % str(e))
+        data = self._fd.read(self._fd.in_waiting or 1)
+        if data and self._fd.in_waiting:
+            data += self._fd.read(self._fd.in_waiting)
+        if pw_capture is not None and data:
+            capture(CAPTURE_RX, data)
+        return data
 
     def readline(self):
         if not self.connected:
@@ -165,7 +274,10 @@ class SerialComChannel(object):
                 self.reopen()
             except Exception as e:
                 info("readline reopen exception %s" % str(e))
-        return self._fd.readline()
+        data = self._fd.readline()
+        if pw_capture is not None and data:
+            capture(CAPTURE_RX, data)
+        return data
 
     def write(self, data):
         if not self.connected:
@@ -173,4 +285,6 @@ class SerialComChannel(object):
                 self.reopen()
             except Exception as e:
                 info("write reopen exception %s" % str(e))
+        if pw_capture is not None:
+            capture(CAPTURE_TX, data)
         self._fd.write(data)